@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 import json
 from dotenv import load_dotenv
 from datetime import datetime
@@ -33,10 +33,13 @@ class Account(BaseModel):
     holdings: dict[str, int]
     transactions: list[Transaction]
     portfolio_value_time_series: list[tuple[str, float]]
+    # False when Account.get left transactions and portfolio_value_time_series out, see load_history()
+    _history_loaded: bool = PrivateAttr(default=True)
 
     @classmethod
-    def get(cls, name: str):
-        fields = db.read_account(name.lower())
+    def get(cls, name: str, history: bool = True):
+        """ The account of name, created if needed.  history=False skips the transactions and the time series. """
+        fields = db.read_account(name.lower(), history)
         if not fields:
             fields = {
                 "name": name.lower(),
@@ -47,10 +50,42 @@ class Account(BaseModel):
                 "portfolio_value_time_series": []
             }
             db.write_account(name, fields)
-        return cls(**fields)
-    
+        account = cls(**fields)
+        account._history_loaded = history
+        return account
+
+    # Projections for callers that need a single field: one small query on an index, no Account built.  An account
+    # that does not exist yet is created like Account.get does
+
+    @classmethod
+    def read_balance(cls, name: str) -> float:
+        """ The cash balance of name. """
+        balance = db.read_balance(name)
+        return balance if balance is not None else cls.get(name, history=False).balance
+
+    @classmethod
+    def read_holdings(cls, name: str) -> dict[str, int]:
+        """ The holdings of name. """
+        holdings = db.read_holdings(name)
+        if not holdings and db.read_balance(name) is None:
+            return cls.get(name, history=False).holdings
+        return holdings
+
+    @classmethod
+    def read_transactions(cls, name: str, last_n: int = 10) -> list[dict]:
+        """ The last_n most recent transactions of name, oldest first. """
+        return db.read_transactions(name, last_n)
+
+    def load_history(self):
+        """ Read the transactions and the portfolio value time series if they were not loaded yet. """
+        if not self._history_loaded:
+            self.transactions = [Transaction(**transaction) for transaction in db.read_transactions(self.name)]
+            self.portfolio_value_time_series = db.read_portfolio_values(self.name)
+            self._history_loaded = True
     
     def save(self):
+        # Rewrites every row of the account, so the history must be there.  Trades only write their own rows
+        self.load_history()
         # BaseModel.model_dump() will convert BaseModel to Dict[string, Any]
         db.write_account(self.name.lower(), self.model_dump())
 
@@ -60,6 +95,7 @@ class Account(BaseModel):
         self.holdings = {}
         self.transactions = []
         self.portfolio_value_time_series = []
+        self._history_loaded = True
         self.save()
 
     def deposit(self, amount: float):
@@ -68,7 +104,7 @@ class Account(BaseModel):
             raise ValueError("Deposit amount must be positive.")
         self.balance += amount
         print(f"Deposited ${amount}. New balance: ${self.balance}")
-        self.save()
+        db.add_to_balance(self.name, amount)
 
     def withdraw(self, amount: float):
         """ Withdraw funds from the account, ensuring it doesn't go negative. """
@@ -76,7 +112,7 @@ class Account(BaseModel):
             raise ValueError("Insufficient funds for withdrawal.")
         self.balance -= amount
         print(f"Withdrew ${amount}. New balance: ${self.balance}")
-        self.save()
+        db.add_to_balance(self.name, -amount)
 
     def buy_shares(self, symbol: str, quantity: int, rationale: str) -> str:
         """ Buy shares of a stock if sufficient funds are available. """
@@ -94,11 +130,12 @@ class Account(BaseModel):
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         # Record transaction
         transaction = Transaction(symbol=symbol, quantity=quantity, price=buy_price, timestamp=timestamp, rationale=rationale)
-        self.transactions.append(transaction)
+        if self._history_loaded:
+            self.transactions.append(transaction)
         
         # Update balance
         self.balance -= total_cost
-        self.save()
+        db.write_transaction(self.name, transaction.model_dump())
         db.write_log(self.name, "account", f"Bought {quantity} of {symbol}")
         return "Completed. Latest details:\n" + self.report()
 
@@ -120,11 +157,12 @@ class Account(BaseModel):
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         # Record transaction
         transaction = Transaction(symbol=symbol, quantity=-quantity, price=sell_price, timestamp=timestamp, rationale=rationale)  # negative quantity for sell
-        self.transactions.append(transaction)
+        if self._history_loaded:
+            self.transactions.append(transaction)
 
         # Update balance
         self.balance += total_proceeds
-        self.save()
+        db.write_transaction(self.name, transaction.model_dump())
         db.write_log(self.name, "account", f"Sold {quantity} of {symbol}")
         return "Completed. Latest details:\n" + self.report()
 
@@ -137,7 +175,10 @@ class Account(BaseModel):
 
     def calculate_profit_loss(self, portfolio_value: float):
         """ Calculate profit or loss from the initial spend. """
-        initial_spend = sum(transaction.total() for transaction in self.transactions)
+        if self._history_loaded:
+            initial_spend = sum(transaction.total() for transaction in self.transactions)
+        else:
+            initial_spend = db.read_transactions_total(self.name)
         return portfolio_value - initial_spend - self.balance
 
     def get_holdings(self):
@@ -148,15 +189,24 @@ class Account(BaseModel):
         """ Report the user's profit or loss at any point in time. """
         return self.calculate_profit_loss()
 
-    def list_transactions(self):
-        """ List all transactions made by the user. """
-        return [transaction.model_dump() for transaction in self.transactions]
+    def list_transactions(self, last_n: int | None = None):
+        """ List all transactions made by the user, or the last_n most recent ones. """
+        if last_n is not None and not self._history_loaded:
+            return db.read_transactions(self.name, last_n)
+        self.load_history()
+        transactions = self.transactions if last_n is None else self.transactions[max(0, len(self.transactions) - last_n):]
+        return [transaction.model_dump() for transaction in transactions]
     
     def report(self) -> str:
         """ Return a json string representing the account.  """
         portfolio_value = self.calculate_portfolio_value()
-        self.portfolio_value_time_series.append((datetime.now().strftime("%Y-%m-%d %H:%M:%S"), portfolio_value))
-        self.save()
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        db.write_portfolio_value(self.name, timestamp, portfolio_value)
+        if self._history_loaded:
+            self.portfolio_value_time_series.append((timestamp, portfolio_value))
+        else:
+            # The report lists the whole history, the new value included
+            self.load_history()
         pnl = self.calculate_profit_loss(portfolio_value)
         data = self.model_dump()
         data["total_portfolio_value"] = portfolio_value
@@ -172,7 +222,7 @@ class Account(BaseModel):
     def change_strategy(self, strategy: str) -> str:
         """ At your discretion, if you choose to, call this to change your investment strategy for the future """
         self.strategy = strategy
-        self.save()
+        db.write_strategy(self.name, strategy)
         db.write_log(self.name, "account", f"Changed strategy")
         return "Changed strategy"
 
@@ -1,3 +1,5 @@
+import threading
+from collections import deque
 import gradio as gr
 from util import css, js, Color
 import pandas as pd
@@ -17,12 +19,19 @@ mapper = {
 
 db = Database()
 
+# Log lines shown per trader
+LOG_LINES = 13
+
 class Trader:
     def __init__(self, name: str, lastname: str, model_name: str):
         self.name = name
         self.lastname = lastname
         self.model_name = model_name
         self.account = Account.get(name)
+        # Tail of the logs shown by the UI.  Each poll only fetches the rows written since the last one
+        self.logs = deque(maxlen=LOG_LINES)
+        self.last_log_id = 0
+        self.logs_lock = threading.Lock()
 
     def reload(self):
         self.account = Account.get(self.name)
@@ -82,7 +91,12 @@ class Trader:
         return f"<div style='text-align: center;background-color:{color};'><span style='font-size:32px'>${portfolio_value:,.0f}</span><span style='font-size:24px'>&nbsp;&nbsp;&nbsp;{emoji}&nbsp;${pnl:,.0f}</span></div>"
 
     def get_logs(self, previous=None) -> str:
-        logs = db.read_log(self.name, last_n=13)
+        # Every open browser tab polls twice a second: the timer ticks share the tail, each one renders it
+        with self.logs_lock:
+            for log_id, timestamp, type, message in db.read_log_since(self.name, self.last_log_id, last_n=LOG_LINES):
+                self.logs.append((timestamp, type, message))
+                self.last_log_id = log_id
+            logs = list(self.logs)
         response = ""
         for log in logs:
             timestamp, type, message = log
@@ -1,102 +1,456 @@
+import os
 import sqlite3
 import json
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 
 load_dotenv(override=True)
 
 DB = "accounts.db"
 
+# Traders, the MCP accounts servers, the tracer and the UI all write accounts.db at the same time.  A writer waits that
+# long for the others to commit instead of failing right away with 'database is locked'
+BUSY_TIMEOUT_SECONDS = 10.0
+# Prepared statements kept by each connection.  Every query below is a constant string, so sqlite3 compiles it once
+# per connection and reuses the statement afterwards
+CACHED_STATEMENTS = 64
+# Log rows older than that are moved to LOG_ARCHIVE_DB by archive_logs().  Their daily counts stay in log_rollups
+LOG_RETENTION_DAYS = 7
+LOG_ARCHIVE_DB = "logs_archive.db"
+# Rows moved per transaction, so the traders writing logs never wait long for the archive job
+LOG_ARCHIVE_BATCH_SIZE = 5000
+
+# An account is spread over four tables, so a trade appends a transaction and updates one balance and one holding
+# instead of rewriting the whole history of the trader
+CREATE_ACCOUNTS = 'CREATE TABLE IF NOT EXISTS accounts (name TEXT PRIMARY KEY, balance REAL, strategy TEXT)'
+CREATE_HOLDINGS = '''
+    CREATE TABLE IF NOT EXISTS holdings (
+        name TEXT,
+        symbol TEXT,
+        quantity INTEGER,
+        PRIMARY KEY (name, symbol)
+    )
+'''
+CREATE_TRANSACTIONS = '''
+    CREATE TABLE IF NOT EXISTS transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        symbol TEXT,
+        quantity INTEGER,
+        price REAL,
+        timestamp TEXT,
+        rationale TEXT
+    )
+'''
+CREATE_TRANSACTIONS_NAME_ID_INDEX = 'CREATE INDEX IF NOT EXISTS transactions_name_id ON transactions (name, id)'
+CREATE_PORTFOLIO_VALUES = '''
+    CREATE TABLE IF NOT EXISTS portfolio_values (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        datetime TEXT,
+        value REAL
+    )
+'''
+CREATE_PORTFOLIO_VALUES_NAME_ID_INDEX = 'CREATE INDEX IF NOT EXISTS portfolio_values_name_id ON portfolio_values (name, id)'
+CREATE_LOGS = '''
+    CREATE TABLE IF NOT EXISTS logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        datetime DATETIME,
+        type TEXT,
+        message TEXT
+    )
+'''
+# A poll of one trader's logs reads the tail of its range in this index instead of sorting the whole table
+CREATE_LOGS_NAME_ID_INDEX = 'CREATE INDEX IF NOT EXISTS logs_name_id ON logs (name, id)'
+# The archive job reads the rows older than the cutoff as a range of this index
+CREATE_LOGS_DATETIME_INDEX = 'CREATE INDEX IF NOT EXISTS logs_datetime ON logs (datetime)'
+CREATE_LOG_ROLLUPS = '''
+    CREATE TABLE IF NOT EXISTS log_rollups (
+        name TEXT,
+        day TEXT,
+        type TEXT,
+        count INTEGER,
+        PRIMARY KEY (name, day, type)
+    )
+'''
+CREATE_MARKET = 'CREATE TABLE IF NOT EXISTS market (date TEXT PRIMARY KEY, data TEXT)'
+
+UPSERT_ACCOUNT = '''
+    INSERT INTO accounts (name, balance, strategy)
+    VALUES (?, ?, ?)
+    ON CONFLICT(name) DO UPDATE SET balance=excluded.balance, strategy=excluded.strategy
+'''
+SELECT_ACCOUNT = 'SELECT balance, strategy FROM accounts WHERE name = ?'
+SELECT_BALANCE = 'SELECT balance FROM accounts WHERE name = ?'
+# Deltas rather than new values: the MCP server of a trader and a reset from another process never undo each other
+ADD_BALANCE = 'UPDATE accounts SET balance = balance + ? WHERE name = ?'
+UPDATE_STRATEGY = 'UPDATE accounts SET strategy = ? WHERE name = ?'
+ADD_HOLDING = '''
+    INSERT INTO holdings (name, symbol, quantity)
+    VALUES (?, ?, ?)
+    ON CONFLICT(name, symbol) DO UPDATE SET quantity = quantity + excluded.quantity
+'''
+DELETE_EMPTY_HOLDING = 'DELETE FROM holdings WHERE name = ? AND symbol = ? AND quantity = 0'
+# rowid: the order the symbols were first bought, like the dict of the JSON account
+SELECT_HOLDINGS = 'SELECT symbol, quantity FROM holdings WHERE name = ? ORDER BY rowid'
+INSERT_TRANSACTION = '''
+    INSERT INTO transactions (name, symbol, quantity, price, timestamp, rationale)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+SELECT_TRANSACTIONS = 'SELECT symbol, quantity, price, timestamp, rationale FROM transactions WHERE name = ? ORDER BY id'
+# The tail of the (name, id) index range, whatever the length of the history
+SELECT_LAST_TRANSACTIONS = '''
+    SELECT symbol, quantity, price, timestamp, rationale FROM transactions
+    WHERE name = ?
+    ORDER BY id DESC
+    LIMIT ?
+'''
+SELECT_TRANSACTIONS_TOTAL = 'SELECT COALESCE(SUM(quantity * price), 0.0) FROM transactions WHERE name = ?'
+INSERT_PORTFOLIO_VALUE = 'INSERT INTO portfolio_values (name, datetime, value) VALUES (?, ?, ?)'
+SELECT_PORTFOLIO_VALUES = 'SELECT datetime, value FROM portfolio_values WHERE name = ? ORDER BY id'
+DELETE_HOLDINGS = 'DELETE FROM holdings WHERE name = ?'
+DELETE_TRANSACTIONS = 'DELETE FROM transactions WHERE name = ?'
+DELETE_PORTFOLIO_VALUES = 'DELETE FROM portfolio_values WHERE name = ?'
+# accounts.db files written before the tables above: one JSON document per trader in accounts (name, account)
+SELECT_ACCOUNTS_COLUMNS = 'SELECT name FROM pragma_table_info(\'accounts\')'
+RENAME_JSON_ACCOUNTS = 'ALTER TABLE accounts RENAME TO accounts_json'
+SELECT_JSON_ACCOUNTS = 'SELECT name, account FROM accounts_json'
+INSERT_LOG = '''
+    INSERT INTO logs (name, datetime, type, message)
+    VALUES (?, datetime('now'), ?, ?)
+'''
+# Batches of the log sink carry the time each entry was logged, not the time the batch is written
+INSERT_TIMED_LOG = 'INSERT INTO logs (name, datetime, type, message) VALUES (?, ?, ?, ?)'
+# id rather than datetime: same order (datetime has a 1 s resolution, id breaks the ties) and served by logs_name_id
+SELECT_LAST_LOGS = '''
+    SELECT datetime, type, message FROM logs
+    WHERE name = ?
+    ORDER BY id DESC
+    LIMIT ?
+'''
+SELECT_LOGS_SINCE = '''
+    SELECT id, datetime, type, message FROM logs
+    WHERE name = ? AND id > ?
+    ORDER BY id DESC
+    LIMIT ?
+'''
+# Rows without a datetime never compare below the cutoff, so they stay in logs instead of breaking the job
+SELECT_OLD_LOGS = 'SELECT id, name, datetime, type, message FROM logs WHERE datetime < ? ORDER BY datetime LIMIT ?'
+CREATE_ARCHIVED_LOGS = '''
+    CREATE TABLE IF NOT EXISTS logs (
+        id INTEGER PRIMARY KEY,
+        name TEXT,
+        datetime DATETIME,
+        type TEXT,
+        message TEXT
+    )
+'''
+INSERT_ARCHIVED_LOG = 'INSERT OR IGNORE INTO logs (id, name, datetime, type, message) VALUES (?, ?, ?, ?, ?)'
+DELETE_LOG = 'DELETE FROM logs WHERE id = ?'
+UPSERT_LOG_ROLLUP = '''
+    INSERT INTO log_rollups (name, day, type, count)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(name, day, type) DO UPDATE SET count=count + excluded.count
+'''
+UPSERT_MARKET = '''
+    INSERT INTO market (date, data)
+    VALUES (?, ?)
+    ON CONFLICT(date) DO UPDATE SET data=excluded.data
+'''
+SELECT_MARKET = 'SELECT data FROM market WHERE date = ?'
+
+# One connection per (process, thread, database file), shared by every Database instance: accounts.py, market.py,
+# tracers.py and app.py each create one at import
+_local = threading.local()
+_connections: list[sqlite3.Connection] = []
+_connections_lock = threading.Lock()
+# Bumped by close_connections(), so every thread drops its closed connections
+_generation = 0
+
+
+def connect(path: str = DB) -> sqlite3.Connection:
+    """The connection of the calling thread to path, opened on first use and reused afterwards."""
+    connections = getattr(_local, 'connections', None)
+    # A forked child must not use the connections of its parent
+    if connections is None or _local.pid != os.getpid() or _local.generation != _generation:
+        connections = _local.connections = {}
+        _local.pid, _local.generation = os.getpid(), _generation
+    conn = connections.get(path)
+    if conn is None:
+        # check_same_thread=False only so close_connections() can close it from the main thread at shutdown
+        conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_SECONDS, cached_statements=CACHED_STATEMENTS,
+                               check_same_thread=False)
+        # With WAL, NORMAL only syncs at checkpoints: a power loss may drop the last commits but never corrupts the file
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(BUSY_TIMEOUT_SECONDS * 1000)}')
+        connections[path] = conn
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+
+def close_connections():
+    """Close every connection opened by this process.  Threads reopen one on their next call."""
+    global _generation
+    with _connections_lock:
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
+        _generation += 1
+
+
 class Database:
-    def __init__(self):
-        with sqlite3.connect(DB) as conn:
-            cursor = conn.cursor()
-            cursor.execute('CREATE TABLE IF NOT EXISTS accounts (name TEXT PRIMARY KEY, account TEXT)')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS logs (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT,
-                    datetime DATETIME,
-                    type TEXT,
-                    message TEXT
-                )
-            ''')
-            cursor.execute('CREATE TABLE IF NOT EXISTS market (date TEXT PRIMARY KEY, data TEXT)')
-            conn.commit()
+    def __init__(self, path: str = DB):
+        self.path = path
+        conn = connect(path)
+        # WAL is stored in the file: readers (the UI polling logs, the MCP resources) no longer block the writer and
+        # the writer no longer blocks them.  Only writers wait for each other
+        conn.execute('PRAGMA journal_mode=WAL')
+        self._migrate_json_accounts(conn)
+        with conn:
+            conn.execute(CREATE_ACCOUNTS)
+            conn.execute(CREATE_HOLDINGS)
+            conn.execute(CREATE_TRANSACTIONS)
+            conn.execute(CREATE_TRANSACTIONS_NAME_ID_INDEX)
+            conn.execute(CREATE_PORTFOLIO_VALUES)
+            conn.execute(CREATE_PORTFOLIO_VALUES_NAME_ID_INDEX)
+            conn.execute(CREATE_LOGS)
+            conn.execute(CREATE_LOGS_NAME_ID_INDEX)
+            conn.execute(CREATE_LOGS_DATETIME_INDEX)
+            conn.execute(CREATE_LOG_ROLLUPS)
+            conn.execute(CREATE_MARKET)
+
+    def _write(self, sql: str, params: tuple):
+        conn = connect(self.path)
+        # Commits, or rolls back if the statement failed
+        with conn:
+            conn.execute(sql, params)
+
+    def _read_one(self, sql: str, params: tuple):
+        return connect(self.path).execute(sql, params).fetchone()
+
+    def _migrate_json_accounts(self, conn: sqlite3.Connection):
+        """Move the JSON accounts of an older accounts.db into the account tables, once.  The documents are kept in
+        accounts_json."""
+        if 'account' not in {row[0] for row in conn.execute(SELECT_ACCOUNTS_COLUMNS)}:
+            return
+        with conn:
+            # The traders' MCP servers open the database at the same time: the first one migrates, the others wait for
+            # the write lock and then find nothing to do
+            conn.execute('BEGIN IMMEDIATE')
+            if 'account' not in {row[0] for row in conn.execute(SELECT_ACCOUNTS_COLUMNS)}:
+                return
+            conn.execute(RENAME_JSON_ACCOUNTS)
+            conn.execute(CREATE_ACCOUNTS)
+            conn.execute(CREATE_HOLDINGS)
+            conn.execute(CREATE_TRANSACTIONS)
+            conn.execute(CREATE_PORTFOLIO_VALUES)
+            for name, account in conn.execute(SELECT_JSON_ACCOUNTS).fetchall():
+                self._replace_account(conn, name, json.loads(account))
+
+    def _replace_account(self, conn: sqlite3.Connection, name: str, account_dict: dict):
+        conn.execute(UPSERT_ACCOUNT, (name, account_dict["balance"], account_dict["strategy"]))
+        conn.execute(DELETE_HOLDINGS, (name,))
+        conn.execute(DELETE_TRANSACTIONS, (name,))
+        conn.execute(DELETE_PORTFOLIO_VALUES, (name,))
+        conn.executemany(ADD_HOLDING, [(name, symbol, quantity) for symbol, quantity in account_dict["holdings"].items()])
+        conn.executemany(INSERT_TRANSACTION, [(name, t["symbol"], t["quantity"], t["price"], t["timestamp"], t["rationale"])
+                                              for t in account_dict["transactions"]])
+        conn.executemany(INSERT_PORTFOLIO_VALUE, [(name, logged_at, value)
+                                                  for logged_at, value in account_dict["portfolio_value_time_series"]])
 
     def write_account(self, name, account_dict):
-        json_data = json.dumps(account_dict)
-        with sqlite3.connect(DB) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO accounts (name, account)
-                VALUES (?, ?)
-                ON CONFLICT(name) DO UPDATE SET account=excluded.account
-            ''', (name.lower(), json_data))
-            conn.commit()
-
-    def read_account(self, name):
-        with sqlite3.connect(DB) as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT account FROM accounts WHERE name = ?', (name.lower(),))
-            row = cursor.fetchone()
-            return json.loads(row[0]) if row else None
-    
+        """
+        Replace every row of an account: balance, strategy, holdings, transactions and portfolio values.  For a new
+        account or a reset; the trades use write_transaction.
+
+        Args:
+            name (str): The name of the account
+            account_dict (dict): The fields of Account.model_dump()
+        """
+        conn = connect(self.path)
+        with conn:
+            self._replace_account(conn, name.lower(), account_dict)
+
+    def read_account(self, name, history: bool = True) -> dict | None:
+        """
+        Read an account, as of one commit.
+
+        Args:
+            name (str): The name of the account
+            history (bool): Also read the transactions and the portfolio value time series, left empty otherwise
+
+        Returns:
+            dict: The fields of Account, None if there is no such account
+        """
+        name = name.lower()
+        conn = connect(self.path)
+        with conn:
+            # One read transaction, so a trade committed in between never shows half of its rows
+            conn.execute('BEGIN')
+            row = conn.execute(SELECT_ACCOUNT, (name,)).fetchone()
+            if not row:
+                return None
+            return {"name": name, "balance": row[0], "strategy": row[1], "holdings": self.read_holdings(name),
+                    "transactions": self.read_transactions(name) if history else [],
+                    "portfolio_value_time_series": self.read_portfolio_values(name) if history else []}
+
+    def read_balance(self, name: str) -> float | None:
+        row = self._read_one(SELECT_BALANCE, (name.lower(),))
+        return row[0] if row else None
+
+    def read_holdings(self, name: str) -> dict[str, int]:
+        rows = connect(self.path).execute(SELECT_HOLDINGS, (name.lower(),)).fetchall()
+        return dict(rows)
+
+    def read_transactions(self, name: str, last_n: int | None = None) -> list[dict]:
+        """
+        Read the transactions of an account.
+
+        Args:
+            name (str): The name of the account
+            last_n (int): Only the most recent ones, None for all
+
+        Returns:
+            list: Transaction fields, oldest first
+        """
+        conn = connect(self.path)
+        if last_n is None:
+            rows = conn.execute(SELECT_TRANSACTIONS, (name.lower(),)).fetchall()
+        else:
+            rows = conn.execute(SELECT_LAST_TRANSACTIONS, (name.lower(), last_n)).fetchall()[::-1]
+        return [{"symbol": symbol, "quantity": quantity, "price": price, "timestamp": timestamp, "rationale": rationale}
+                for symbol, quantity, price, timestamp, rationale in rows]
+
+    def read_transactions_total(self, name: str) -> float:
+        """Sum of quantity * price over the transactions of an account, without reading them."""
+        return self._read_one(SELECT_TRANSACTIONS_TOTAL, (name.lower(),))[0]
+
+    def read_portfolio_values(self, name: str) -> list[tuple[str, float]]:
+        return connect(self.path).execute(SELECT_PORTFOLIO_VALUES, (name.lower(),)).fetchall()
+
+    def write_transaction(self, name: str, transaction: dict):
+        """
+        Record a trade in one transaction: append it, add its quantity to the holding of its symbol (dropped at 0)
+        and take quantity * price from the balance.  A few rows whatever the length of the history.
+
+        Args:
+            name (str): The name of the account
+            transaction (dict): The fields of Transaction, quantity negative for a sale
+        """
+        name = name.lower()
+        symbol, quantity, price = transaction["symbol"], transaction["quantity"], transaction["price"]
+        conn = connect(self.path)
+        with conn:
+            conn.execute(INSERT_TRANSACTION, (name, symbol, quantity, price, transaction["timestamp"],
+                                              transaction["rationale"]))
+            conn.execute(ADD_HOLDING, (name, symbol, quantity))
+            conn.execute(DELETE_EMPTY_HOLDING, (name, symbol))
+            conn.execute(ADD_BALANCE, (-quantity * price, name))
+
+    def add_to_balance(self, name: str, amount: float):
+        self._write(ADD_BALANCE, (amount, name.lower()))
+
+    def write_strategy(self, name: str, strategy: str):
+        self._write(UPDATE_STRATEGY, (strategy, name.lower()))
+
+    def write_portfolio_value(self, name: str, timestamp: str, value: float):
+        self._write(INSERT_PORTFOLIO_VALUE, (name.lower(), timestamp, value))
+
     def write_log(self, name: str, type: str, message: str):
         """
         Write a log entry to the logs table.
-        
+
         Args:
             name (str): The name associated with the log
             type (str): The type of log entry
             message (str): The log message
         """
-        now = datetime.now().isoformat()
-        
-        with sqlite3.connect(DB) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO logs (name, datetime, type, message)
-                VALUES (?, datetime('now'), ?, ?)
-            ''', (name.lower(), type, message))
-            conn.commit()
+        self._write(INSERT_LOG, (name.lower(), type, message))
+
+    def write_logs(self, entries: list[tuple[str, str, str, str]]):
+        """
+        Write many log entries in one transaction.
+
+        Args:
+            entries (list): (name, datetime, type, message) tuples, datetime as 'YYYY-MM-DD HH:MM:SS' UTC like datetime('now')
+        """
+        conn = connect(self.path)
+        with conn:
+            conn.executemany(INSERT_TIMED_LOG, [(name.lower(), logged_at, type, message)
+                                                for name, logged_at, type, message in entries])
 
     def read_log(self, name: str, last_n=10):
         """
         Read the most recent log entries for a given name.
-        
+
         Args:
             name (str): The name to retrieve logs for
             last_n (int): Number of most recent entries to retrieve
-            
+
         Returns:
             list: A list of tuples containing (datetime, type, message)
         """
-        with sqlite3.connect(DB) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT datetime, type, message FROM logs 
-                WHERE name = ? 
-                ORDER BY datetime DESC
-                LIMIT ?
-            ''', (name.lower(), last_n))
-            
-            return reversed(cursor.fetchall())
+        rows = connect(self.path).execute(SELECT_LAST_LOGS, (name.lower(), last_n)).fetchall()
+        return reversed(rows)
+
+    def read_log_since(self, name: str, after_id: int = 0, last_n=10):
+        """
+        Read the log entries of a given name written after after_id, so a UI only fetches what it does not show yet.
+
+        Args:
+            name (str): The name to retrieve logs for
+            after_id (int): id of the last entry already read, 0 for none
+            last_n (int): Maximum number of entries, the most recent ones are kept
+
+        Returns:
+            list: A list of tuples containing (id, datetime, type, message), oldest first
+        """
+        rows = connect(self.path).execute(SELECT_LOGS_SINCE, (name.lower(), after_id, last_n)).fetchall()
+        return rows[::-1]
+
+    def archive_logs(self, retention_days: float = LOG_RETENTION_DAYS, archive_path: str = LOG_ARCHIVE_DB,
+                     batch_size: int = LOG_ARCHIVE_BATCH_SIZE) -> dict:
+        """
+        Move the log entries older than retention_days to the logs table of archive_path, and add them to the daily
+        counts of log_rollups (name, day, type).  Old rows are read as a range of the logs_datetime index, a page at a
+        time, so the job never scans the recent part of the table.  Rows with a NULL datetime are left alone.
+
+        Returns:
+            dict: number of rows archived, highest id archived and the cutoff datetime
+        """
+        # datetime('now') of write_log is UTC
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+        conn, archive = connect(self.path), connect(archive_path)
+        with archive:
+            archive.execute(CREATE_ARCHIVED_LOGS)
+        archived, last_id = 0, 0
+        while True:
+            # Every page is deleted below, so the next one starts where it ended
+            rows = conn.execute(SELECT_OLD_LOGS, (cutoff, batch_size)).fetchall()
+            if not rows:
+                break
+            # Archive first: with INSERT OR IGNORE, a rerun after a crash between both commits is harmless
+            with archive:
+                archive.executemany(INSERT_ARCHIVED_LOG, rows)
+            counts = {}
+            for _, name, logged_at, type, _ in rows:
+                key = (name, str(logged_at)[:10], type)
+                counts[key] = counts.get(key, 0) + 1
+            # Rollup and deletion in one short transaction: a row is either counted and gone, or neither
+            with conn:
+                conn.executemany(UPSERT_LOG_ROLLUP, [(*key, count) for key, count in counts.items()])
+                conn.executemany(DELETE_LOG, [(row[0],) for row in rows])
+            archived += len(rows)
+            last_id = max(last_id, max(row[0] for row in rows))
+        return {"archived": archived, "last_id": last_id, "cutoff": cutoff}
 
     def write_market(self, date: str, data: dict) -> None:
         data_json = json.dumps(data)
-        with sqlite3.connect(DB) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO market (date, data)
-                VALUES (?, ?)
-                ON CONFLICT(date) DO UPDATE SET data=excluded.data
-            ''', (date, data_json))
-            conn.commit()
+        self._write(UPSERT_MARKET, (date, data_json))
 
     def read_market(self, date: str) -> dict | None:
-        with sqlite3.connect(DB) as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT data FROM market WHERE date = ?', (date,))
-            row = cursor.fetchone()
-            return json.loads(row[0]) if row else None
\ No newline at end of file
+        row = self._read_one(SELECT_MARKET, (date,))
+        return json.loads(row[0]) if row else None
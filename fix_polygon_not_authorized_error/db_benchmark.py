@@ -0,0 +1,379 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from database import Database, close_connections, connect
+from log_sink import LogSink
+
+# Contention on accounts.db: --traders processes, each one a trader with its MCP accounts server and tracer (read the
+# account, write it back after a trade, write the trace and account logs), plus one process for the Gradio UI polling
+# the logs and the account of every trader every --ui-interval seconds.
+# It runs once with the old access pattern (a new sqlite3.connect per call, rollback journal) and once with
+# database.py (one connection per thread, WAL, synchronous=NORMAL, busy_timeout, cached prepared statements), and
+# reports throughput, p50/p95/p99 latency per operation and how many calls failed with 'database is locked'.
+#
+#   python db_benchmark.py --traders 4 --duration 20
+#
+# With --log-rows, it also measures one poll of the UI log panel as the logs table grows: the old query (full scan of
+# the trader's rows sorted by datetime), read_log on the (name, id) index and the read_log_since tail poll.
+#
+#   python db_benchmark.py --modes --log-rows 10000 100000 1000000
+#
+# With --tracer-events, it measures the LogTracer of trading_floor.py: --traders threads of the same process emit trace
+# and span events, written either with one write_log transaction per event or through the batching LogSink.  It reports
+# the time each event costs the agent (span overhead) and the rows written per second until everything is flushed.
+#
+#   python db_benchmark.py --modes --tracer-events 20000
+#
+# With --trade-history, it measures one trade of an account that already has that many transactions and portfolio
+# values: the JSON document rewritten by the former Account.save() versus write_transaction of the account tables.
+#
+#   python db_benchmark.py --modes --trade-history 100 1000 10000
+#
+# With --tool-history, it measures what get_balance, get_holdings and the last transactions cost an MCP tool call as the
+# history grows: the JSON document parsed by the former Account.get, the full read_account, and the projections.  The
+# pydantic validation of Account.get came on top of the JSON parsing.
+#
+#   python db_benchmark.py --modes --tool-history 100 1000 10000
+#
+# The database is a throw-away file in a temporary folder.  accounts.db is not touched.
+
+LOGS_PER_TRADE = 6
+LOG_POLLS = 50
+LOG_LINES = 13
+# read_log as it was: no index to use, so every poll sorts all the rows of the trader
+UNINDEXED_LAST_LOGS = 'SELECT datetime, type, message FROM logs NOT INDEXED WHERE name = ? ORDER BY datetime DESC LIMIT ?'
+TRANSACTIONS_PER_ACCOUNT = 200
+TRADES = 200
+TOOL_CALLS = 200
+LAST_TRANSACTIONS = 10
+# accounts as Account.save() wrote them, one JSON document per trader
+CREATE_JSON_ACCOUNTS = 'CREATE TABLE IF NOT EXISTS accounts_json (name TEXT PRIMARY KEY, account TEXT)'
+SELECT_JSON_ACCOUNT = 'SELECT account FROM accounts_json WHERE name = ?'
+UPSERT_JSON_ACCOUNT = 'INSERT INTO accounts_json (name, account) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET account=excluded.account'
+SYNC_WRITE_LOG = "sync_write_log"
+LOG_SINK = "log_sink"
+CONNECT_PER_CALL = "connect_per_call"
+POOLED_WAL = "pooled_wal"
+
+
+class ConnectPerCallDatabase:
+    """The access pattern database.py used to have: a new connection per call, default journal and timeout."""
+    def __init__(self, path: str):
+        self.path = path
+        with sqlite3.connect(path) as conn:
+            conn.execute('PRAGMA journal_mode=DELETE')
+            conn.execute('CREATE TABLE IF NOT EXISTS accounts (name TEXT PRIMARY KEY, account TEXT)')
+            conn.execute('CREATE TABLE IF NOT EXISTS logs (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, '
+                         'datetime DATETIME, type TEXT, message TEXT)')
+
+    def write_account(self, name, account_dict):
+        with sqlite3.connect(self.path) as conn:
+            conn.execute('INSERT INTO accounts (name, account) VALUES (?, ?) '
+                         'ON CONFLICT(name) DO UPDATE SET account=excluded.account', (name.lower(), json.dumps(account_dict)))
+            conn.commit()
+
+    def read_account(self, name):
+        with sqlite3.connect(self.path) as conn:
+            row = conn.execute('SELECT account FROM accounts WHERE name = ?', (name.lower(),)).fetchone()
+            return json.loads(row[0]) if row else None
+
+    def write_log(self, name: str, type: str, message: str):
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("INSERT INTO logs (name, datetime, type, message) VALUES (?, datetime('now'), ?, ?)",
+                         (name.lower(), type, message))
+            conn.commit()
+
+    def read_log(self, name: str, last_n=10):
+        with sqlite3.connect(self.path) as conn:
+            rows = conn.execute('SELECT datetime, type, message FROM logs WHERE name = ? ORDER BY datetime DESC LIMIT ?',
+                                (name.lower(), last_n)).fetchall()
+            return reversed(rows)
+
+
+def open_database(mode: str, path: str):
+    return ConnectPerCallDatabase(path) if mode == CONNECT_PER_CALL else Database(path)
+
+
+def sample_account(name: str, n_transactions: int) -> dict:
+    """An account the size of one that traded for a while, like Account.model_dump()."""
+    return {"name": name, "balance": 10_000.0, "strategy": "You are a value-oriented investor. " * 10,
+            "holdings": {f"SYM{i}": i for i in range(20)},
+            "transactions": [{"symbol": "AAPL", "quantity": 1, "price": 200.0, "timestamp": "2026-01-02 10:00:00",
+                              "rationale": "Strong cash flows and a wide moat."} for _ in range(n_transactions)],
+            "portfolio_value_time_series": [["2026-01-02 10:00:00", 10_000.0] for _ in range(n_transactions)]}
+
+
+def sample_transaction(rng: random.Random) -> dict:
+    return {"symbol": "AAPL", "quantity": rng.choice([1, -1]), "price": 200.0 + rng.random(),
+            "timestamp": "2026-01-02 10:00:00", "rationale": "Strong cash flows and a wide moat."}
+
+
+def timed_call(latencies: dict, errors: dict, op: str, func, *args):
+    started = time.perf_counter()
+    try:
+        func(*args)
+    except sqlite3.OperationalError as e:
+        errors[str(e)] = errors.get(str(e), 0) + 1
+        return
+    latencies.setdefault(op, []).append(time.perf_counter() - started)
+
+
+def trader_process(mode: str, path: str, name: str, duration: float, n_transactions: int, results):
+    db = open_database(mode, path)
+    account = sample_account(name, n_transactions)
+    latencies, errors = {}, {}
+    rng = random.Random(name)
+    if mode == POOLED_WAL:
+        db.write_account(name, account)
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        # One agent turn: trace and span logs around reading the account, a trade and the account log
+        for i in range(LOGS_PER_TRADE // 2):
+            timed_call(latencies, errors, 'write_log', db.write_log, name, "trace", f"Started span {i}")
+        if mode == POOLED_WAL:
+            # The MCP accounts server: Account.get(name, history=False), then a trade appends its own rows
+            timed_call(latencies, errors, 'read_account', db.read_account, name, False)
+            timed_call(latencies, errors, 'write_account', db.write_transaction, name, sample_transaction(rng))
+        else:
+            timed_call(latencies, errors, 'read_account', db.read_account, name)
+            account["balance"] -= rng.random()
+            account["transactions"].append(sample_transaction(rng))
+            timed_call(latencies, errors, 'write_account', db.write_account, name, account)
+        for i in range(LOGS_PER_TRADE - LOGS_PER_TRADE // 2):
+            timed_call(latencies, errors, 'write_log', db.write_log, name, "account", f"Bought 1 of AAPL ({i})")
+    results.put({"latencies": latencies, "errors": errors})
+    if mode == POOLED_WAL:
+        close_connections()
+
+
+def ui_process(mode: str, path: str, names: list[str], duration: float, interval: float, results):
+    db = open_database(mode, path)
+    latencies, errors = {}, {}
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        for name in names:
+            timed_call(latencies, errors, 'ui_read_log', lambda: list(db.read_log(name, last_n=13)))
+            timed_call(latencies, errors, 'ui_read_account', db.read_account, name)
+        time.sleep(max(0.0, interval - (time.perf_counter() - started)))
+    results.put({"latencies": latencies, "errors": errors})
+    if mode == POOLED_WAL:
+        close_connections()
+
+
+def percentiles_ms(seconds: list[float], scale: float = 1000) -> dict:
+    if not seconds:
+        return {}
+    values = sorted(seconds)
+    pick = lambda q: round(scale * values[min(len(values) - 1, int(q * len(values)))], 2)
+    return {"count": len(values), "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(scale * values[-1], 2)}
+
+
+def run(mode: str, traders: int, duration: float, ui_interval: float, n_transactions: int) -> dict:
+    folder = tempfile.mkdtemp(prefix="db_benchmark_")
+    try:
+        path = os.path.join(folder, "accounts.db")
+        open_database(mode, path)
+        names = [f"trader{i}" for i in range(traders)]
+        # spawn: a fresh interpreter per process, like the MCP servers started by the traders
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        processes = [context.Process(target=trader_process, args=(mode, path, name, duration, n_transactions, results))
+                     for name in names]
+        processes.append(context.Process(target=ui_process, args=(mode, path, names, duration, ui_interval, results)))
+        for process in processes:
+            process.start()
+        outcomes = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+        latencies, errors = {}, {}
+        for outcome in outcomes:
+            for op, values in outcome["latencies"].items():
+                latencies.setdefault(op, []).extend(values)
+            for error, count in outcome["errors"].items():
+                errors[error] = errors.get(error, 0) + count
+        operations = sum(len(values) for values in latencies.values())
+        return {"mode": mode, "traders": traders, "seconds": duration, "operations": operations,
+                "ops_per_second": round(operations / duration, 1), "errors": errors,
+                "latency_ms": {op: percentiles_ms(values) for op, values in sorted(latencies.items())}}
+    finally:
+        if mode == POOLED_WAL:
+            close_connections()
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def benchmark_log_polls(sizes: list[int], traders: int, polls: int = LOG_POLLS) -> list[dict]:
+    folder = tempfile.mkdtemp(prefix="db_benchmark_logs_")
+    try:
+        path = os.path.join(folder, "accounts.db")
+        db = Database(path)
+        conn = connect(path)
+        names = [f"trader{i}" for i in range(traders)]
+        report, rows = [], 0
+        for size in sorted(sizes):
+            with conn:
+                conn.executemany("INSERT INTO logs (name, datetime, type, message) VALUES (?, datetime('now'), ?, ?)",
+                                 ((names[i % traders], "function", f"Ended function lookup_share_price {i}")
+                                  for i in range(rows, size)))
+            rows = size
+            latencies = {}
+            last_id = max(log_id for log_id, *_ in db.read_log_since(names[0], 0, last_n=LOG_LINES))
+            for poll in range(polls):
+                timed_call(latencies, {}, 'unindexed_read_log', lambda: conn.execute(UNINDEXED_LAST_LOGS, (names[0], LOG_LINES)).fetchall())
+                timed_call(latencies, {}, 'read_log', lambda: list(db.read_log(names[0], last_n=LOG_LINES)))
+                # A poll of the UI tail: the trader wrote one new entry since the previous poll
+                db.write_log(names[0], "account", f"Bought 1 of AAPL ({poll})")
+                started = time.perf_counter()
+                new_rows = db.read_log_since(names[0], last_id, last_n=LOG_LINES)
+                latencies.setdefault('read_log_since', []).append(time.perf_counter() - started)
+                last_id = new_rows[-1][0]
+            rows += polls
+            report.append({"log_rows": size, "latency_ms": {op: percentiles_ms(values) for op, values in latencies.items()}})
+        return report
+    finally:
+        close_connections()
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def benchmark_tracer(writer: str, events: int, traders: int) -> dict:
+    folder = tempfile.mkdtemp(prefix="db_benchmark_tracer_")
+    try:
+        db = Database(os.path.join(folder, "accounts.db"))
+        sink = LogSink(db) if writer == LOG_SINK else None
+        write = sink.write if sink else db.write_log
+        names = [f"trader{i}" for i in range(traders)]
+        latencies, errors = {}, {}
+        lock = threading.Lock()
+
+        def emit(name: str):
+            # The events of one agent turn, like LogTracer.on_span_start/on_span_end
+            mine, failed = {}, {}
+            for i in range(events // traders):
+                timed_call(mine, failed, 'span_event', write, name, "function", f"Started function lookup_share_price {i}")
+            with lock:
+                latencies.setdefault('span_event', []).extend(mine.get('span_event', []))
+                for error, count in failed.items():
+                    errors[error] = errors.get(error, 0) + count
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=emit, args=(name,)) for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        emitted = time.perf_counter() - started
+        if sink:
+            # LogTracer.shutdown(): every queued entry is in the database when it returns
+            sink.close()
+        elapsed = time.perf_counter() - started
+        rows = connect(db.path).execute('SELECT COUNT(*) FROM logs').fetchone()[0]
+        result = {"writer": writer, "traders": traders, "events": events, "rows": rows, "errors": errors,
+                  "emit_seconds": round(emitted, 3), "seconds": round(elapsed, 3),
+                  "rows_per_second": round(rows / elapsed, 1),
+                  "span_overhead_us": percentiles_ms(latencies.get('span_event', []), scale=1e6)}
+        if sink:
+            result["sink"] = {key: round(value, 1) for key, value in sink.stats().items()}
+        return result
+    finally:
+        close_connections()
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def benchmark_trades(histories: list[int], trades: int = TRADES) -> list[dict]:
+    folder = tempfile.mkdtemp(prefix="db_benchmark_trades_")
+    try:
+        path = os.path.join(folder, "accounts.db")
+        db = Database(path)
+        conn = connect(path)
+        with conn:
+            conn.execute(CREATE_JSON_ACCOUNTS)
+        rng = random.Random(0)
+        report = []
+        for history in histories:
+            name = f"trader{history}"
+            account = sample_account(name, history)
+            db.write_account(name, account)
+            latencies = {}
+            for _ in range(trades):
+                transaction = sample_transaction(rng)
+                # Account.save() as it was: the whole model dumped and upserted after every trade
+                started = time.perf_counter()
+                account["transactions"].append(transaction)
+                with conn:
+                    conn.execute(UPSERT_JSON_ACCOUNT, (name, json.dumps(account)))
+                latencies.setdefault('json_account', []).append(time.perf_counter() - started)
+                timed_call(latencies, {}, 'write_transaction', db.write_transaction, name, transaction)
+            report.append({"history": history, "json_bytes": len(json.dumps(account)),
+                           "latency_ms": {op: percentiles_ms(values) for op, values in latencies.items()}})
+        return report
+    finally:
+        close_connections()
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def benchmark_tool_calls(histories: list[int], calls: int = TOOL_CALLS) -> list[dict]:
+    folder = tempfile.mkdtemp(prefix="db_benchmark_tools_")
+    try:
+        path = os.path.join(folder, "accounts.db")
+        db = Database(path)
+        conn = connect(path)
+        with conn:
+            conn.execute(CREATE_JSON_ACCOUNTS)
+        report = []
+        for history in histories:
+            name = f"trader{history}"
+            account = sample_account(name, history)
+            db.write_account(name, account)
+            with conn:
+                conn.execute(UPSERT_JSON_ACCOUNT, (name, json.dumps(account)))
+            latencies = {}
+            for _ in range(calls):
+                timed_call(latencies, {}, 'json_account', lambda: json.loads(conn.execute(SELECT_JSON_ACCOUNT, (name,)).fetchone()[0]))
+                timed_call(latencies, {}, 'read_account', db.read_account, name)
+                timed_call(latencies, {}, 'read_account_without_history', db.read_account, name, False)
+                timed_call(latencies, {}, 'read_balance', db.read_balance, name)
+                timed_call(latencies, {}, 'read_holdings', db.read_holdings, name)
+                timed_call(latencies, {}, 'read_last_transactions', db.read_transactions, name, LAST_TRANSACTIONS)
+            report.append({"history": history, "latency_ms": {op: percentiles_ms(values) for op, values in latencies.items()}})
+        return report
+    finally:
+        close_connections()
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="accounts.db contention: N traders plus the UI, old vs pooled WAL access")
+    parser.add_argument("--traders", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds per mode")
+    parser.add_argument("--ui-interval", type=float, default=0.5, help="seconds between two refreshes of the UI")
+    parser.add_argument("--transactions", type=int, default=TRANSACTIONS_PER_ACCOUNT, help="size of each account")
+    parser.add_argument("--modes", nargs="*", choices=[CONNECT_PER_CALL, POOLED_WAL], default=[CONNECT_PER_CALL, POOLED_WAL])
+    parser.add_argument("--log-rows", type=int, nargs="*", default=[], help="sizes of the logs table for the log poll benchmark")
+    parser.add_argument("--trade-history", type=int, nargs="*", default=[], help="transactions per account for the trade benchmark")
+    parser.add_argument("--tool-history", type=int, nargs="*", default=[], help="transactions per account for the tool call benchmark")
+    parser.add_argument("--tracer-events", type=int, default=0, help="events of the tracer benchmark, 0 to skip it")
+    parser.add_argument("--output", help="write the report as JSON")
+    args = parser.parse_args()
+
+    report = [run(mode, args.traders, args.duration, args.ui_interval, args.transactions) for mode in args.modes]
+    if args.log_rows:
+        report += benchmark_log_polls(args.log_rows, args.traders)
+    if args.trade_history:
+        report += benchmark_trades(args.trade_history)
+    if args.tool_history:
+        report += benchmark_tool_calls(args.tool_history)
+    if args.tracer_events:
+        report += [benchmark_tracer(writer, args.tracer_events, args.traders) for writer in (SYNC_WRITE_LOG, LOG_SINK)]
+    for result in report:
+        print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
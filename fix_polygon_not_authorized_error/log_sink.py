@@ -0,0 +1,130 @@
+import atexit
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from database import Database
+
+# Entries written per transaction at most, and the longest an entry waits in the queue before its batch is written
+LOG_BATCH_SIZE = 200
+LOG_FLUSH_INTERVAL_SECONDS = 0.25
+# Beyond that many pending entries, write() waits for the writer to catch up instead of growing memory
+LOG_QUEUE_SIZE = 10_000
+
+_CLOSE = object()
+
+
+class LogSink:
+    """
+    Background writer of the logs table.  write() stamps the entry with the current time and puts it on a queue.
+    A daemon thread takes entries off in batches of up to batch_size, or whatever arrived within flush_interval, and
+    writes each batch with one executemany transaction: one commit per batch instead of one per log entry.
+    flush() returns once everything written before it is in the database.
+    """
+    def __init__(self, db: Database, batch_size: int = LOG_BATCH_SIZE,
+                 flush_interval: float = LOG_FLUSH_INTERVAL_SECONDS, queue_size: int = LOG_QUEUE_SIZE):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        # Held while putting on the queue, so nothing lands behind the close marker.  The writer never takes it: a put
+        # waiting on a full queue still gets drained
+        self._closed_lock = threading.Lock()
+        self._closed = False
+        self._metrics_lock = threading.Lock()
+        self._metrics = {"enqueued": 0, "written": 0, "dropped": 0, "batches": 0, "enqueue_seconds": 0.0,
+                         "write_seconds": 0.0}
+        self._thread = threading.Thread(target=self._run, name="log-sink", daemon=True)
+        self._thread.start()
+        # Entries still queued when the process exits are written (the agents SDK also calls shutdown() of tracers)
+        atexit.register(self.close)
+
+    def write(self, name: str, type: str, message: str):
+        started = time.perf_counter()
+        # Same format as datetime('now') of Database.write_log
+        logged_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        with self._closed_lock:
+            if self._closed or not self._thread.is_alive():
+                # Nobody drains the queue anymore, write it right away
+                self.db.write_log(name, type, message)
+                return
+            self._queue.put((name, logged_at, type, message))
+        with self._metrics_lock:
+            self._metrics["enqueued"] += 1
+            self._metrics["enqueue_seconds"] += time.perf_counter() - started
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Wait until the entries written so far are in the database.  False if timeout expired first."""
+        done = threading.Event()
+        with self._closed_lock:
+            if self._closed or not self._thread.is_alive():
+                return True
+            self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout: float | None = None):
+        """Write the pending entries and stop the writer thread.  Later entries are written synchronously."""
+        with self._closed_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(_CLOSE)
+        self._thread.join(timeout)
+
+    def _run(self):
+        closing = False
+        while not closing:
+            batch, flushes = [], []
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is _CLOSE:
+                    closing = True
+                    break
+                if isinstance(item, threading.Event):
+                    # flush(): write what we have now instead of waiting for the end of the window
+                    flushes.append(item)
+                    break
+                batch.append(item)
+                timeout = deadline - time.monotonic()
+                if len(batch) >= self.batch_size or timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+            for done in flushes:
+                done.set()
+
+    def _write(self, batch: list[tuple]):
+        started = time.perf_counter()
+        try:
+            self.db.write_logs(batch)
+        except Exception as e:
+            # Losing trace lines must not stop the writer, nor the traders: a dead writer would leave write() blocked
+            # on a full queue and flush() waiting forever
+            print(f"Log sink dropped {len(batch)} entries: {e!r}")
+            with self._metrics_lock:
+                self._metrics["dropped"] += len(batch)
+            return
+        with self._metrics_lock:
+            self._metrics["written"] += len(batch)
+            self._metrics["batches"] += 1
+            self._metrics["write_seconds"] += time.perf_counter() - started
+
+    def stats(self) -> dict:
+        """Queue depth, rows written, batching and the time write() costs the caller (the span overhead)."""
+        with self._metrics_lock:
+            metrics = dict(self._metrics)
+        return {
+            "queued": self._queue.qsize(),
+            "enqueued": metrics["enqueued"],
+            "written": metrics["written"],
+            "dropped": metrics["dropped"],
+            "batches": metrics["batches"],
+            "mean_batch_size": metrics["written"] / metrics["batches"] if metrics["batches"] else 0.0,
+            "rows_per_second": metrics["written"] / metrics["write_seconds"] if metrics["write_seconds"] else 0.0,
+            "mean_enqueue_us": 1e6 * metrics["enqueue_seconds"] / metrics["enqueued"] if metrics["enqueued"] else 0.0,
+        }
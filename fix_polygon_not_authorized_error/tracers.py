@@ -1,5 +1,6 @@
 from agents import TracingProcessor, Trace, Span
 from database import Database
+from log_sink import LogSink
 import secrets
 import string
 
@@ -19,6 +20,10 @@ def make_trace_id(tag: str) -> str:
 
 class LogTracer(TracingProcessor):
 
+    def __init__(self, sink: LogSink | None = None):
+        # Spans only queue their log lines; the sink writes them in batches from its own thread
+        self.sink = sink or LogSink(db)
+
     def get_name(self, trace_or_span: Trace | Span) -> str | None:
         trace_id = trace_or_span.trace_id
         name = trace_id.split("_")[1]
@@ -30,12 +35,12 @@ class LogTracer(TracingProcessor):
     def on_trace_start(self, trace) -> None:
         name = self.get_name(trace)
         if name:
-            db.write_log(name, "trace", f"Started: {trace.name}")
+            self.sink.write(name, "trace", f"Started: {trace.name}")
 
     def on_trace_end(self, trace) -> None:
         name = self.get_name(trace)
         if name:
-            db.write_log(name, "trace", f"Ended: {trace.name}")
+            self.sink.write(name, "trace", f"Ended: {trace.name}")
 
     def on_span_start(self, span) -> None:
         name = self.get_name(span)
@@ -51,7 +56,7 @@ class LogTracer(TracingProcessor):
                     message += f" {span.span_data.server}"
             if span.error:
                 message += f" {span.error}"
-            db.write_log(name, type, message)
+            self.sink.write(name, type, message)
 
     def on_span_end(self, span) -> None:
         name = self.get_name(span)
@@ -68,10 +73,10 @@ class LogTracer(TracingProcessor):
                     message += f" {span.span_data.server}"
             if span.error:
                 message += f" {span.error}"
-            db.write_log(name, type, message)
+            self.sink.write(name, type, message)
 
     def force_flush(self) -> None:
-        pass
+        self.sink.flush()
 
     def shutdown(self) -> None:
-        pass
\ No newline at end of file
+        self.sink.close()
\ No newline at end of file
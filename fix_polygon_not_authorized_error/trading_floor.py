@@ -4,6 +4,7 @@ import asyncio
 from tracers import LogTracer
 from agents import add_trace_processor
 from market import is_market_open
+from database import Database
 from dotenv import load_dotenv
 import os
 
@@ -14,6 +15,10 @@ RUN_EVEN_WHEN_MARKET_IS_CLOSED = (
     os.getenv("RUN_EVEN_WHEN_MARKET_IS_CLOSED", "false").strip().lower() == "true"
 )
 USE_MANY_MODELS = os.getenv("USE_MANY_MODELS", "false").strip().lower() == "true"
+# Logs older than that are archived to logs_archive.db after each run, so the logs table stops growing
+LOG_RETENTION_DAYS = float(os.getenv("LOG_RETENTION_DAYS", "7"))
+
+db = Database()
 
 names = ["Warren", "George", "Ray", "Cathie"]
 lastnames = ["Patience", "Bold", "Systematic", "Crypto"]
@@ -46,6 +51,9 @@ async def run_every_n_minutes():
             await asyncio.gather(*[trader.run() for trader in traders])
         else:
             print("Market is closed, skipping run")
+        archived = await asyncio.to_thread(db.archive_logs, LOG_RETENTION_DAYS)
+        if archived["archived"]:
+            print(f"Archived {archived['archived']} log entries older than {archived['cutoff']}")
         await asyncio.sleep(RUN_EVERY_N_MINUTES * 60)
 
 
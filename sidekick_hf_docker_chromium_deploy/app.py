@@ -1,5 +1,6 @@
 import gradio as gr
 from sidekick import Sidekick
+from checkpointer import close_checkpointers
 
 
 async def setup():
@@ -60,3 +61,5 @@ with gr.Blocks(title="Sidekick", theme=gr.themes.Default(primary_hue="emerald"))
     ui.queue(default_concurrency_limit=1)
 
 ui.launch(inbrowser=True)
+# The SQLite thread of the checkpointer would keep the process alive after Gradio stops
+close_checkpointers()
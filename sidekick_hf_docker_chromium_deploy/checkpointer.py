@@ -0,0 +1,147 @@
+# Same file as sonya_agentic_rag_v2/checkpointer.py: each project of this repo is deployed on its own (this one as a
+# Docker Space built from this folder only), so it cannot import from a sibling folder.  Change both copies together.
+import asyncio
+import os
+import time
+import aiosqlite
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+checkpoint_db_path = "./checkpoints/checkpoints.sqlite"
+
+# Checkpoints kept per thread.  A run of the graph writes one per step, so the last steps can still be replayed from
+# their checkpoint_id (get_state_history) while older ones are pruned
+CHECKPOINTS_PER_THREAD = 20
+# Threads (sessions) without a new checkpoint for that long are deleted
+CHECKPOINT_THREAD_TTL_SECONDS = 24 * 3600
+# Bytes used by the database.  Beyond it, the least recently active threads are deleted until it fits
+CHECKPOINT_DB_MAX_BYTES = 256 * 2**20
+# The TTL and size sweep scans every thread, so it runs once every that many checkpoints instead of every time
+CHECKPOINT_SWEEP_EVERY = 100
+
+
+class RetentionSqliteSaver(AsyncSqliteSaver):
+    """
+    Durable LangGraph checkpointer (SQLite through aiosqlite) whose size stays bounded:
+      - after each checkpoint, only the last keep_last checkpoints of its thread (and their pending writes) are kept
+      - every sweep_every checkpoints, threads idle for more than ttl_seconds are deleted, then the least recently
+        active threads until the database uses at most max_bytes.  The thread being written is never evicted.
+    Deleted pages are reused by SQLite, so the file stops growing instead of shrinking.
+    """
+    def __init__(self, conn: aiosqlite.Connection, *, keep_last: int = CHECKPOINTS_PER_THREAD,
+                 ttl_seconds: float = CHECKPOINT_THREAD_TTL_SECONDS, max_bytes: int = CHECKPOINT_DB_MAX_BYTES,
+                 sweep_every: int = CHECKPOINT_SWEEP_EVERY, serde=None):
+        super().__init__(conn, serde=serde)
+        self.keep_last = keep_last
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.sweep_every = sweep_every
+        self._retention_ready = False
+        self.stats = {'checkpoints': 0, 'pruned_checkpoints': 0, 'expired_threads': 0, 'evicted_threads': 0, 'sweeps': 0}
+
+    async def setup(self) -> None:
+        await super().setup()
+        if self._retention_ready:
+            return
+        async with self.lock:
+            # Last activity per thread, so TTL and size eviction do not have to decode checkpoints
+            await self.conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS thread_activity (
+                    thread_id TEXT PRIMARY KEY,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS thread_activity_updated_at ON thread_activity (updated_at);
+                """)
+            # Threads checkpointed before retention existed start their TTL now
+            await self.conn.execute(
+                "INSERT OR IGNORE INTO thread_activity (thread_id, updated_at) SELECT DISTINCT thread_id, ? FROM checkpoints",
+                (time.time(),))
+            await self.conn.commit()
+            self._retention_ready = True
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        next_config = await super().aput(config, checkpoint, metadata, new_versions)
+        thread_id = str(next_config["configurable"]["thread_id"])
+        await self._prune_thread(thread_id, next_config["configurable"]["checkpoint_ns"])
+        self.stats['checkpoints'] += 1
+        if self.stats['checkpoints'] % self.sweep_every == 0:
+            await self.sweep(keep_thread_id=thread_id)
+        return next_config
+
+    async def _prune_thread(self, thread_id: str, checkpoint_ns: str):
+        # checkpoint ids are time-ordered (uuid6), the same order AsyncSqliteSaver lists them in
+        kept = ("SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? "
+                "ORDER BY checkpoint_id DESC LIMIT ?")
+        params = (thread_id, checkpoint_ns, thread_id, checkpoint_ns, self.keep_last)
+        async with self.lock:
+            cursor = await self.conn.execute(
+                f"DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id NOT IN ({kept})", params)
+            self.stats['pruned_checkpoints'] += max(cursor.rowcount, 0)
+            await self.conn.execute(
+                f"DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id NOT IN ({kept})", params)
+            await self.conn.execute(
+                "INSERT OR REPLACE INTO thread_activity (thread_id, updated_at) VALUES (?, ?)", (thread_id, time.time()))
+            await self.conn.commit()
+
+    async def _delete_threads(self, thread_ids: list[str]):
+        for thread_id in thread_ids:
+            for table in ['checkpoints', 'writes', 'thread_activity']:
+                await self.conn.execute(f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,))
+
+    async def used_bytes(self) -> int:
+        """Bytes of the database in use, free pages left by deletions excluded."""
+        values = []
+        for pragma in ['page_count', 'freelist_count', 'page_size']:
+            async with self.conn.execute(f"PRAGMA {pragma}") as cursor:
+                values.append((await cursor.fetchone())[0])
+        page_count, freelist_count, page_size = values
+        return (page_count - freelist_count) * page_size
+
+    async def sweep(self, keep_thread_id: str | None = None) -> dict:
+        """Apply the TTL and size cap now.  Also called every sweep_every checkpoints."""
+        await self.setup()
+        async with self.lock:
+            async with self.conn.execute(
+                    "SELECT thread_id FROM thread_activity WHERE updated_at < ? AND thread_id IS NOT ?",
+                    (time.time() - self.ttl_seconds, keep_thread_id)) as cursor:
+                expired = [row[0] for row in await cursor.fetchall()]
+            await self._delete_threads(expired)
+            await self.conn.commit()
+            self.stats['expired_threads'] += len(expired)
+
+            while await self.used_bytes() > self.max_bytes:
+                async with self.conn.execute(
+                        "SELECT thread_id FROM thread_activity WHERE thread_id IS NOT ? ORDER BY updated_at LIMIT 1",
+                        (keep_thread_id,)) as cursor:
+                    oldest = await cursor.fetchone()
+                if oldest is None:
+                    break
+                await self._delete_threads([oldest[0]])
+                await self.conn.commit()
+                self.stats['evicted_threads'] += 1
+            self.stats['sweeps'] += 1
+            return dict(self.stats)
+
+
+_checkpointers: dict[str, RetentionSqliteSaver] = {}
+_checkpointers_lock = asyncio.Lock()
+
+
+async def shared_checkpointer(path: str = checkpoint_db_path, **retention) -> RetentionSqliteSaver:
+    """One checkpointer (and SQLite connection) per database file, shared by every session of the process."""
+    async with _checkpointers_lock:
+        if path not in _checkpointers:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            checkpointer = RetentionSqliteSaver(await aiosqlite.connect(path), **retention)
+            await checkpointer.setup()
+            print(f"---Checkpoints in {path}: last {checkpointer.keep_last} per thread, "
+                  f"threads idle > {checkpointer.ttl_seconds / 3600:.0f} h deleted, at most {checkpointer.max_bytes // 2**20} MB---")
+            _checkpointers[path] = checkpointer
+        return _checkpointers[path]
+
+
+def close_checkpointers():
+    """Stop the SQLite threads of the shared checkpointers.  They are not daemon threads: the process would wait for them on exit."""
+    for checkpointer in _checkpointers.values():
+        checkpointer.conn.stop()
+    _checkpointers.clear()
@@ -5,11 +5,11 @@ from langgraph.graph.message import add_messages
 from dotenv import load_dotenv
 from langgraph.prebuilt import ToolNode
 from langchain_openai import ChatOpenAI
-from langgraph.checkpoint.memory import MemorySaver
 from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 from typing import List, Any, Optional, Dict
 from pydantic import BaseModel, Field
 from sidekick_tools import playwright_tools, other_tools
+from checkpointer import shared_checkpointer
 import uuid
 import asyncio
 from datetime import datetime
@@ -34,18 +34,22 @@ class EvaluatorOutput(BaseModel):
 
 
 class Sidekick:
-    def __init__(self):
+    def __init__(self, sidekick_id: Optional[str] = None):
         self.worker_llm_with_tools = None
         self.evaluator_llm_with_output = None
         self.tools = None
         self.llm_with_tools = None
         self.graph = None
-        self.sidekick_id = str(uuid.uuid4())
-        self.memory = MemorySaver()
+        # Pass the id of a previous Sidekick to resume its conversation from the checkpoints
+        self.sidekick_id = sidekick_id or str(uuid.uuid4())
+        # Set by setup()
+        self.memory = None
         self.browser = None
         self.playwright = None
 
-    async def setup(self):
+    async def setup(self, checkpointer=None):
+        # SQLite with bounded retention (see checkpointer.py) instead of an in-process MemorySaver growing forever
+        self.memory = checkpointer if checkpointer is not None else await shared_checkpointer()
         self.tools, self.browser, self.playwright = await playwright_tools()
         self.tools += await other_tools()
         worker_llm = ChatOpenAI(model="gpt-4.1-mini")
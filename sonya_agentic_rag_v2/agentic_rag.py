@@ -2,17 +2,26 @@
 from langchain_openai import ChatOpenAI
 from langgraph.graph import StateGraph, START, END
 from dotenv import load_dotenv
-from langchain_community.utilities import GoogleSerperAPIWrapper
 from langchain_core.tools import Tool
-from openai import OpenAI
+from openai import AsyncOpenAI
 from langgraph.checkpoint.memory import MemorySaver
+from langgraph.config import get_stream_writer
 from langchain_core.messages import HumanMessage, SystemMessage
 from typing import Any, Literal
 from typing_extensions import TypedDict
 from pydantic import BaseModel, Field
 import uuid
+import time
+from functools import partial
 from pprint import pprint
 from documents_retrievers import MedicalDiseaseQAndARetriever, MedicalDeviceManualsRetriever, SEMANTIC_RETRIEVAL, HYBRID_RETRIEVAL_RERANK
+from ingestion import ENCODE_BATCH_SIZE
+from resource_registry import shared_registry
+from embedding_router import LLM_ROUTING, EMBEDDING_ROUTING, FANOUT_ROUTING
+from reranker import CrossEncoderReranker
+from relevance_gate import LLM_RELEVANCE, CROSS_ENCODER_RELEVANCE
+from web_search import WebSearcher, SerperBackend
+from checkpointer import shared_checkpointer, close_checkpointers
 import asyncio
 import nest_asyncio
 
@@ -24,16 +33,33 @@ source_web_search_disp = 'Web Search'
 source_disease_qna = "medical_disease_qna"
 source_device_manuals = "medical_device_manuals"
 source_web_search = 'web_search'
+# Fan-out: both collections retrieved concurrently and merged by the cross-encoder
+source_both_collections = "medical_disease_qna_and_device_manuals"
 source_disp_dict = {
             source_disease_qna: source_disease_qna_disp, 
             source_device_manuals: source_device_manuals_disp, 
-            source_web_search: source_web_search_disp
+            source_web_search: source_web_search_disp,
+            source_both_collections: f"{source_disease_qna_disp} and {source_device_manuals_disp}"
             }
+vectordb_sources = [source_disease_qna, source_device_manuals, source_both_collections]
 
 YES = 'yes'
 NO = 'no'
 MAX_ITERATION = 3
 N_RESULTS = 3 
+# Markdown the streamed generation tokens are appended to
+GENERATION_HEADER = "##### "
+# run_batch: questions encoded, routed and retrieved together, and questions in the LLM stages at the same time
+BATCH_SIZE = 256
+BATCH_CONCURRENCY = 8
+
+class GenerationToken(str):
+    """A piece of the generation streamed by augment_generate.  The UI appends it to the answer without a newline."""
+
+
+class TimingMessage(str):
+    """Time-to-first-token and per-node timing messages of run.  Not replayed from the semantic cache."""
+
 
 class GraphState(TypedDict):
     query: str
@@ -45,6 +71,12 @@ class GraphState(TypedDict):
     iteration_count: int
     generation: str
     strategy: str
+    # Cross-encoder scores of raw_results (None when not scored yet), used by the relevance gate
+    relevance_scores: list
+    # Which of the cross-encoder gate or the LLM grader took the relevance decision
+    relevance_grader: str
+    # MAX_ITERATION turned a 'no' into 'yes': the answer is generated from a context nobody found relevant
+    forced_relevance: bool
 
 class RouteOutput(BaseModel):
     """Route a user query to the most relevant datasource."""
@@ -61,7 +93,7 @@ class RelevanceOutput(BaseModel):
     ) 
 
 class AgenticRAG:
-    def __init__(self):
+    def __init__(self, thread_id: str | None = None):
         self.medical_disease_qna_retriever = None
         self.medical_device_manuals_retriever = None
         self.ollama_via_openai = None
@@ -69,40 +101,117 @@ class AgenticRAG:
         self.checker_llm_with_output = None
         self.embedding_model = None
         self.agentic_rag = None
-        self.config = config = {"configurable": {"thread_id": str(uuid.uuid4()), "recursion_limit": 50}}
+        # Relevance check, web search and generation only.  run_batch enters it with the documents already retrieved
+        self.answer_graph = None
+        # Pass the thread_id of a previous session to resume from its checkpoints
+        self.config = config = {"configurable": {"thread_id": thread_id or str(uuid.uuid4()), "recursion_limit": 50}}
+        # In-process until setup() swaps in the durable checkpointer.  evaluation.py keeps this one
         self.memory = MemorySaver()
         self.search_tool = None
+        self.semantic_cache = None
+        self.corpus = None
+        self.embedding_router = None
+        self.fanout_reranker = None
+        self.relevance_gate = None
+        self.relevance_reranker = None
+
+    async def setup(self, strategy = HYBRID_RETRIEVAL_RERANK, routing = LLM_ROUTING, relevance = LLM_RELEVANCE,
+                    checkpointer = None):
+        await self.setup_retrievers(strategy, routing, relevance)
+        self.setup_llms()
+        # Checkpoints go to SQLite with bounded retention (see checkpointer.py) instead of piling up in RAM forever.
+        # All sessions share one connection; each one is a thread_id
+        self.memory = checkpointer if checkpointer is not None else await shared_checkpointer()
+        await self.build_graph()
 
-    async def setup(self, strategy = HYBRID_RETRIEVAL_RERANK):
+    async def setup_retrievers(self, strategy = HYBRID_RETRIEVAL_RERANK, routing = LLM_ROUTING, relevance = LLM_RELEVANCE):
+        """Everything local: retrievers, models, caches, routers and relevance gate.  evaluation.py pairs it with fake LLMs."""
         self.strategy = strategy
-        self.medical_disease_qna_retriever = MedicalDiseaseQAndARetriever()
-        await self.medical_disease_qna_retriever.setup_hybrid_retriever()
-        self.medical_device_manuals_retriever = MedicalDeviceManualsRetriever()
-        await self.medical_device_manuals_retriever.setup_hybrid_retriever()
-
-        self.ollama_via_openai = OpenAI(base_url='http://localhost:11434/v1', api_key='ollama')
+        self.routing = routing
+        self.relevance = relevance
+        # Retrievers (with their models, Chroma client and hybrid index) are shared read-only by all sessions.
+        # Only the first session pays for loading them.  Do it off the event loop so other sessions keep running.
+        self.medical_disease_qna_retriever = await asyncio.to_thread(shared_registry.retriever, MedicalDiseaseQAndARetriever)
+        self.medical_device_manuals_retriever = await asyncio.to_thread(shared_registry.retriever, MedicalDeviceManualsRetriever)
+        self.embedding_model = shared_registry.embedding_model()
+        self.semantic_cache = shared_registry.semantic_cache()
+        if routing in [EMBEDDING_ROUTING, FANOUT_ROUTING]:
+            # Centroids of both collections are computed once per process from the memory-mapped embeddings
+            self.embedding_router = await asyncio.to_thread(shared_registry.embedding_router, {
+                source_disease_qna: self.medical_disease_qna_retriever.hybrid_retriever.index,
+                source_device_manuals: self.medical_device_manuals_retriever.hybrid_retriever.index,
+            })
+        if routing == FANOUT_ROUTING:
+            self.fanout_reranker = CrossEncoderReranker(shared_registry.cross_encoder())
+        if relevance == CROSS_ENCODER_RELEVANCE:
+            self.relevance_gate = shared_registry.relevance_gate()
+            # Scores documents the retriever did not score: semantic retrieval and hybrid results too few to re-rank
+            self.relevance_reranker = CrossEncoderReranker(shared_registry.cross_encoder())
+        # Content of both collections as this session sees it.  Part of the semantic cache key: answers cached before a
+        # re-ingestion are not served from the new content
+        self.corpus = ':'.join(retriever.hybrid_retriever.index.fingerprint[:16] for retriever in
+                               [self.medical_disease_qna_retriever, self.medical_device_manuals_retriever])
+
+    def setup_llms(self):
+        """Remote dependencies: OpenAI router and grader, Ollama generator and Serper web search."""
+        self.ollama_via_openai = AsyncOpenAI(base_url='http://localhost:11434/v1', api_key='ollama')
         router_llm = ChatOpenAI(model="gpt-5-nano")
         self.router_llm_with_output = router_llm.with_structured_output(RouteOutput)
         checker_llm = ChatOpenAI(model="gpt-5-nano", reasoning_effort="low")
         self.checker_llm_with_output = checker_llm.with_structured_output(RelevanceOutput)
 
-        serper = GoogleSerperAPIWrapper(k= N_RESULTS)
-        self.search_tool =Tool(
+        self.search_tool = self.build_search_tool(SerperBackend())
+
+    def build_search_tool(self, backend, cache = None) -> Tool:
+        """Web search through backend (Serper, or StubSearchBackend offline).  Snippets are cached per normalized question
+        and compacted by the cross-encoder before they reach the relevance checker and the prompt."""
+        web_searcher = WebSearcher(backend, cache if cache is not None else shared_registry.web_search_cache(),
+                                   CrossEncoderReranker(shared_registry.cross_encoder()), shared_registry.cpu_executor())
+        return Tool(
             name="search",
-            func=serper.run,
+            func=None,
+            # Used by ainvoke
+            coroutine=web_searcher.search,
             description="Use this tool when you want to get the results of an online web search"
         )
-        await self.build_graph()
 
 
     ###########################################################
     #####  Route to an appropriate Retriever to retrieve documents
     ########################################################### 
     # All node should return a GraphState.  That's how LangGraph become stateful  
-    def route(self, state: GraphState) -> GraphState:
+    # Nodes are async: LLM and HTTP calls are awaited, encoders and rerankers run on the bounded CPU pool of the registry.
+    # Then a single event loop serves many sessions without one of them blocking the others.
+    async def route(self, state: GraphState) -> GraphState:
         """Agentic router: decides which retriever to use."""
         print("---ROUTER to VECTORDB RETRIEVER---")
         query = state["query"]
+        if self.embedding_router is not None:
+            # Fast path: no LLM round-trip when the question is clearly closer to one collection
+            q_emb = await shared_registry.run_cpu_bound(self.embedding_model.encode, query)
+            source = self.route_by_embedding(q_emb)
+            if source is not None:
+                state["source"] = source
+                return state
+        state["source"] = await self.route_with_llm(query)
+        return state
+
+    def route_by_embedding(self, q_emb) -> str | None:
+        """One collection, both of them with fan-out routing, or None when the LLM router has to decide."""
+        source, margin = self.embedding_router.route(q_emb)
+        if source is not None:
+            counts = self.embedding_router.record(EMBEDDING_ROUTING)
+            print(f"---EMBEDDING ROUTER DECISION: {source} (margin {margin:.3f}), routing counts: {counts}---")
+            return source
+        if self.routing == FANOUT_ROUTING:
+            counts = self.embedding_router.record(FANOUT_ROUTING)
+            print(f"---EMBEDDING ROUTER UNSURE (margin {margin:.3f}), FAN OUT TO BOTH COLLECTIONS, routing counts: {counts}---")
+            return source_both_collections
+        counts = self.embedding_router.record(LLM_ROUTING)
+        print(f"---EMBEDDING ROUTER UNSURE (margin {margin:.3f}), FALLBACK TO LLM ROUTER, routing counts: {counts}---")
+        return None
+
+    async def route_with_llm(self, query: str) -> str:
         system_message = f"You are a routing agent. Based on the user query, decide where to look for information."
         user_message = f"""
         You are routing an user query, respond ONLY with one of options:
@@ -114,10 +223,9 @@ class AgenticRAG:
             SystemMessage(content=system_message),
             HumanMessage(content=user_message),
         ]
-        result = self.router_llm_with_output.invoke(messages)
+        result = await self.router_llm_with_output.ainvoke(messages)
         print(f"---ROUTER DECISION: {result.datasource}---")
-        state["source"] = result.datasource
-        return state
+        return result.datasource
 
     def route_decision(self, state: GraphState) -> str:
         return state["source"]    
@@ -125,38 +233,72 @@ class AgenticRAG:
     ##############################################
     #####  Retrieval
     ##############################################
-    def retrieve_from_disease_qna(self, state: GraphState) -> GraphState:
+    async def retrieve_scored(self, retriever, query: str) -> tuple[list[str] | None, list[float | None] | None]:
+        """Documents and their cross-encoder scores.  The hybrid strategies already computed the scores when re-ranking."""
+        results = await shared_registry.run_cpu_bound(retriever.retrieve_scored, query, N_RESULTS, self.strategy)
+        if results is None:
+            return None, None
+        return [doc for doc, _ in results], [score for _, score in results]
+
+    async def retrieve_from_disease_qna(self, state: GraphState) -> GraphState:
         """Retrieve top documents from ChromaDB Collection 1 (Medical Q&A Data) based on query."""
         print("---Retrieving from Medical Disease Q&A Collection---")
         # Retrieve based upon initialized strategy: semantic or hybrid
         state["strategy"] = self.strategy
         print(f"---strategy= {state["strategy"]}---")
-        results = self.medical_disease_qna_retriever.retrieve(state["query"], k = N_RESULTS, strategy = self.strategy)
-        state["raw_results"] = results
+        state["raw_results"], state["relevance_scores"] = await self.retrieve_scored(self.medical_disease_qna_retriever, state["query"])
         state["source"] = source_disease_qna
         return state
 
-    def retrieve_from_device_manual(self, state: GraphState) -> GraphState:
+    async def retrieve_from_device_manual(self, state: GraphState) -> GraphState:
         """Retrieve top documents from ChromaDB Collection 2 ((Medical Device Manuals Data)) based on query."""
         print("---Retrieving from Medical Device Manual Collection---")
         # Retrieve based upon initialized strategy: semantic or hybrid
         state["strategy"] = self.strategy
         print(f"---strategy= {state["strategy"]}---")
-        results = self.medical_device_manuals_retriever.retrieve(state["query"], k = N_RESULTS, strategy = self.strategy)
-        state["raw_results"] = results
+        state["raw_results"], state["relevance_scores"] = await self.retrieve_scored(self.medical_device_manuals_retriever, state["query"])
         state["source"] = source_device_manuals
         return state
 
 
+    async def retrieve_from_both_collections(self, state: GraphState) -> GraphState:
+        """Retrieve from both collections concurrently, then keep the N_RESULTS best of both by cross-encoder score."""
+        print("---Retrieving from Medical Disease Q&A and Medical Device Manual Collections---")
+        state["strategy"] = self.strategy
+        print(f"---strategy= {state["strategy"]}---")
+        query = state["query"]
+        # Encoders, BM25 and cross-encoder are CPU-bound.  Run both retrievers on the pool instead of one after the other
+        all_results = await asyncio.gather(*[
+            shared_registry.run_cpu_bound(retriever.retrieve_scored, query, N_RESULTS, self.strategy)
+            for retriever in [self.medical_disease_qna_retriever, self.medical_device_manuals_retriever]])
+        merged = await shared_registry.run_cpu_bound(self.merge_collections, [query], [all_results])
+        state["raw_results"], state["relevance_scores"] = merged[0]
+        state["source"] = source_both_collections
+        return state
+
+    def merge_collections(self, queries: list[str], all_results: list[list]) -> list[tuple[list[str], list[float | None]]]:
+        """N_RESULTS best (documents, scores) of both collections per query.  All queries share one cross-encoder pass."""
+        all_candidates = [[result for results in query_results if results for result in results] for query_results in all_results]
+        to_rerank = [i for i, candidates in enumerate(all_candidates) if len(candidates) > N_RESULTS]
+        if to_rerank:
+            # Cross-collection rerank.  Each retriever already applied its own quality filter, so just order by score
+            all_scores = self.fanout_reranker.score_batch(
+                [(queries[i], [(doc, doc) for doc, _ in all_candidates[i]]) for i in to_rerank])
+            for i, scores in zip(to_rerank, all_scores):
+                all_candidates[i] = sorted(zip([doc for doc, _ in all_candidates[i]], scores),
+                                           key=lambda x: x[1], reverse=True)[:N_RESULTS]
+        return [([doc for doc, _ in candidates], [score for _, score in candidates]) for candidates in all_candidates]
+
+
     ###########################################################
     #####  Check if the retrieved documents are relevant
     ########################################################### 
-    def check_relevance(self, state: GraphState) -> GraphState:
+    async def check_relevance(self, state: GraphState) -> GraphState:
         """Determine whether the retrieved documents are relevant or not."""
         print("---CONTEXT RELEVANCE CHECKER---")
         query = state['query']
         documents, context = state["raw_results"], state["raw_results"]
-        if state['source'] in [source_disease_qna, source_device_manuals]:
+        if state['source'] in vectordb_sources:
             if not documents:
                 print("---FILTER OUT ALL RETRIEVED DOCUMENTS, RELEVANCE RESULT: no---")
                 state['filter_out_all_retrieved_documents'] = True
@@ -165,7 +307,46 @@ class AgenticRAG:
             context = '\n'.join(documents)  # Override in the case of VectorDB
 
         state['context'] = context
-        
+        decision = None
+        if state['source'] in vectordb_sources and self.relevance_gate is not None:
+            decision = await self.gate_relevance(query, documents, state.get('relevance_scores'))
+        if decision is None:
+            state['pass_relevance_test'] = await self.grade_relevance(query, context)
+            state['relevance_grader'] = LLM_RELEVANCE
+        else:
+            state['pass_relevance_test'] = YES if decision else NO
+            state['relevance_grader'] = CROSS_ENCODER_RELEVANCE
+
+        iteration_count = state.get("iteration_count", 0)
+        state["iteration_count"] = iteration_count + 1
+        ## Limiting to MAX_ITERATION
+        state['forced_relevance'] = False
+        if state["iteration_count"] >= MAX_ITERATION:
+            print("---MAX ITERATIONS REACHED, FORCING 'Yes'---")
+            state['forced_relevance'] = state["pass_relevance_test"] != YES
+            state["pass_relevance_test"] = YES
+
+        return state
+
+    async def gate_relevance(self, query: str, documents: list[str], scores: list[float | None] | None) -> bool | None:
+        """Local decision from the best cross-encoder score of the documents.  None when the LLM grader has to decide."""
+        scores = list(scores or [None] * len(documents))
+        missing = [i for i, score in enumerate(scores) if score is None]
+        if missing:
+            # Cached per (query, document) like the fan-out reranker, so a retry of the same question is not scored again
+            missing_scores = await shared_registry.run_cpu_bound(self.relevance_reranker.score, query,
+                                                                 [(documents[i], documents[i]) for i in missing], len(missing))
+            for i, score in zip(missing, missing_scores):
+                scores[i] = score
+        best_score = max(scores)
+        decision = self.relevance_gate.decide(best_score)
+        counts = self.relevance_gate.record(decision)
+        outcome = "AMBIGUOUS, ASK LLM GRADER" if decision is None else YES if decision else NO
+        print(f"---CROSS-ENCODER RELEVANCE GATE: best score {best_score:.3f}, {outcome}, gate counts: {counts}---")
+        return decision
+
+    async def grade_relevance(self, query: str, context: str) -> str:
+        """Remote LLM grader: 'yes' or 'no'."""
         system_message = "You are a grader assessing relevance of a retrieved document to a user question."
         user_message = f"""
         Your assessment need to be precise.
@@ -176,55 +357,65 @@ class AgenticRAG:
             SystemMessage(content=system_message),
             HumanMessage(content=user_message),
         ]
-        result = self.checker_llm_with_output.invoke(messages)
+        result = await self.checker_llm_with_output.ainvoke(messages)
         print(f"---RELEVANCE RESULT: {result.binary_score}---")
-        state['pass_relevance_test'] = result.binary_score
-
-        iteration_count = state.get("iteration_count", 0)
-        state["iteration_count"] = iteration_count + 1
-        ## Limiting to MAX_ITERATION
-        if state["iteration_count"] >= MAX_ITERATION:
-            print("---MAX ITERATIONS REACHED, FORCING 'Yes'---")
-            state["pass_relevance_test"] = YES
-
-        return state
+        return result.binary_score
     
     def relevance_decision(self, state: GraphState) -> str:
         return state['pass_relevance_test']    
 
+    @staticmethod
+    def is_cacheable(state: GraphState) -> bool:
+        """Only answers grounded in the vector DB are cached: not web search fallbacks, not forced relevance."""
+        return state.get('source') in vectordb_sources and state.get('pass_relevance_test') == YES and \
+            not state.get('forced_relevance', False)
+
 
     ###########################################################
     #####  Fallback to web search if we cannot retrieve relevant documents from vectorDB
     ###########################################################
     # Choose among 1) Use Serper.run directly, 2) Use Serper as a standalone Langchain Tool 3) Use LLM Bind tool
     # because Serper is the only tool and LLM does not have add-on value here.  Try option 2).  1) should be outside of Langgraph workflow
-    def web_search(self, state: GraphState) -> GraphState:
+    async def web_search(self, state: GraphState) -> GraphState:
         """Perform web search using Google Serper API."""
         print("---PERFORMING WEB SEARCH---")
-        search_results = self.search_tool.invoke(state["query"])
+        search_results = await self.search_tool.ainvoke(state["query"])
         # print(search_results)
         state["raw_results"] = search_results
+        state["relevance_scores"] = None
         state["source"] = source_web_search
 
         return state
 
 
-    def get_llm_response(self, prompt: str) -> str:
+    async def get_llm_response(self, prompt: str) -> str:
         """Function to get response from simple LLM prompt (user message)"""
         messages = [{"role": "user", "content": prompt}]
-        # Simple OpenAI chat message
-        response = self.ollama_via_openai.chat.completions.create(
+        # Tokens go to the custom stream of the graph as they come, run() shows them before the whole answer is ready
+        writer = get_stream_writer()
+        started = time.perf_counter()
+        stream = await self.ollama_via_openai.chat.completions.create(
             model="llama3.2",
             messages=messages,
-            seed=42
+            seed=42,
+            stream=True
         )
-        return response.choices[0].message.content
+        tokens = []
+        async for chunk in stream:
+            token = chunk.choices[0].delta.content if chunk.choices else None
+            if not token:
+                continue
+            if not tokens:
+                print(f"---LLM TIME TO FIRST TOKEN: {time.perf_counter() - started:.2f} s---")
+            tokens.append(token)
+            writer({"token": token})
+        return "".join(tokens)
 
 
     ###########################################################
     #####  AUGMENTED GENERATION
     ###########################################################
-    def augment_generate(self, state: GraphState) -> GraphState:
+    async def augment_generate(self, state: GraphState) -> GraphState:
         """Construct the RAG-style message"""
         print("---AUGMENT GENERATE ON CONTEXT---")
         query = state["query"]
@@ -237,32 +428,44 @@ class AgenticRAG:
         Please elaborate what can be applied under what circumstance if the context provides such information.
         Please also cite the source as "{source_disp}"
         """
-        answer = self.get_llm_response(prompt)
+        answer = await self.get_llm_response(prompt)
         state["generation"] = answer
         return state
 
 
+    def add_answer_nodes(self, graph_builder: StateGraph):
+        """Relevance checker, web search fallback and generator, shared by both graphs."""
+        graph_builder.add_node("relevance_checker", self.check_relevance)
+        graph_builder.add_node("web_searcher", self.web_search)
+        graph_builder.add_node("generator", self.augment_generate)
+        graph_builder.add_edge("web_searcher", "relevance_checker")
+        graph_builder.add_conditional_edges("relevance_checker", self.relevance_decision, {YES: "generator", NO: "web_searcher"})
+        graph_builder.add_edge("generator", END)
+
     async def build_graph(self):
         graph_builder = StateGraph(GraphState)
         graph_builder.add_node("router", self.route)
         graph_builder.add_node("disease_qna_retriever", self.retrieve_from_disease_qna)
         graph_builder.add_node("device_manual_retriever", self.retrieve_from_device_manual)
-        graph_builder.add_node("relevance_checker", self.check_relevance)
-        graph_builder.add_node("web_searcher", self.web_search)
-        graph_builder.add_node("generator", self.augment_generate)
+        graph_builder.add_node("fanout_retriever", self.retrieve_from_both_collections)
+        self.add_answer_nodes(graph_builder)
 
         # Add edges
         graph_builder.add_conditional_edges("router", self.route_decision, 
-            {source_disease_qna: "disease_qna_retriever", source_device_manuals: "device_manual_retriever"})
+            {source_disease_qna: "disease_qna_retriever", source_device_manuals: "device_manual_retriever",
+             source_both_collections: "fanout_retriever"})
         graph_builder.add_edge("disease_qna_retriever", "relevance_checker")
+        graph_builder.add_edge("fanout_retriever", "relevance_checker")
         graph_builder.add_edge("device_manual_retriever", "relevance_checker")
-        graph_builder.add_edge("web_searcher", "relevance_checker")
-        graph_builder.add_conditional_edges("relevance_checker", self.relevance_decision, {YES: "generator", NO: "web_searcher"})
-
-        graph_builder.add_edge("generator", END)
         graph_builder.add_edge(START, "router")
         self.agentic_rag = graph_builder.compile(checkpointer=self.memory)
 
+        # Batch questions are not conversations: no checkpoints, they would only churn the retention of the sessions
+        answer_builder = StateGraph(GraphState)
+        self.add_answer_nodes(answer_builder)
+        answer_builder.add_edge(START, "relevance_checker")
+        self.answer_graph = answer_builder.compile()
+
    
 
     async def run_query(self, input_state: GraphState):
@@ -276,24 +479,176 @@ class AgenticRAG:
         pprint('User close browser and free up resources')
 
     async def run(self, query: str):
-        input_state = GraphState(query=query, iteration_count=0, filter_out_all_retrieved_documents=False)
-        async for step in self.agentic_rag.astream(input_state, config=self.config):
+        # Near-duplicate questions answered with the same strategy skip router, retrieval, relevance check and generation
+        q_emb = await shared_registry.run_cpu_bound(self.embedding_model.encode, query)
+        cached = self.semantic_cache.lookup(q_emb, self.strategy, self.corpus)
+        if cached:
+            print(f"---SEMANTIC CACHE HIT: '{cached['query']}' (similarity {cached['similarity']:.3f})---")
+            yield f"### SEMANTIC CACHE HIT: answered before as `{cached['query']}`"
+            for message in cached['messages']:
+                yield message
+            yield f'{GENERATION_HEADER}{cached["generation"]}'
+            return
+
+        messages, tokens = [], []
+        async for message in self.run_graph(query):
+            if isinstance(message, GenerationToken):
+                tokens.append(message)
+            elif not isinstance(message, TimingMessage) and message != GENERATION_HEADER:
+                messages.append(message)
+            yield message
+        generation = "".join(tokens)
+        # The checkpoint of the session holds the final state of this run
+        state = (await self.agentic_rag.aget_state(self.config)).values
+        if generation.strip() and self.is_cacheable(state):
+            self.semantic_cache.put(q_emb, self.strategy, self.corpus, query, generation, messages)
+
+    async def run_graph(self, query: str):
+        input_state = GraphState(query=query, iteration_count=0, filter_out_all_retrieved_documents=False, relevance_grader=None,
+                                 forced_relevance=False)
+        started = last_step = time.perf_counter()
+        first_token = True
+        # 'updates' after each node like before, 'custom' for the generation tokens written by augment_generate
+        async for mode, step in self.agentic_rag.astream(input_state, config=self.config, stream_mode=["updates", "custom"]):
+            if mode == "custom":
+                if first_token:
+                    first_token = False
+                    yield TimingMessage(f"#### TIME TO FIRST TOKEN: {time.perf_counter() - started:.2f} s")
+                    yield GENERATION_HEADER
+                yield GenerationToken(step["token"])
+                continue
+            # Nodes run one after the other, so the time since the previous update is the time of this node
+            now = time.perf_counter()
+            elapsed, last_step = now - last_step, now
             for key, value in step.items():
                 yield f"### Finished running: '{key.upper()}'"
+                yield TimingMessage(f"###### `{key}` took {elapsed * 1000:.0f} ms")
                 if key == 'router':
                     yield f"#### ROUTER DECISION: `{value['source']}`"
-                elif key in ["disease_qna_retriever","device_manual_retriever"]:
+                elif key in ["disease_qna_retriever","device_manual_retriever","fanout_retriever"]:
                     yield f"#### STRATEGY: `{value['strategy']}`"   
                 elif key == 'relevance_checker':
-                    yield f"#### RELEVANCE DECISION: `{value['pass_relevance_test']}`"
+                    grader = f" by `{value['relevance_grader']}`" if value.get('relevance_grader') else ""
+                    yield f"#### RELEVANCE DECISION: `{value['pass_relevance_test']}`{grader}"
                     if value.get("iteration_count", 0) >= MAX_ITERATION:
                         yield "**MAX ITERATIONS REACHED, FORCING 'Yes' to relevance**"
-                    if value['source'] in [source_disease_qna, source_device_manuals] and \
+                    if value['source'] in vectordb_sources and \
                        value.get('filter_out_all_retrieved_documents', False):
                        yield "**Unable to retrieve documents met quality criteria, Fallback to Web Search!**"
                     if value['pass_relevance_test'] == YES:
                         yield "### START AUGMENTED GENERATION using CONTEXT---"
-        yield f'##### {value["generation"]}'
+        yield TimingMessage(f"###### Total: {time.perf_counter() - started:.2f} s")
+
+    ###########################################################
+    #####  Batch of questions
+    ###########################################################
+    async def run_batch(self, queries, batch_size: int = BATCH_SIZE, concurrency: int = BATCH_CONCURRENCY,
+                        use_cache: bool = True):
+        """
+        Answer a list, iterator or async iterator of questions.  Yields one dict per question as soon as it is answered,
+        so results come in completion order: 'index' is the position of the question in the input.
+        Every batch_size questions share one encode call, one semantic cache lookup and one vectorized retrieval per
+        collection (matrix product, sparse BM25 product, one cross-encoder pass).  The LLM stages (router fallback,
+        relevance grader, web search and generation) run for at most concurrency questions at a time.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        batch, index = [], 0
+        async for query in as_async_iterator(queries):
+            batch.append((index, query))
+            index += 1
+            if len(batch) == batch_size:
+                async for result in self.answer_batch(batch, semaphore, use_cache):
+                    yield result
+                batch = []
+        if batch:
+            async for result in self.answer_batch(batch, semaphore, use_cache):
+                yield result
+
+    async def answer_batch(self, items: list[tuple[int, str]], semaphore: asyncio.Semaphore, use_cache: bool):
+        print(f"---BATCH OF {len(items)} QUESTIONS---")
+        queries = [query for _, query in items]
+        q_embs = await shared_registry.run_cpu_bound(partial(self.embedding_model.encode, batch_size=ENCODE_BATCH_SIZE), queries)
+        pending = []
+        cached_answers = self.semantic_cache.lookup_batch(q_embs, self.strategy, self.corpus) if use_cache else [None] * len(items)
+        for position, cached in enumerate(cached_answers):
+            if cached:
+                # Same keys as a fresh answer, so the JSONL of batch_rag.py has one schema
+                yield {"index": items[position][0], "query": queries[position], "cached": True, "route": None,
+                       "source": None, "strategy": self.strategy, "relevance_grader": None,
+                       "generation": cached['generation'], "answer_seconds": 0.0}
+            else:
+                pending.append(position)
+
+        # Route: embedding router on the shared embeddings, the LLM router (bounded) only for the unsure ones
+        routes = {}
+        if self.embedding_router is not None:
+            for position in pending:
+                routes[position] = self.route_by_embedding(q_embs[position])
+
+        async def route_with_llm(position):
+            async with semaphore:
+                routes[position] = await self.route_with_llm(queries[position])
+        await asyncio.gather(*[route_with_llm(position) for position in pending if routes.get(position) is None])
+
+        # Retrieve: one vectorized call per collection for all the questions routed to it
+        retrievers = {source_disease_qna: self.medical_disease_qna_retriever,
+                      source_device_manuals: self.medical_device_manuals_retriever}
+        positions_by_source = {source: [position for position in pending
+                                        if routes[position] in [source, source_both_collections]] for source in retrievers}
+        positions_by_source = {source: positions for source, positions in positions_by_source.items() if positions}
+        all_results = await asyncio.gather(*[
+            shared_registry.run_cpu_bound(retrievers[source].retrieve_scored_batch, [queries[p] for p in positions],
+                                          N_RESULTS, self.strategy, q_embs[positions])
+            for source, positions in positions_by_source.items()])
+        results_by_source = {source: dict(zip(positions, results))
+                             for (source, positions), results in zip(positions_by_source.items(), all_results)}
+        retrieved = {}
+        for position in pending:
+            if routes[position] != source_both_collections:
+                results = results_by_source[routes[position]][position]
+                retrieved[position] = (None, None) if results is None else \
+                    ([doc for doc, _ in results], [score for _, score in results])
+        fanout = [position for position in pending if routes[position] == source_both_collections]
+        if fanout:
+            merged = await shared_registry.run_cpu_bound(self.merge_collections, [queries[p] for p in fanout],
+                [[results_by_source[source][p] for source in retrievers] for p in fanout])
+            retrieved.update(zip(fanout, merged))
+
+        # Relevance check, web search fallback and generation of each question
+        answers = []
+
+        async def answer(position):
+            started = time.perf_counter()
+            documents, scores = retrieved[position]
+            state = GraphState(query=queries[position], source=routes[position], strategy=self.strategy,
+                               raw_results=documents, relevance_scores=scores, iteration_count=0,
+                               filter_out_all_retrieved_documents=False, relevance_grader=None, forced_relevance=False)
+            async with semaphore:
+                state = await self.answer_graph.ainvoke(state)
+            generation = state.get("generation", "")
+            if use_cache and generation.strip() and self.is_cacheable(state):
+                answers.append((q_embs[position], queries[position], generation, [
+                    f"#### ROUTER DECISION: `{routes[position]}`", f"#### STRATEGY: `{self.strategy}`",
+                    f"#### RELEVANCE DECISION: `{state['pass_relevance_test']}` by `{state['relevance_grader']}`"]))
+            return {"index": items[position][0], "query": queries[position], "cached": False, "route": routes[position],
+                    "source": state["source"], "strategy": self.strategy, "relevance_grader": state["relevance_grader"],
+                    "generation": generation, "answer_seconds": round(time.perf_counter() - started, 3)}
+
+        for next_answer in asyncio.as_completed([answer(position) for position in pending]):
+            yield await next_answer
+        if answers:
+            # One save of the cache file for the whole batch
+            self.semantic_cache.put_many(self.strategy, self.corpus, answers)
+
+
+async def as_async_iterator(queries):
+    """A list, an iterator (e.g. lines read from stdin) or an async iterator of questions."""
+    if hasattr(queries, '__aiter__'):
+        async for query in queries:
+            yield query
+    else:
+        for query in queries:
+            yield query
           
 
 if __name__ == '__main__':
@@ -305,5 +660,6 @@ if __name__ == '__main__':
     # asyncio.run(instance.run_query({"query": "When will a measles patient have the first appearance symptons after he or she is exposed to a pathogen?"}))
     # asyncio.run(instance.run_query({"query": "How do patients contract hantavirus pulmonary syndrome?"}))
     asyncio.run(instance.run_query({"query": "what is the most aggressive form of brain tumor?"}))
+    close_checkpointers()
     # asyncio.run(instance.run_query({"query": "What are the usage of Dialysis Machine Device?"}))
     # asyncio.run(instance.run_query({"query": "Which devices are suitable for neonatal patients?"}))
\ No newline at end of file
@@ -0,0 +1,91 @@
+import os
+import uuid
+import numpy as np
+from chromadb.api.models.Collection import Collection
+from hybrid_index import HybridIndex
+
+try:
+    import hnswlib
+except ImportError:
+    # Optional. Without it the semantic leg of hybrid ANN retrieval uses the HNSW index Chroma already maintains
+    hnswlib = None
+
+HNSW_INDEX_FILE = 'hnsw_cosine.bin'
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 128
+
+
+class ChromaAnnIndex:
+    """Semantic candidates from the HNSW index of the Chroma collection (created with 'hnsw:space': 'cosine')."""
+    def __init__(self, collection: Collection, index: HybridIndex):
+        self.collection = collection
+        self.index = index
+
+    def search(self, q_emb: np.ndarray, n_results: int) -> tuple[np.ndarray, np.ndarray]:
+        """Rows of the hybrid index and cosine similarities of the approximate nearest neighbours."""
+        return self.search_batch(q_emb[None, :], n_results)[0]
+
+    def search_batch(self, q_embs: np.ndarray, n_results: int) -> list[tuple[np.ndarray, np.ndarray]]:
+        """search() of each row of q_embs with one query to Chroma."""
+        results = self.collection.query(query_embeddings=[q_emb.astype(float) for q_emb in q_embs], n_results=n_results,
+                                        include=['distances'])
+        row_by_id = self.index.row_by_id
+        matches = []
+        for ids, distances in zip(results['ids'], results['distances']):
+            rows, similarities = [], []
+            for doc_id, distance in zip(ids, distances):
+                # Skip documents added after the hybrid index was built. They will be part of the next one
+                if doc_id in row_by_id:
+                    rows.append(row_by_id[doc_id])
+                    similarities.append(1.0 - distance)
+            matches.append((np.asarray(rows, dtype=np.int64), np.asarray(similarities, dtype=np.float32)))
+        return matches
+
+
+class HnswlibAnnIndex:
+    """
+    Local hnswlib index over the memory-mapped embeddings of a hybrid index.  It is saved inside the artifact folder,
+    so it shares the content hash of the collection and is built at most once per version of the collection.
+    """
+    def __init__(self, index: HybridIndex, ef_search: int = HNSW_EF_SEARCH):
+        if hnswlib is None:
+            raise ImportError("hnswlib is not installed. pip install hnswlib or use ChromaAnnIndex")
+        self.index = index
+        dimension = index.embeddings.shape[1]
+        self.hnsw = hnswlib.Index(space='cosine', dim=dimension)
+        path = os.path.join(index.path, HNSW_INDEX_FILE)
+        if os.path.exists(path):
+            self.hnsw.load_index(path, max_elements=len(index))
+        else:
+            self._build(path)
+        self.hnsw.set_ef(ef_search)
+
+    def _build(self, path: str, batch_size: int = 50_000):
+        self.hnsw.init_index(max_elements=max(len(self.index), 1), ef_construction=HNSW_EF_CONSTRUCTION, M=HNSW_M)
+        for start in range(0, len(self.index), batch_size):
+            batch = np.asarray(self.index.embeddings[start:start + batch_size])
+            self.hnsw.add_items(batch, np.arange(start, start + len(batch)))
+        tmp_path = f'{path}.tmp-{uuid.uuid4().hex}'
+        self.hnsw.save_index(tmp_path)
+        os.replace(tmp_path, path)
+
+    def search(self, q_emb: np.ndarray, n_results: int) -> tuple[np.ndarray, np.ndarray]:
+        return self.search_batch(q_emb[None, :], n_results)[0]
+
+    def search_batch(self, q_embs: np.ndarray, n_results: int) -> list[tuple[np.ndarray, np.ndarray]]:
+        """search() of each row of q_embs.  hnswlib spreads the queries of one knn_query over its threads."""
+        n_results = min(n_results, len(self.index))
+        # hnswlib needs ef >= k
+        if n_results > self.hnsw.ef:
+            self.hnsw.set_ef(n_results)
+        labels, distances = self.hnsw.knn_query(q_embs, k=n_results)
+        return [(row_labels.astype(np.int64), (1.0 - row_distances).astype(np.float32))
+                for row_labels, row_distances in zip(labels, distances)]
+
+
+def open_ann_index(collection: Collection, index: HybridIndex):
+    """hnswlib when it is installed, otherwise the HNSW index of Chroma itself."""
+    if hnswlib is not None:
+        return HnswlibAnnIndex(index)
+    return ChromaAnnIndex(collection, index)
@@ -1,7 +1,8 @@
 import gradio as gr
-from agentic_rag import AgenticRAG
-from documents_retrievers import SEMANTIC_RETRIEVAL, HYBRID_RETRIEVAL_RERANK
-import time
+import asyncio
+from agentic_rag import AgenticRAG, GenerationToken
+from checkpointer import close_checkpointers
+from documents_retrievers import SEMANTIC_RETRIEVAL, HYBRID_RETRIEVAL_RERANK, HYBRID_ANN_RETRIEVAL_RERANK
 
 
 async def setup():
@@ -17,14 +18,20 @@ async def run(agentic_rag, query):
     # Cumulative Output: The value you yield at each step should be the entire content you want to display
     # Make use of Markdown H1, H2.... Bold, Italic 
     async for progress in agentic_rag.run(query):
-        full_messages += '\n' + progress
-        time.sleep(0.05)
+        # Generation tokens are appended as they stream.  Everything else goes to a new line
+        full_messages += progress if isinstance(progress, GenerationToken) else '\n' + progress
+        if not isinstance(progress, GenerationToken):
+            # Never time.sleep here: it would block the event loop serving every other session
+            await asyncio.sleep(0.05)
         yield full_messages
 
 async def reset(selected_index = 1):
+    # Cheap: the new session reuses the retrievers and models of the process-wide registry
     new_agentic_rag = AgenticRAG()
     if selected_index == 0:
         await new_agentic_rag.setup(SEMANTIC_RETRIEVAL)
+    elif selected_index == 2:
+        await new_agentic_rag.setup(HYBRID_ANN_RETRIEVAL_RERANK)
     else:
         await new_agentic_rag.setup(HYBRID_RETRIEVAL_RERANK)    
     # How do those parameters match
@@ -48,7 +55,7 @@ with gr.Blocks(title="Agentic RAG", theme=gr.themes.Default(primary_hue="emerald
     # with gr.Group():
     with gr.Blocks():
         with gr.Row():
-            radio  = gr.Radio(["Semantic Retrieval", "Hybrid Retrieval Plus ReRank"], label="RAG Retrieval Strategy", 
+            radio  = gr.Radio(["Semantic Retrieval", "Hybrid Retrieval Plus ReRank", "Hybrid ANN Retrieval Plus ReRank"], label="RAG Retrieval Strategy", 
             value="Hybrid Retrieval Plus ReRank", type='index')
         with gr.Row():
             query  = gr.Textbox(show_label=False, placeholder="Your question to your Assistant:")
@@ -68,6 +75,9 @@ with gr.Blocks(title="Agentic RAG", theme=gr.themes.Default(primary_hue="emerald
     )
     reset_button.click(reset, [], [query, report, agentic_rag])
     radio.input(fn=reset, inputs=radio, outputs=[query, report, agentic_rag])
-    ui.queue(default_concurrency_limit=5)
+    # Graph nodes are async and CPU-bound work runs on a bounded pool, so one worker serves many sessions at once
+    ui.queue(default_concurrency_limit=50)
 
 ui.launch(inbrowser=True)
+# The SQLite thread of the checkpointer would keep the process alive after Gradio stops
+close_checkpointers()
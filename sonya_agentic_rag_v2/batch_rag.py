@@ -0,0 +1,87 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import sys
+import time
+from documents_retrievers import SEMANTIC_RETRIEVAL, HYBRID_RETRIEVAL_RERANK, HYBRID_ANN_RETRIEVAL_RERANK
+from embedding_router import LLM_ROUTING, EMBEDDING_ROUTING, FANOUT_ROUTING
+from relevance_gate import LLM_RELEVANCE, CROSS_ENCODER_RELEVANCE
+from agentic_rag import AgenticRAG, BATCH_SIZE, BATCH_CONCURRENCY
+from checkpointer import close_checkpointers
+
+# Answers a file (or stdin) of questions with AgenticRAG.run_batch and streams one JSON line per answer, in completion
+# order ("index" is the line number of the question).  Every --batch-size questions share one encode call, one semantic
+# cache lookup and one vectorized retrieval per collection; at most --concurrency of them are in the LLM stages.
+# Throughput (QPS) is reported every --report-every answers and at the end.
+#
+#   python batch_rag.py questions.txt --output answers.jsonl
+#   cat questions.jsonl | python batch_rag.py - > answers.jsonl
+#
+# Input lines are either a plain question or a JSON object with a "query" key.  With --offline, the LLMs and the web
+# search are the fakes of evaluation.py (no network, no API keys) and the semantic cache is left alone.
+
+REPORT_EVERY = 100
+
+
+def read_queries(path: str):
+    """Questions read lazily, so a long file or a pipe starts being answered before it is fully read."""
+    with (contextlib.nullcontext(sys.stdin) if path == '-' else open(path, encoding='utf-8')) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            yield json.loads(line)['query'] if line.startswith('{') else line
+
+
+async def answer_all(args, output) -> dict:
+    if args.offline:
+        from evaluation import offline_agentic_rag
+        from web_search import StubSearchBackend, WebSearchCache
+        agentic_rag = await offline_agentic_rag(args.strategy, args.fake_llm_latency, StubSearchBackend(latency=args.fake_llm_latency),
+                                                WebSearchCache(path=None), args.routing, args.relevance)
+    else:
+        agentic_rag = AgenticRAG()
+        await agentic_rag.setup(args.strategy, args.routing, args.relevance)
+    use_cache = not args.offline and not args.no_cache
+
+    stats = {"queries": 0, "cached": 0, "web_search": 0}
+    started = time.perf_counter()
+    async for result in agentic_rag.run_batch(read_queries(args.input), args.batch_size, args.concurrency, use_cache):
+        output.write(json.dumps(result) + '\n')
+        output.flush()
+        stats["queries"] += 1
+        stats["cached"] += result["cached"]
+        stats["web_search"] += result.get("source") == "web_search"
+        if stats["queries"] % args.report_every == 0:
+            print(f"---{stats['queries']} ANSWERED, {stats['queries'] / (time.perf_counter() - started):.1f} QPS---")
+    elapsed = time.perf_counter() - started
+    return {**stats, "seconds": round(elapsed, 2), "qps": round(stats["queries"] / elapsed, 2) if elapsed else 0.0,
+            "batch_size": args.batch_size, "concurrency": args.concurrency, "strategy": args.strategy}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Answer a batch of questions with AgenticRAG, streamed as JSONL")
+    parser.add_argument("input", help="questions, one per line (text or JSON with a 'query' key). '-' reads stdin")
+    parser.add_argument("--output", default='-', help="JSONL answers. Default stdout, progress then goes to stderr")
+    parser.add_argument("--strategy", choices=[SEMANTIC_RETRIEVAL, HYBRID_RETRIEVAL_RERANK, HYBRID_ANN_RETRIEVAL_RERANK],
+                        default=HYBRID_RETRIEVAL_RERANK)
+    parser.add_argument("--routing", choices=[EMBEDDING_ROUTING, FANOUT_ROUTING, LLM_ROUTING], default=LLM_ROUTING,
+                        help="embedding and fanout route by collection centroid first, see embedding_router.py")
+    parser.add_argument("--relevance", choices=[CROSS_ENCODER_RELEVANCE, LLM_RELEVANCE], default=LLM_RELEVANCE,
+                        help="cross_encoder decides clear cases by reranker score, see relevance_gate.py")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="questions encoded and retrieved together")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="questions in the LLM stages at a time")
+    parser.add_argument("--no-cache", action="store_true", help="neither read nor fill the semantic cache")
+    parser.add_argument("--offline", action="store_true", help="fake LLMs and web search of evaluation.py")
+    parser.add_argument("--fake-llm-latency", type=float, default=0.2, help="seconds of each fake LLM or web call")
+    parser.add_argument("--report-every", type=int, default=REPORT_EVERY)
+    args = parser.parse_args()
+
+    to_stdout = args.output == '-'
+    with (contextlib.nullcontext(sys.stdout) if to_stdout else open(args.output, 'w', encoding='utf-8')) as output:
+        # Progress messages of the graph nodes must not end up in the JSONL
+        with contextlib.redirect_stdout(sys.stderr) if to_stdout else contextlib.nullcontext():
+            summary = asyncio.run(answer_all(args, output))
+            close_checkpointers()
+            print(json.dumps(summary, indent=2))
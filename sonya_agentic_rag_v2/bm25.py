@@ -0,0 +1,123 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+# BM25Okapi defaults of rank_bm25. Keep them identical so the scores match the previous path
+BM25_K1 = 1.5
+BM25_B = 0.75
+BM25_EPSILON = 0.25
+
+
+def tokenize(text: str) -> list[str]:
+    # The same naive tokenizer used on documents and queries ever since the first version of HybridRetriever
+    return text.lower().split()
+
+
+def bm25_weights(tf_indptr: np.ndarray, tf_indices: np.ndarray, tf_data: np.ndarray, doc_len: np.ndarray,
+                 k1: float = BM25_K1, b: float = BM25_B, epsilon: float = BM25_EPSILON) -> np.ndarray:
+    """
+    BM25Okapi contribution of every (term, document) posting of a term-major CSR of raw term frequencies:
+    idf[t] * tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl)).  IDF and length normalization are baked in,
+    so scoring a query is only a gather and a sum.
+    """
+    corpus_size = len(doc_len)
+    doc_freq = np.diff(tf_indptr).astype(np.float64)
+    # Same as BM25Okapi._calc_idf: negative idfs are floored to epsilon * average idf
+    idf = np.log(corpus_size - doc_freq + 0.5) - np.log(doc_freq + 0.5)
+    if len(idf):
+        idf[idf < 0] = epsilon * idf.mean()
+    avgdl = float(np.mean(doc_len)) if corpus_size else 0.0
+    length_norm = k1 * (1 - b + b * np.asarray(doc_len, dtype=np.float64) / (avgdl or 1.0))
+    tf = np.asarray(tf_data, dtype=np.float64)
+    posting_idf = np.repeat(idf, np.diff(tf_indptr))
+    return (posting_idf * tf * (k1 + 1) / (tf + length_norm[tf_indices])).astype(np.float32)
+
+
+class SparseBM25:
+    """
+    BM25 over a SciPy CSR term-document matrix of precomputed weights (one row per term).
+    A query becomes a sparse vector of term counts over the vocabulary, so scoring it is a sparse row gather and sum,
+    and scoring a batch of queries is one sparse matrix product.  Scores match rank_bm25.BM25Okapi.get_scores.
+    """
+    def __init__(self, weights: csr_matrix, vocab: dict[str, int]):
+        self.weights = weights
+        self.vocab = vocab
+        self.corpus_size = weights.shape[1]
+
+    @classmethod
+    def from_term_statistics(cls, vocab: dict[str, int], tf_indptr: np.ndarray, tf_indices: np.ndarray,
+                             weights: np.ndarray, corpus_size: int) -> "SparseBM25":
+        # copy=False keeps the memory-mapped arrays of the hybrid index; indices and indptr must share one dtype for that
+        matrix = csr_matrix((weights, tf_indices, tf_indptr), shape=(len(vocab), corpus_size), copy=False)
+        return cls(matrix, vocab)
+
+    @classmethod
+    def from_tokenized(cls, corpus: list[list[str]]) -> "SparseBM25":
+        vocab: dict[str, int] = {}
+        rows, cols, counts = [], [], []
+        for doc_id, tokens in enumerate(corpus):
+            frequencies: dict[int, int] = {}
+            for token in tokens:
+                term_id = vocab.setdefault(token, len(vocab))
+                frequencies[term_id] = frequencies.get(term_id, 0) + 1
+            rows.extend(frequencies.keys())
+            cols.extend([doc_id] * len(frequencies))
+            counts.extend(frequencies.values())
+        tf = csr_matrix((np.asarray(counts, dtype=np.float32), (rows, cols)), shape=(len(vocab), len(corpus)))
+        doc_len = np.array([len(tokens) for tokens in corpus], dtype=np.float32)
+        weights = bm25_weights(tf.indptr, tf.indices, tf.data, doc_len)
+        return cls.from_term_statistics(vocab, tf.indptr, tf.indices, weights, len(corpus))
+
+    def query_matrix(self, queries: list[list[str]]) -> csr_matrix:
+        """Term counts of each tokenized query over the vocabulary. Repeated terms count twice like in BM25Okapi."""
+        rows, cols = [], []
+        for row, tokens in enumerate(queries):
+            for token in tokens:
+                term_id = self.vocab.get(token)
+                if term_id is not None:
+                    rows.append(row)
+                    cols.append(term_id)
+        data = np.ones(len(rows), dtype=np.float32)
+        # Duplicated (row, col) entries are summed by the constructor
+        return csr_matrix((data, (rows, cols)), shape=(len(queries), len(self.vocab)))
+
+    def get_scores(self, query_tokens: list[str]) -> np.ndarray:
+        return self.get_batch_scores([query_tokens])[0]
+
+    def get_sparse_scores(self, query_tokens: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        """(document indices, scores) of the documents sharing at least one term with the query."""
+        scores = (self.query_matrix([query_tokens]) @ self.weights).tocsr()
+        return scores.indices, scores.data
+
+    def get_batch_sparse_scores(self, queries: list[list[str]]) -> list[tuple[np.ndarray, np.ndarray]]:
+        """get_sparse_scores of many queries with one sparse product."""
+        scores = (self.query_matrix(queries) @ self.weights).tocsr()
+        return [(scores.indices[start:stop], scores.data[start:stop])
+                for start, stop in zip(scores.indptr[:-1], scores.indptr[1:])]
+
+    def get_batch_scores(self, queries: list[list[str]]) -> np.ndarray:
+        """Dense (n_queries, corpus_size) matrix of scores computed with one sparse product."""
+        return (self.query_matrix(queries) @ self.weights).toarray()
+
+
+if __name__ == "__main__":
+    # Check that the sparse engine gives the same scores as rank_bm25 on the indexed collections
+    from rank_bm25 import BM25Okapi
+    from resource_registry import shared_registry, chromdb_persistent_path
+
+    queries = [
+        "How long is the incubation period of measles?",
+        "How do patients contract hantavirus pulmonary syndrome?",
+        "what is the most aggressive form of brain tumor?",
+        "What are the usage of Dialysis Machine Device?",
+        "Which devices are suitable for neonatal patients?",
+    ]
+    client = shared_registry.chroma_client(chromdb_persistent_path)
+    for name in ["medical_disease_qna", "medical_device_manuals"]:
+        index = shared_registry.hybrid_index(client.get_collection(name))
+        reference = BM25Okapi([tokenize(document) for document in index.documents])
+        tokenized_queries = [tokenize(query) for query in queries]
+        batch_scores = index.bm25.get_batch_scores(tokenized_queries)
+        for tokens, scores in zip(tokenized_queries, batch_scores):
+            expected = reference.get_scores(tokens)
+            assert np.allclose(scores, expected, rtol=1e-4, atol=1e-4), f"BM25 scores of '{name}' differ for {tokens}"
+        print(f"SparseBM25 matches BM25Okapi on '{name}' ({len(index)} documents, {len(queries)} queries)")
@@ -0,0 +1,46 @@
+import atexit
+import threading
+
+# Changes of the caches are saved together at most that long after the first one, off the thread that made them
+SAVE_DELAY_SECONDS = 5.0
+
+
+class DebouncedSave:
+    """
+    Runs save at most once per delay seconds, on a timer thread, after mark_dirty() was called.  The caches call
+    mark_dirty() on every change instead of rewriting their JSON file, so an answer or a web search on the event loop
+    never waits for the disk, and a burst of changes is written once.  flush() saves right away if needed; it also runs
+    at exit, so nothing marked dirty is lost on a normal shutdown.
+    """
+    def __init__(self, save, delay: float = SAVE_DELAY_SECONDS):
+        self.save = save
+        self.delay = delay
+        self._lock = threading.Lock()
+        # Serializes the saves: the timer and a flush() at shutdown never write the same file at once
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._timer = None
+        atexit.register(self.flush)
+
+    def mark_dirty(self):
+        with self._lock:
+            self._dirty = True
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._save_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                dirty, self._dirty = self._dirty, False
+            if dirty:
+                try:
+                    self.save()
+                except OSError as e:
+                    # Keep the changes for the next attempt rather than losing them
+                    print(f"---Cache save failed, retried later: {e}---")
+                    self.mark_dirty()
@@ -1,65 +1,69 @@
-import chromadb
 from chromadb.api.models.Collection import Collection
 import polars as pl
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from sentence_transformers import SentenceTransformer, CrossEncoder
-from rank_bm25 import BM25Okapi
 import numpy as np
 import asyncio
-
-chromdb_persistent_path = "./chroma_db"
+from hybrid_index import HybridIndex, collection_fingerprint, freshness_key, mark_collection_written, CHROMA_PAGE_SIZE
+from fusion import fuse, WEIGHTED_MINMAX_FUSION
+from embedding_store import FLOAT32, RESCORE_FACTOR, EMBEDDING_STORES, default_embedding_precision
+from reranker import CrossEncoderReranker
+from ingestion import IngestionPipeline, content_hash, EMBED_BATCH_SIZE, ENCODE_BATCH_SIZE
+from bm25 import tokenize
+from stage_timings import timed
+from resource_registry import ResourceRegistry, shared_registry, chromdb_persistent_path
 
 SEMANTIC_RETRIEVAL = "semantic_retrieval"
 HYBRID_RETRIEVAL_RERANK = "hybrid_retrieval_plus_rerank"
+# Same as HYBRID_RETRIEVAL_RERANK but the semantic leg takes its candidates from an ANN (HNSW) index
+HYBRID_ANN_RETRIEVAL_RERANK = "hybrid_ann_retrieval_plus_rerank"
+# Candidates taken from each leg (semantic and keyword) before fusion: max(LEG_CANDIDATE_FACTOR * n_results, LEG_MIN_CANDIDATES)
+LEG_CANDIDATE_FACTOR = 10
+LEG_MIN_CANDIDATES = 50
+# Queries scored together by the exact semantic leg of a batch: a (queries x documents) float32 block of scores
+QUERY_BLOCK_SIZE = 64
+# Stable natural key of a device manual.  A new Manual_Version is a new document, an edit of the same version replaces it
+DEVICE_MANUAL_KEY = ['Device_Name', 'Model_Number', 'Manual_Version']
 
 
 class MedicalDiseaseQAndARetriever:
     # Chromadb is using "all-MiniLM-L6-v2" as embedding model.  That is a good choice (384 dimensions and OpenAIEmbedding do have more dimensions).
     # However, Chromadb is using L2 distance at default. Change to 'cosine' distance, a better choice than L2 one.
     # reranker_model need to match chromadb embedding model. Keep both using "all-MiniLM-L6-v2" for now
-    def __init__(self, data_path: str = "data/medical_q_n_a.csv", max_semantic_cosine_distance: float = .40):
-        self.shared_chroma_client = chromadb.PersistentClient(path = "./chroma_db")
+    def __init__(self, data_path: str = "data/medical_q_n_a.csv", max_semantic_cosine_distance: float = .40,
+                 registry: ResourceRegistry = shared_registry, embedding_precision: str | None = None):
+        # Chroma client and models are shared process-wide through the registry
+        self.registry = registry
+        self.shared_chroma_client = registry.chroma_client(chromdb_persistent_path)
         self.data_path = data_path
         # the embedding model for query need to match the embedding model for Chroma documents
         # If we ever change to use ex. OpenAI embedding for document.  We have to switch the embedding for the query too.
         # OpenAI Embedding has higher dimensions.  It should perform better in sematic search overall.
-        self.embedding_model_for_query = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
-        self.splitter = RecursiveCharacterTextSplitter(
-                            chunk_size=500,
-                            chunk_overlap=100,  # This is the key
-                            separators = ["\n\n", "\n", " ", ""]
-                        )
+        self.embedding_model_for_query = registry.embedding_model()
         self.identity = "medical_disease_qna"
         # chromadb is using 
         self.collection = self.shared_chroma_client.get_or_create_collection(name=self.identity, metadata={"hnsw:space": "cosine"})
         self.max_semantic_cosine_distance = max_semantic_cosine_distance
+        # float16/int8 copies of the embeddings for the exact semantic leg, see embedding_store.py
+        self.embedding_precision = embedding_precision or default_embedding_precision()
         self.hybrid_retriever = None
         
+    def build_hybrid_retriever(self):
+        self.hybrid_retriever = HybridRetriever(self.collection, embedding_model_for_query=self.embedding_model_for_query, alpha = 0.6,
+                                                index=self.registry.hybrid_index(self.collection), reranker=self.registry.cross_encoder(),
+                                                embedding_precision=self.embedding_precision)
+
     async def setup_hybrid_retriever(self):
-        self.hybrid_retriever = HybridRetriever(self.collection, embedding_model_for_query=self.embedding_model_for_query, alpha = 0.6)
+        self.build_hybrid_retriever()
         
-    def batch_add_documents(self, pl_df: pl.DataFrame, batch_size= 400):
-        n = pl_df.shape[0]
-
-        for st_idx in range(0, n, batch_size):
-            e_idx = min(st_idx + batch_size - 1, n - 1)
-            # the default ClosedInterval = 'both' for is_between
-            nested_chunks = pl_df.filter(pl.col('index').is_between(st_idx, e_idx)).select(['chunks']).to_series().to_list()
-            meta_summary = pl_df.filter(pl.col('index').is_between(st_idx, e_idx)).select(['qtype', 'Question']).to_dicts()
-            nested_metas = [[meta] * len(nested_chunks[i]) for i, meta in enumerate(meta_summary)]  # duplicate metas
-            # flatten nested_chunks and nested_metas and ids need to take starting_index into consideration otherwise id won't be unique 
-            self.collection.add(
-                documents=[ x for xs in nested_chunks for x in xs ],
-                metadatas=[ x for xs in nested_metas for x in xs ],
-                # index-1 based
-                ids=[f'{st_idx + idx + 1}_{c_idx + 1}' for idx in range(len(nested_chunks)) for c_idx in range(len(nested_chunks[idx]))],
-            )
-
     def load_index_documents(self):
         pl_qna = pl.read_csv(self.data_path)
-        pl_qna_index = pl_qna.with_row_index("index")
-        pl_qna_all = pl_qna_index.with_columns(pl.col("Answer").map_elements(self.splitter.split_text, return_dtype=pl.List(pl.String)).alias("chunks"))
-        self.batch_add_documents(pl_qna_all)
+        # Chunk answers in a process pool (RecursiveCharacterTextSplitter, chunk_size=500, chunk_overlap=100), embed in large
+        # batches and skip chunks already indexed.  Ids are content hashes, so it is safe to re-run on the same or a bigger CSV
+        IngestionPipeline(self.collection, self.embedding_model_for_query).run(
+            pl_qna.select(['Answer']).to_series().to_list(), pl_qna.select(['qtype', 'Question']).to_dicts())
+        # Hybrid indexes opened from now on compare the collection with their artifact again
+        mark_collection_written(self.identity)
+        # Next retriever built by the registry picks up the new hybrid index
+        self.registry.invalidate(self.identity)
 
     def retrieve_semantic(self, query: str, n_results: int) -> str:
         embedding = self.embedding_model_for_query.encode(query)
@@ -69,44 +73,129 @@ class MedicalDiseaseQAndARetriever:
         documents = results['documents'][0][:]
         distances = results['distances'][0][:]
         return [doc for doc, dist in zip(documents, distances) if dist < self.max_semantic_cosine_distance]
+
+    def retrieve_semantic_batch(self, queries: list[str], n_results: int, q_embs: np.ndarray | None = None) -> list[list[str]]:
+        """retrieve_semantic of many queries with one encode call and one query to Chroma."""
+        if q_embs is None:
+            q_embs = self.embedding_model_for_query.encode(queries, batch_size=ENCODE_BATCH_SIZE)
+        results = self.collection.query(query_embeddings=[q_emb.astype(float) for q_emb in q_embs], n_results=n_results)
+        return [[doc for doc, dist in zip(documents, distances) if dist < self.max_semantic_cosine_distance]
+                for documents, distances in zip(results['documents'], results['distances'])]
         
     def retrieve(self, query: str, k = 3, strategy = SEMANTIC_RETRIEVAL) -> list[str] | None:
         if strategy == SEMANTIC_RETRIEVAL:
             return self.retrieve_semantic(query, k)
-        return self.hybrid_retriever.retrieve(query, k)
+        return self.hybrid_retriever.retrieve(query, k, use_ann=strategy == HYBRID_ANN_RETRIEVAL_RERANK)
+
+    def retrieve_scored(self, query: str, k = 3, strategy = SEMANTIC_RETRIEVAL) -> list[tuple[str, float | None]] | None:
+        """(document, cross-encoder score).  Semantic retrieval has no re-ranking stage, so its scores are None."""
+        if strategy == SEMANTIC_RETRIEVAL:
+            return [(doc, None) for doc in self.retrieve_semantic(query, k)]
+        return self.hybrid_retriever.retrieve_scored(query, k, use_ann=strategy == HYBRID_ANN_RETRIEVAL_RERANK)
+
+    def retrieve_scored_batch(self, queries: list[str], k = 3, strategy = SEMANTIC_RETRIEVAL,
+                              q_embs: np.ndarray | None = None) -> list[list[tuple[str, float | None]] | None]:
+        """retrieve_scored of many queries.  q_embs, if given, are the query embeddings already computed by the caller."""
+        if strategy == SEMANTIC_RETRIEVAL:
+            return [[(doc, None) for doc in documents] for documents in self.retrieve_semantic_batch(queries, k, q_embs)]
+        return self.hybrid_retriever.retrieve_scored_batch(queries, k, use_ann=strategy == HYBRID_ANN_RETRIEVAL_RERANK, q_embs=q_embs)
 
 
 class MedicalDeviceManualsRetriever:
-    def __init__(self, data_path: str = "data/medical_device_manuals.csv", max_semantic_cosine_distance: float = .45):
-        self.shared_chroma_client = chromadb.PersistentClient(path = "./chroma_db")
+    def __init__(self, data_path: str = "data/medical_device_manuals.csv", max_semantic_cosine_distance: float = .45,
+                 registry: ResourceRegistry = shared_registry, embedding_precision: str | None = None):
+        self.registry = registry
+        self.shared_chroma_client = registry.chroma_client(chromdb_persistent_path)
         self.data_path = data_path
-        self.embedding_model_for_query = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+        self.embedding_model_for_query = registry.embedding_model()
         self.identity = "medical_device_manuals"
         # chromadb is using L2 distance in default
         self.collection = self.shared_chroma_client.get_or_create_collection(name=self.identity, metadata={"hnsw:space": "cosine"})
         self.max_semantic_cosine_distance = max_semantic_cosine_distance
+        self.embedding_precision = embedding_precision or default_embedding_precision()
         self.hybrid_retriever = None
       
+    def build_hybrid_retriever(self):
+        self.hybrid_retriever = HybridRetriever(self.collection, embedding_model_for_query=self.embedding_model_for_query, alpha = 0.6,
+                                                index=self.registry.hybrid_index(self.collection), reranker=self.registry.cross_encoder(),
+                                                embedding_precision=self.embedding_precision)
+
     async def setup_hybrid_retriever(self):
-        self.hybrid_retriever = HybridRetriever(self.collection, embedding_model_for_query=self.embedding_model_for_query, alpha = 0.6)
+        self.build_hybrid_retriever()
 
     def load_index_documents(self):
+        """Sync the collection with the CSV.  Safe to re-run after editing the CSV, see sync_index_documents."""
+        return self.sync_index_documents()
+
+    def read_device_manuals(self) -> tuple[list[str], list[str], list[dict]]:
+        """(ids, documents, metadatas) of the CSV.  Ids are the natural key and content_hash tells if a row changed."""
         pl_device= pl.read_csv(self.data_path)
         # Filter out rows with no Manufacturer
-        pl_device_index = pl_device.filter(pl.col('Manufacturer').is_not_null()).with_row_index("index")
-        pl_device_partial = pl_device_index.with_columns((pl.col('index') + 1).cast(pl.Utf8).alias('doc_id'))
+        pl_device_partial = pl_device.filter(pl.col('Manufacturer').is_not_null())
         # Polars tries very hard not to use Pandas style apply because it is very heavy
         pl_device_all = pl_device_partial.with_columns(pl.when(pl.col("Contraindications").is_not_null()).
         then('Device: ' + pl.col("Device_Name") + ', Model: ' + pl.col("Model_Number") + ', Manufacturer: ' + pl.col("Manufacturer") + '; ' + 
             pl.col("Indications_for_Use") + ' '+  pl.col("Contraindications")).
-        otherwise('Device: ' + pl.col("Device_Name") + ', Model: ' + pl.col("Model_Number") + ', Manufacturer: ' + pl.col("Manufacturer") + '; ' + pl.col("Indications_for_Use")).alias("combined_text"))
+        otherwise('Device: ' + pl.col("Device_Name") + ', Model: ' + pl.col("Model_Number") + ', Manufacturer: ' + pl.col("Manufacturer") + '; ' + pl.col("Indications_for_Use")).alias("combined_text"),
+        pl.concat_str([pl.col(name).cast(pl.Utf8).fill_null('') for name in DEVICE_MANUAL_KEY], separator='|').alias('doc_id'))
+
+        rows = {}
+        for doc_id, document, metadata in zip(pl_device_all.select(['doc_id']).to_series().to_list(),
+                                              pl_device_all.select(['combined_text']).to_series().to_list(),
+                                              pl_device_all.select(['Manual_Version', 'Publication_Date', 'Patient_Population']).to_dicts()):
+            # The last row of a duplicated key wins, like an upsert would
+            rows[doc_id] = (document, {**metadata, 'content_hash': content_hash(document, metadata)})
+        ids = list(rows)
+        return ids, [rows[doc_id][0] for doc_id in ids], [rows[doc_id][1] for doc_id in ids]
 
-        self.collection.add(
-            documents=pl_device_all.select(['combined_text']).to_series().to_list(),
-            metadatas=pl_device_all.select(['Manual_Version', 'Publication_Date', 'Patient_Population']).to_dicts(),
-            # index-1 based
-            ids=pl_device_all.select(['doc_id']).to_series().to_list(),
-        )
+    def sync_index_documents(self) -> dict:
+        """
+        Upsert/delete sync keyed on Device_Name + Model_Number + Manual_Version: only new or edited rows are embedded,
+        rows gone from the CSV are deleted.  The hybrid index is updated from the changes instead of rebuilt from Chroma.
+        """
+        # The current version of the hybrid index, before the collection changes
+        index = self.registry.hybrid_index(self.collection)
+        # Someone else changed the collection since the registry opened the index: it cannot be patched, only rebuilt
+        index_is_current = index.fingerprint == collection_fingerprint(self.collection)
+        ids, documents, metadatas = self.read_device_manuals()
+        indexed = {}
+        offset = 0
+        while True:
+            page = self.collection.get(include=['metadatas'], limit=CHROMA_PAGE_SIZE, offset=offset)
+            if not page['ids']:
+                break
+            for doc_id, metadata in zip(page['ids'], page['metadatas'] or [None] * len(page['ids'])):
+                indexed[doc_id] = (metadata or {}).get('content_hash')
+            offset += len(page['ids'])
+        # Includes the positional ids ('1', '2', ...) of collections loaded before the natural key
+        deleted = set(indexed) - set(ids)
+        changed = [i for i, doc_id in enumerate(ids) if indexed.get(doc_id) != metadatas[i]['content_hash']]
+        stats = {'rows': len(ids), 'unchanged': len(ids) - len(changed), 'upserted': len(changed), 'deleted': len(deleted)}
+        if not changed and not deleted:
+            print(f"---'{self.identity}' is up to date: {stats}---")
+            return stats
+
+        changed_ids = [ids[i] for i in changed]
+        changed_documents = [documents[i] for i in changed]
+        embeddings = self.embedding_model_for_query.encode(changed_documents, batch_size=ENCODE_BATCH_SIZE, convert_to_numpy=True,
+                                                           show_progress_bar=False) if changed else np.zeros((0, 0), dtype=np.float32)
+        for start in range(0, len(changed), EMBED_BATCH_SIZE):
+            self.collection.upsert(ids=changed_ids[start:start + EMBED_BATCH_SIZE],
+                                   documents=changed_documents[start:start + EMBED_BATCH_SIZE],
+                                   metadatas=[metadatas[i] for i in changed[start:start + EMBED_BATCH_SIZE]],
+                                   embeddings=embeddings[start:start + EMBED_BATCH_SIZE])
+        deleted_ids = list(deleted)
+        for start in range(0, len(deleted_ids), EMBED_BATCH_SIZE):
+            self.collection.delete(ids=deleted_ids[start:start + EMBED_BATCH_SIZE])
+
+        mark_collection_written(self.identity)
+        if index_is_current:
+            index.apply_changes(collection_fingerprint(self.collection), deleted, changed_ids, changed_documents, embeddings,
+                                freshness_key(self.collection))
+        # Sessions built from now on open the new version of the hybrid index
+        self.registry.invalidate(self.identity)
+        print(f"---Synced '{self.identity}': {stats}---")
+        return stats
 
     def retrieve_semantic(self, query: str, n_results: int) -> str:
         embedding = self.embedding_model_for_query.encode(query)
@@ -116,65 +205,227 @@ class MedicalDeviceManualsRetriever:
         documents = results['documents'][0][:]
         distances = results['distances'][0][:]
         return [doc for doc, dist in zip(documents, distances) if dist < self.max_semantic_cosine_distance]
+
+    def retrieve_semantic_batch(self, queries: list[str], n_results: int, q_embs: np.ndarray | None = None) -> list[list[str]]:
+        """retrieve_semantic of many queries with one encode call and one query to Chroma."""
+        if q_embs is None:
+            q_embs = self.embedding_model_for_query.encode(queries, batch_size=ENCODE_BATCH_SIZE)
+        results = self.collection.query(query_embeddings=[q_emb.astype(float) for q_emb in q_embs], n_results=n_results)
+        return [[doc for doc, dist in zip(documents, distances) if dist < self.max_semantic_cosine_distance]
+                for documents, distances in zip(results['documents'], results['distances'])]
         
     def retrieve(self, query: str, k = 3, strategy = SEMANTIC_RETRIEVAL) -> list[str] | None:
         if strategy == SEMANTIC_RETRIEVAL:
             return self.retrieve_semantic(query, k)
-        return self.hybrid_retriever.retrieve(query, k)     
+        return self.hybrid_retriever.retrieve(query, k, use_ann=strategy == HYBRID_ANN_RETRIEVAL_RERANK)
+
+    def retrieve_scored(self, query: str, k = 3, strategy = SEMANTIC_RETRIEVAL) -> list[tuple[str, float | None]] | None:
+        """(document, cross-encoder score).  Semantic retrieval has no re-ranking stage, so its scores are None."""
+        if strategy == SEMANTIC_RETRIEVAL:
+            return [(doc, None) for doc in self.retrieve_semantic(query, k)]
+        return self.hybrid_retriever.retrieve_scored(query, k, use_ann=strategy == HYBRID_ANN_RETRIEVAL_RERANK)
+
+    def retrieve_scored_batch(self, queries: list[str], k = 3, strategy = SEMANTIC_RETRIEVAL,
+                              q_embs: np.ndarray | None = None) -> list[list[tuple[str, float | None]] | None]:
+        """retrieve_scored of many queries.  q_embs, if given, are the query embeddings already computed by the caller."""
+        if strategy == SEMANTIC_RETRIEVAL:
+            return [[(doc, None) for doc in documents] for documents in self.retrieve_semantic_batch(queries, k, q_embs)]
+        return self.hybrid_retriever.retrieve_scored_batch(queries, k, use_ann=strategy == HYBRID_ANN_RETRIEVAL_RERANK, q_embs=q_embs)     
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k largest scores, best first.  argpartition is O(N) where a full argsort is O(N log N)."""
+    if k >= len(scores):
+        return np.argsort(scores)[::-1]
+    top = np.argpartition(scores, -k)[-k:]
+    return top[np.argsort(scores[top])[::-1]]
 
 
 class HybridRetriever:
-    def __init__(self, collection: Collection, embedding_model_for_query, alpha: float = 0.5):
+    # Read-only after construction, so one instance can serve every session
+    def __init__(self, collection: Collection, embedding_model_for_query, alpha: float = 0.5,
+                 index: HybridIndex | None = None, reranker=None, ann_index=None, fusion: str = WEIGHTED_MINMAX_FUSION,
+                 rerank_options: dict | None = None, embedding_precision: str = FLOAT32, rescore: bool = True):
         self.collection = collection
         self.embedding_model_for_query = embedding_model_for_query
-        results = self.collection.get(include=['documents', 'embeddings'])
-        self.documents = results['documents']
-        self.embeddings = results['embeddings']
-        tokenized = [doc.lower().split() for doc in self.documents]
-        self.bm25 = BM25Okapi(tokenized)
+        # Documents, float32 embeddings and BM25 term statistics are memory-mapped from an on-disk artifact.
+        # It is only rebuilt when the content of the collection changes.
+        self.index = index or HybridIndex.open_or_build(self.collection)
+        self.documents = self.index.documents
+        self.embeddings = self.index.embeddings
+        # Vectorized BM25 over a sparse term-document matrix
+        self.bm25 = self.index.bm25
         self.alpha = alpha
-        self.reranker = CrossEncoder("cross-encoder/ms-marco-MiniLM-L-6-v2")
-
-    def search_semantic_matches(self, query: str) -> list[float]:
-        q_emb = self.embedding_model_for_query.encode(query)
-        sem_scores = np.dot(self.embeddings, q_emb)
-        # To avoid divide by zero
-        return (sem_scores - sem_scores.min()) / (sem_scores.max() - sem_scores.min() + 1e-8) 
-
-    def search_keyword_matches(self, query: str) -> list[float] | None:
-        bm25_scores = np.array(self.bm25.get_scores(query.lower().split()))
-        if bm25_scores.max() > 0 :
-            return bm25_scores / (bm25_scores.max() + 1e-8)
+        # weighted_minmax, zscore or rrf (see fusion.py). It can also be chosen per call of retrieve()
+        self.fusion = fusion
+        # Cross-encoder scores are cached per (normalized query, chunk id) by the re-ranking stage
+        self.reranker = CrossEncoderReranker(reranker or shared_registry.cross_encoder(), **(rerank_options or {}))
+        self.ann_index = ann_index
+        # float16 or int8 copies of the embeddings halve or quarter the memory scanned by the exact semantic leg.
+        # With rescore, the best RESCORE_FACTOR x n_candidates of the quantized scan are re-scored at full precision
+        if embedding_precision not in EMBEDDING_STORES:
+            # Fail at startup rather than on the first query
+            raise ValueError(f"Unknown embedding precision '{embedding_precision}'. Choose one of {list(EMBEDDING_STORES)}")
+        self.embedding_precision = embedding_precision
+        self.rescore = rescore
+        self._embedding_store = None
+
+    @property
+    def ann(self):
+        # Loaded (or built) on first use of HYBRID_ANN_RETRIEVAL_RERANK only
+        if self.ann_index is None:
+            self.ann_index = shared_registry.ann_index(self.collection, self.index)
+        return self.ann_index
+
+    @property
+    def embedding_store(self):
+        # Quantized copies are built next to the hybrid index on first use, then shared through the registry
+        if self._embedding_store is None:
+            self._embedding_store = shared_registry.embedding_store(self.index, self.embedding_precision)
+        return self._embedding_store
+
+    def search_semantic_matches(self, q_emb: np.ndarray, n_candidates: int, use_ann: bool = False) -> tuple[np.ndarray, np.ndarray]:
+        """Rows and cosine similarities of the top n_candidates, best first."""
+        if use_ann:
+            return self.ann.search(q_emb, n_candidates)
+        if self.embedding_precision == FLOAT32:
+            sem_scores = np.dot(self.embeddings, q_emb)
         else:
-            # No good keyword matches, # bm25_scores.max() is a guardrail 
-            return None    
-    
-    def search(self, query: str, n_results) -> list[str] | None:
-        norm_sem_scores = self.search_semantic_matches(query)
-        norm_bm25_scores = self.search_keyword_matches(query)
-        if norm_bm25_scores is None:
-            return None
-        combined = self.alpha * norm_sem_scores + (1 - self.alpha) * norm_bm25_scores
-        # I did not set up a guardrail here. Re-ranker seems to be a better guardrail
-        top_k = np.argsort(combined)[::-1][:n_results]
-        
-        return [self.documents[i] for i in top_k]     
+            sem_scores = self.embedding_store.scores(q_emb)
+        return self.top_semantic_matches(sem_scores, q_emb, n_candidates)
+
+    def top_semantic_matches(self, sem_scores: np.ndarray, q_emb: np.ndarray, n_candidates: int) -> tuple[np.ndarray, np.ndarray]:
+        if self.embedding_precision == FLOAT32 or not self.rescore:
+            top = top_k_indices(sem_scores, n_candidates)
+            return top, sem_scores[top]
+        shortlist = top_k_indices(sem_scores, RESCORE_FACTOR * n_candidates)
+        exact_scores = self.embedding_store.exact_scores(shortlist, q_emb)
+        top = top_k_indices(exact_scores, n_candidates)
+        return shortlist[top], exact_scores[top]
+
+    def search_semantic_matches_batch(self, q_embs: np.ndarray, n_candidates: int,
+                                      use_ann: bool = False) -> list[tuple[np.ndarray, np.ndarray]]:
+        """search_semantic_matches of each row of q_embs.  The exact scan is one matrix product per QUERY_BLOCK_SIZE queries."""
+        if use_ann:
+            return self.ann.search_batch(q_embs, n_candidates)
+        matches = []
+        for start in range(0, len(q_embs), QUERY_BLOCK_SIZE):
+            block = q_embs[start:start + QUERY_BLOCK_SIZE]
+            if self.embedding_precision == FLOAT32:
+                sem_scores = np.dot(block, self.embeddings.T)
+            else:
+                sem_scores = self.embedding_store.scores_batch(block)
+            matches.extend(self.top_semantic_matches(scores, q_emb, n_candidates) for scores, q_emb in zip(sem_scores, block))
+        return matches
+
+    @staticmethod
+    def top_keyword_matches(doc_indices: np.ndarray, bm25_scores: np.ndarray, n_candidates: int) -> tuple[np.ndarray, np.ndarray]:
+        # Terms present in most documents get a negative weight from BM25Okapi. Those are no keyword match
+        positive = bm25_scores > 0
+        doc_indices, bm25_scores = doc_indices[positive], bm25_scores[positive]
+        top = top_k_indices(bm25_scores, n_candidates)
+        return doc_indices[top], bm25_scores[top]
+
+    def search_keyword_matches(self, query: str, n_candidates: int) -> tuple[np.ndarray, np.ndarray]:
+        """Rows and BM25 scores of the top n_candidates, best first.  Empty when no document matches a query term."""
+        # Only documents sharing at least one term with the query have a BM25 score.  The rest is 0
+        return self.top_keyword_matches(*self.bm25.get_sparse_scores(tokenize(query)), n_candidates)
+
+    def search_keyword_matches_batch(self, queries: list[str], n_candidates: int) -> list[tuple[np.ndarray, np.ndarray]]:
+        """search_keyword_matches of many queries with one sparse product."""
+        return [self.top_keyword_matches(doc_indices, bm25_scores, n_candidates)
+                for doc_indices, bm25_scores in self.bm25.get_batch_sparse_scores([tokenize(query) for query in queries])]
+
+    def search_rows(self, query: str, n_results, use_ann: bool = False, fusion: str | None = None,
+                    timings: dict | None = None) -> np.ndarray:
+        """Rows of the top n_results by fused score.  timings, if given, collects the seconds spent per stage."""
+        n_candidates = max(LEG_CANDIDATE_FACTOR * n_results, LEG_MIN_CANDIDATES)
+        with timed(timings, 'encode'):
+            q_emb = self.embedding_model_for_query.encode(query)
+        with timed(timings, 'ann' if use_ann else 'dot'):
+            sem_rows, sem_scores = self.search_semantic_matches(q_emb, n_candidates, use_ann)
+        # No keyword match leaves the keyword leg empty. The semantic leg alone still gives candidates to the re-ranker
+        # instead of giving up and falling back to a (slow and costly) web search
+        with timed(timings, 'bm25'):
+            keyword_rows, keyword_scores = self.search_keyword_matches(query, n_candidates)
+        with timed(timings, 'fuse'):
+            rows, fused = fuse(fusion or self.fusion, sem_rows, sem_scores, keyword_rows, keyword_scores, self.alpha)
+            # I did not set up a guardrail here. Re-ranker seems to be a better guardrail
+            return rows[top_k_indices(fused, n_results)]
+
+    def search_rows_batch(self, queries: list[str], n_results, use_ann: bool = False, fusion: str | None = None,
+                          q_embs: np.ndarray | None = None, timings: dict | None = None) -> list[np.ndarray]:
+        """
+        search_rows of many queries: one encode call (skipped when the caller already has q_embs), one matrix product
+        per block of queries for the semantic leg and one sparse product for BM25.  Only the fusion runs per query.
+        """
+        n_candidates = max(LEG_CANDIDATE_FACTOR * n_results, LEG_MIN_CANDIDATES)
+        if q_embs is None:
+            with timed(timings, 'encode'):
+                q_embs = self.embedding_model_for_query.encode(queries, batch_size=ENCODE_BATCH_SIZE)
+        with timed(timings, 'ann' if use_ann else 'dot'):
+            semantic_matches = self.search_semantic_matches_batch(np.asarray(q_embs), n_candidates, use_ann)
+        with timed(timings, 'bm25'):
+            keyword_matches = self.search_keyword_matches_batch(queries, n_candidates)
+        all_rows = []
+        with timed(timings, 'fuse'):
+            for (sem_rows, sem_scores), (keyword_rows, keyword_scores) in zip(semantic_matches, keyword_matches):
+                rows, fused = fuse(fusion or self.fusion, sem_rows, sem_scores, keyword_rows, keyword_scores, self.alpha)
+                all_rows.append(rows[top_k_indices(fused, n_results)])
+        return all_rows
 
-    def retrieve(self, query: str, k = 3) -> list[str] | None:
-        candidates = self.search(query, n_results=k * 3)
-        if not candidates:
+    def search(self, query: str, n_results, use_ann: bool = False, fusion: str | None = None) -> list[str]:
+        return [self.documents[i] for i in self.search_rows(query, n_results, use_ann, fusion)]
+
+    def retrieve_rows(self, query: str, k = 3, use_ann: bool = False, fusion: str | None = None,
+                      timings: dict | None = None) -> list[tuple[int, float | None]] | None:
+        """(row, cross-encoder score) of the final results.  Score is None when there were too few candidates to rerank."""
+        rows = self.search_rows(query, n_results=k * 3, use_ann=use_ann, fusion=fusion, timings=timings)
+        if not len(rows):
             return None
-        if len(candidates) <= k:
-            return candidates
+        if len(rows) <= k:
+            return [(int(row), None) for row in rows]
         else:
-            # Rerank with cross-encoder (expensive, accurate). Do that only when it is necessary. 
+            # Rerank with cross-encoder (expensive, accurate). Do that only when it is necessary.
             # In a practice, it's like relevance check and re-rank to me
-            pairs = [(query, doc) for doc in candidates]
-            scores = self.reranker.predict(pairs)
-            reranked = sorted(zip(candidates, scores), key=lambda x: x[1], reverse=True)
-            # score > 0 is a guardrail 
-            return [doc for doc, score in reranked if score > 0][:k]
-    
+            candidates = [(self.index.ids[i], self.documents[i]) for i in rows]
+            with timed(timings, 'rerank'):
+                reranked = self.reranker.rerank(query, candidates, k)
+            return [(int(rows[position]), score) for position, score in reranked]
+
+    def retrieve_rows_batch(self, queries: list[str], k = 3, use_ann: bool = False, fusion: str | None = None,
+                            q_embs: np.ndarray | None = None, timings: dict | None = None) -> list[list[tuple[int, float | None]] | None]:
+        """retrieve_rows of many queries.  The candidates of every query are re-ranked by one cross-encoder pass."""
+        all_rows = self.search_rows_batch(queries, k * 3, use_ann, fusion, q_embs, timings)
+        results = [[(int(row), None) for row in rows] if len(rows) else None for rows in all_rows]
+        to_rerank = [i for i, rows in enumerate(all_rows) if len(rows) > k]
+        if to_rerank:
+            items = [(queries[i], [(self.index.ids[row], self.documents[row]) for row in all_rows[i]]) for i in to_rerank]
+            with timed(timings, 'rerank'):
+                reranked = self.reranker.rerank_batch(items, k)
+            for i, query_reranked in zip(to_rerank, reranked):
+                results[i] = [(int(all_rows[i][position]), score) for position, score in query_reranked]
+        return results
+
+    def retrieve_scored_batch(self, queries: list[str], k = 3, use_ann: bool = False, fusion: str | None = None,
+                              q_embs: np.ndarray | None = None) -> list[list[tuple[str, float | None]] | None]:
+        return [None if results is None else [(self.documents[row], score) for row, score in results]
+                for results in self.retrieve_rows_batch(queries, k, use_ann, fusion, q_embs)]
+
+    def retrieve_scored(self, query: str, k = 3, use_ann: bool = False,
+                        fusion: str | None = None) -> list[tuple[str, float | None]] | None:
+        """(document, cross-encoder score) of the final results.  The relevance gate of AgenticRAG reuses the scores."""
+        results = self.retrieve_rows(query, k, use_ann, fusion)
+        if results is None:
+            return None
+        return [(self.documents[row], score) for row, score in results]
+
+    def retrieve(self, query: str, k = 3, use_ann: bool = False, fusion: str | None = None) -> list[str] | None:
+        results = self.retrieve_scored(query, k, use_ann, fusion)
+        if results is None:
+            return None
+        return [doc for doc, _ in results]
+
 if __name__ == "__main__":
     medical_qna_retriever = MedicalDiseaseQAndARetriever()
     # medical_qna_retriever.load_index_documents()
@@ -208,4 +459,7 @@ if __name__ == "__main__":
     else:
         print("Nothing qualified to retrieve")    
 
-    
\ No newline at end of file
+    
+    # The second time, the cross-encoder scores of the popular question come from the cache
+    medical_qna_retriever.retrieve("how do patients contract Hantavirus pulmonary syndrome", strategy = HYBRID_RETRIEVAL_RERANK)
+    print(f'Re-ranking metrics: {medical_qna_retriever.hybrid_retriever.reranker.metrics.snapshot()}')
@@ -0,0 +1,56 @@
+import threading
+import numpy as np
+from hybrid_index import HybridIndex
+
+# Routing modes of AgenticRAG
+LLM_ROUTING = "llm"
+EMBEDDING_ROUTING = "embedding"
+# Embedding router, but a question it cannot decide is sent to both collections at once instead of the LLM router
+FANOUT_ROUTING = "fanout"
+
+# Minimum gap between the cosine similarities of the best and the second best centroid to trust the embedding router.
+# Below it, the question looks like both collections and the LLM router decides
+ROUTER_MIN_MARGIN = 0.05
+# Chunks averaged per step, so a 1M-chunk memory-mapped matrix is never copied as a whole
+CENTROID_BATCH_SIZE = 100_000
+
+
+def centroid(embeddings: np.ndarray, batch_size: int = CENTROID_BATCH_SIZE) -> np.ndarray:
+    """Normalized mean of the normalized embeddings of a collection."""
+    total = np.zeros(embeddings.shape[1], dtype=np.float64)
+    for start in range(0, len(embeddings), batch_size):
+        batch = np.asarray(embeddings[start:start + batch_size], dtype=np.float32)
+        total += (batch / (np.linalg.norm(batch, axis=1, keepdims=True) + 1e-8)).sum(axis=0)
+    return (total / (np.linalg.norm(total) + 1e-8)).astype(np.float32)
+
+
+class CentroidRouter:
+    """
+    Routes a question to the collection whose embedding centroid is the closest: one dot product per collection
+    instead of an LLM round-trip.  route() returns None when the margin is too small to decide.
+    """
+    def __init__(self, centroids: dict[str, np.ndarray], min_margin: float = ROUTER_MIN_MARGIN):
+        self.sources = list(centroids)
+        self.centroids = np.stack([centroids[source] for source in self.sources])
+        self.min_margin = min_margin
+        self._lock = threading.Lock()
+        self.counts = {EMBEDDING_ROUTING: 0, LLM_ROUTING: 0, FANOUT_ROUTING: 0}
+
+    @classmethod
+    def from_indexes(cls, indexes: dict[str, HybridIndex], min_margin: float = ROUTER_MIN_MARGIN):
+        """Centroids of the embeddings of the hybrid indexes, keyed by the source name of each collection."""
+        return cls({source: centroid(index.embeddings) for source, index in indexes.items()}, min_margin)
+
+    def route(self, q_emb: np.ndarray) -> tuple[str | None, float]:
+        """(source, margin).  source is None when the LLM router has to decide."""
+        q_emb = np.asarray(q_emb, dtype=np.float32)
+        similarities = self.centroids @ (q_emb / (np.linalg.norm(q_emb) + 1e-8))
+        order = np.argsort(similarities)[::-1]
+        margin = float(similarities[order[0]] - similarities[order[1]]) if len(order) > 1 else float('inf')
+        return (self.sources[order[0]] if margin >= self.min_margin else None), margin
+
+    def record(self, path: str) -> dict:
+        """Count a routing decision taken by path (EMBEDDING_ROUTING, LLM_ROUTING or FANOUT_ROUTING) and return the counts."""
+        with self._lock:
+            self.counts[path] += 1
+            return dict(self.counts)
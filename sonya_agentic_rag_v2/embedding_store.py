@@ -0,0 +1,152 @@
+import os
+import uuid
+import numpy as np
+from hybrid_index import HybridIndex
+
+# Precision of the embedding matrix scanned by the exact semantic leg of HybridRetriever
+FLOAT32 = "float32"
+FLOAT16 = "float16"
+INT8 = "int8"
+
+# Rows converted to float32 at once while scanning a quantized matrix.  Small enough for the float32 scratch block
+# to stay in the CPU cache between the conversion and the dot product (65536-row blocks were ~3x slower on int8)
+SCAN_BLOCK_ROWS = 4096
+# Rows quantized at once when a quantized copy is built
+QUANTIZE_BLOCK_ROWS = 65_536
+# Candidates re-scored at full precision per candidate requested, when rescoring is on
+RESCORE_FACTOR = 4
+
+
+def _save_atomic(path: str, array: np.ndarray):
+    tmp_path = f'{path}.tmp-{uuid.uuid4().hex}.npy'
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+def _write_blockwise(path: str, embeddings: np.ndarray, dtype, convert):
+    """Write convert(block) of every block of rows to a .npy, without holding the converted matrix in memory."""
+    tmp_path = f'{path}.tmp-{uuid.uuid4().hex}.npy'
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=embeddings.shape)
+    for start in range(0, len(embeddings), QUANTIZE_BLOCK_ROWS):
+        block = np.asarray(embeddings[start:start + QUANTIZE_BLOCK_ROWS], dtype=np.float32)
+        out[start:start + len(block)] = convert(block)
+    out.flush()
+    del out
+    os.replace(tmp_path, path)
+
+
+def _scan(codes: np.ndarray, q_emb: np.ndarray, bias: float | np.ndarray = 0.0) -> np.ndarray:
+    """
+    codes @ q_emb + bias, converting one block of rows at a time into a reused float32 scratch block.
+    q_emb can also be a (dimension, n_queries) matrix: each block is then converted once for all the queries.
+    """
+    scores = np.empty((len(codes),) + q_emb.shape[1:], dtype=np.float32)
+    scratch = np.empty((min(SCAN_BLOCK_ROWS, len(codes)), codes.shape[1]), dtype=np.float32)
+    for start in range(0, len(codes), SCAN_BLOCK_ROWS):
+        block = codes[start:start + SCAN_BLOCK_ROWS]
+        converted = scratch[:len(block)]
+        np.copyto(converted, block, casting='unsafe')
+        np.dot(converted, q_emb, out=scores[start:start + len(block)])
+    if np.any(bias):
+        scores += bias
+    return scores
+
+
+class Float32Store:
+    """The float32 matrix of the hybrid index itself: 4 bytes per dimension."""
+    precision = FLOAT32
+
+    def __init__(self, index: HybridIndex):
+        self.index = index
+        self.embeddings = index.embeddings
+
+    @property
+    def nbytes(self) -> int:
+        return self.embeddings.nbytes
+
+    def scores(self, q_emb: np.ndarray) -> np.ndarray:
+        return np.dot(self.embeddings, q_emb)
+
+    def scores_batch(self, q_embs: np.ndarray) -> np.ndarray:
+        """(n_queries, n_documents) scores of the rows of q_embs: one matrix product instead of one scan per query."""
+        return np.dot(q_embs, self.embeddings.T)
+
+    def exact_scores(self, rows: np.ndarray, q_emb: np.ndarray) -> np.ndarray:
+        """Full-precision scores of a few rows.  Only their pages of the float32 memmap are read."""
+        return np.dot(np.asarray(self.index.embeddings[np.sort(rows)]), q_emb)[np.argsort(np.argsort(rows))]
+
+
+class Float16Store(Float32Store):
+    """Half-precision copy: 2 bytes per dimension, ~1e-3 relative error on cosine similarities."""
+    precision = FLOAT16
+
+    def __init__(self, index: HybridIndex):
+        super().__init__(index)
+        path = os.path.join(index.path, 'embeddings_f16.npy')
+        if not os.path.exists(path):
+            _write_blockwise(path, index.embeddings, np.float16, lambda block: block.astype(np.float16))
+        self.embeddings = np.load(path, mmap_mode='r')
+
+    def scores(self, q_emb: np.ndarray) -> np.ndarray:
+        return _scan(self.embeddings, np.asarray(q_emb, dtype=np.float32))
+
+    def scores_batch(self, q_embs: np.ndarray) -> np.ndarray:
+        return _scan(self.embeddings, np.ascontiguousarray(np.asarray(q_embs, dtype=np.float32).T)).T
+
+
+class Int8Store(Float32Store):
+    """
+    Scalar quantization: each dimension d is mapped linearly from [min_d, max_d] to 256 levels, 1 byte per dimension.
+    With x_d = offset_d + scale_d * code_d, the dot product is codes @ (q * scale) + q @ offset.
+    """
+    precision = INT8
+
+    def __init__(self, index: HybridIndex):
+        super().__init__(index)
+        codes_path = os.path.join(index.path, 'embeddings_int8.npy')
+        calibration_path = os.path.join(index.path, 'embeddings_int8_calibration.npy')
+        if not os.path.exists(codes_path) or not os.path.exists(calibration_path):
+            self._quantize(codes_path, calibration_path)
+        self.embeddings = np.load(codes_path, mmap_mode='r')
+        self.offset, self.scale = np.load(calibration_path)
+
+    def _quantize(self, codes_path: str, calibration_path: str):
+        embeddings = self.index.embeddings
+        low = np.full(embeddings.shape[1], np.inf, dtype=np.float32)
+        high = np.full(embeddings.shape[1], -np.inf, dtype=np.float32)
+        for start in range(0, len(embeddings), QUANTIZE_BLOCK_ROWS):
+            block = np.asarray(embeddings[start:start + QUANTIZE_BLOCK_ROWS])
+            low = np.minimum(low, block.min(axis=0))
+            high = np.maximum(high, block.max(axis=0))
+        scale = np.maximum(high - low, 1e-12) / 255
+        # codes are stored as int8 (-128..127) so the offset of the dequantization absorbs the shift of 128
+        offset = low + 128 * scale
+        _write_blockwise(codes_path, embeddings, np.int8,
+                         lambda block: np.clip(np.rint((block - low) / scale) - 128, -128, 127).astype(np.int8))
+        _save_atomic(calibration_path, np.stack([offset, scale]).astype(np.float32))
+
+    def scores(self, q_emb: np.ndarray) -> np.ndarray:
+        q_emb = np.asarray(q_emb, dtype=np.float32)
+        return _scan(self.embeddings, (q_emb * self.scale).astype(np.float32), float(q_emb @ self.offset))
+
+    def scores_batch(self, q_embs: np.ndarray) -> np.ndarray:
+        q_embs = np.asarray(q_embs, dtype=np.float32)
+        return _scan(self.embeddings, np.ascontiguousarray((q_embs * self.scale).T), q_embs @ self.offset).T
+
+
+EMBEDDING_STORES = {FLOAT32: Float32Store, FLOAT16: Float16Store, INT8: Int8Store}
+
+
+def default_embedding_precision() -> str:
+    """Precision of the retrievers built by the app: EMBEDDING_PRECISION=float16|int8 (env or .env), float32 otherwise."""
+    return os.environ.get('EMBEDDING_PRECISION', FLOAT32)
+
+
+def open_embedding_store(index: HybridIndex, precision: str = FLOAT32):
+    """The embedding matrix of a hybrid index at the given precision.  Quantized copies are built once, next to it."""
+    if precision not in EMBEDDING_STORES:
+        raise ValueError(f"Unknown embedding precision '{precision}'. Choose one of {list(EMBEDDING_STORES)}")
+    if not len(index):
+        # Nothing to quantize (and numpy cannot memory-map an empty file)
+        return Float32Store(index)
+    return EMBEDDING_STORES[precision](index)
@@ -0,0 +1,338 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from documents_retrievers import MedicalDiseaseQAndARetriever, MedicalDeviceManualsRetriever, SEMANTIC_RETRIEVAL, \
+    HYBRID_RETRIEVAL_RERANK, HYBRID_ANN_RETRIEVAL_RERANK
+from hybrid_index import CHROMA_PAGE_SIZE
+from relevance_gate import RelevanceGate, calibrate, relevance_gate_path, RELEVANCE_TARGET_PRECISION, CROSS_ENCODER_RELEVANCE
+from embedding_router import EMBEDDING_ROUTING
+from resource_registry import shared_registry
+from stage_timings import timed
+
+# Replays a labeled query set against both collections with every retrieval strategy and reports
+#   - p50/p95/p99 latency of each stage (encode, dot/ann, bm25, fuse, rerank; encode and chroma for semantic retrieval)
+#   - throughput (QPS) with concurrent callers
+#   - memory footprint of the process and of the hybrid indexes
+#   - recall@k, hit@k and MRR against the labels
+# With --graph it also runs the whole Agentic RAG graph with fake LLMs (router, relevance grader, llama3.2) and the
+# offline web search backend, so it needs neither network nor API keys.  Models and ChromaDB are the real ones.
+# With --calibrate-relevance it fits the thresholds of the cross-encoder relevance gate on the labeled queries and
+# saves them where AgenticRAG loads them from.
+#
+#   python evaluation.py --n-queries 200 --k 3 --concurrency 8 --calibrate-relevance --graph
+#
+# Labeled queries are JSONL lines {"query": ..., "source": "medical_disease_qna", "relevant_ids": [...]}.  Without
+# --queries, they are sampled from the collections: the 'Question' metadata of a Q&A chunk is a query whose relevant
+# ids are every chunk of its answer, and a device manual id (Device_Name|Model_Number|Manual_Version) becomes
+# 'What is <device> <model> indicated for?'.
+
+RETRIEVERS = {
+    "medical_disease_qna": MedicalDiseaseQAndARetriever,
+    "medical_device_manuals": MedicalDeviceManualsRetriever,
+}
+STRATEGIES = [SEMANTIC_RETRIEVAL, HYBRID_RETRIEVAL_RERANK, HYBRID_ANN_RETRIEVAL_RERANK]
+FAKE_ANSWER = "This is an offline answer from the fake generator of evaluation.py, cited from the retrieved context."
+
+
+###########################################################
+#####  Labeled queries
+###########################################################
+def load_labeled_queries(path: str) -> list[dict]:
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def sample_labeled_queries(retrievers: dict, n_queries: int, seed: int = 42) -> list[dict]:
+    rng = random.Random(seed)
+    ids_by_question = {}
+    collection = retrievers["medical_disease_qna"].collection
+    offset = 0
+    while True:
+        page = collection.get(include=['metadatas'], limit=CHROMA_PAGE_SIZE, offset=offset)
+        if not page['ids']:
+            break
+        for doc_id, metadata in zip(page['ids'], page['metadatas'] or [None] * len(page['ids'])):
+            if metadata and metadata.get('Question'):
+                ids_by_question.setdefault(metadata['Question'], []).append(doc_id)
+        offset += len(page['ids'])
+    device_ids = [doc_id for doc_id in retrievers["medical_device_manuals"].collection.get(include=[])['ids'] if '|' in doc_id]
+
+    n_devices = min(len(device_ids), n_queries // 2)
+    questions = rng.sample(sorted(ids_by_question), min(len(ids_by_question), n_queries - n_devices))
+    labeled = [{"query": question, "source": "medical_disease_qna", "relevant_ids": ids_by_question[question]}
+               for question in questions]
+    for doc_id in rng.sample(sorted(device_ids), n_devices):
+        device, model, _ = doc_id.split('|', 2)
+        labeled.append({"query": f"What is {device} {model} indicated for?", "source": "medical_device_manuals",
+                        "relevant_ids": [doc_id]})
+    rng.shuffle(labeled)
+    return labeled
+
+
+###########################################################
+#####  Retrieval
+###########################################################
+def ranked_ids(retriever, strategy: str, query: str, k: int, timings: dict | None = None) -> list[str]:
+    """Ids of the documents retriever.retrieve(query, k, strategy) would return, in order."""
+    if strategy == SEMANTIC_RETRIEVAL:
+        # Same as retrieve_semantic, but keeps the ids
+        with timed(timings, 'encode'):
+            embedding = retriever.embedding_model_for_query.encode(query)
+        with timed(timings, 'chroma'):
+            results = retriever.collection.query(query_embeddings=[embedding.astype(float)], n_results=k, include=['distances'])
+        return [doc_id for doc_id, dist in zip(results['ids'][0], results['distances'][0])
+                if dist < retriever.max_semantic_cosine_distance]
+    hybrid = retriever.hybrid_retriever
+    results = hybrid.retrieve_rows(query, k, use_ann=strategy == HYBRID_ANN_RETRIEVAL_RERANK, timings=timings) or []
+    return [hybrid.index.ids[row] for row, _ in results]
+
+
+def percentiles_ms(seconds: list[float]) -> dict:
+    if not seconds:
+        return {}
+    p50, p95, p99 = np.percentile(np.asarray(seconds) * 1000, [50, 95, 99])
+    return {"p50_ms": round(float(p50), 2), "p95_ms": round(float(p95), 2), "p99_ms": round(float(p99), 2)}
+
+
+def quality(labeled: list[dict], rankings: list[list[str]], k: int) -> dict:
+    recalls, hits, reciprocal_ranks = [], [], []
+    for item, ranking in zip(labeled, rankings):
+        relevant = set(item["relevant_ids"])
+        found = [rank for rank, doc_id in enumerate(ranking[:k], start=1) if doc_id in relevant]
+        recalls.append(len(found) / len(relevant))
+        hits.append(1.0 if found else 0.0)
+        reciprocal_ranks.append(1.0 / found[0] if found else 0.0)
+    return {f"recall@{k}": round(float(np.mean(recalls)), 4), f"hit@{k}": round(float(np.mean(hits)), 4),
+            "mrr": round(float(np.mean(reciprocal_ranks)), 4)}
+
+
+def evaluate_strategy(retrievers: dict, labeled: list[dict], strategy: str, k: int, concurrency: int) -> dict:
+    # Warm up: hnswlib index, page cache of the memory-mapped arrays and the models
+    for item in labeled[:3]:
+        ranked_ids(retrievers[item["source"]], strategy, item["query"], k)
+    # Warm up already filled the cross-encoder caches of these queries. Score everything from scratch
+    for retriever in retrievers.values():
+        retriever.hybrid_retriever.reranker.cache.clear()
+
+    stage_seconds, totals, rankings = {}, [], []
+    for item in labeled:
+        timings = {}
+        started = time.perf_counter()
+        rankings.append(ranked_ids(retrievers[item["source"]], strategy, item["query"], k, timings))
+        totals.append(time.perf_counter() - started)
+        for stage, seconds in timings.items():
+            stage_seconds.setdefault(stage, []).append(seconds)
+
+    # Throughput: concurrent callers like Gradio sessions sharing the retrievers.  Reranking is served from the cache now,
+    # so this is the throughput of popular questions
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(lambda item: ranked_ids(retrievers[item["source"]], strategy, item["query"], k), labeled))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "strategy": strategy,
+        "queries": len(labeled),
+        "total": percentiles_ms(totals),
+        "stages": {stage: percentiles_ms(seconds) for stage, seconds in stage_seconds.items()},
+        f"qps@{concurrency}": round(len(labeled) / elapsed, 1),
+        **quality(labeled, rankings, k),
+    }
+
+
+def memory_footprint(retrievers: dict) -> dict:
+    def rss_mb():
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    footprint = {}
+    try:
+        footprint["rss_mb"] = round(rss_mb(), 1)
+    except OSError:
+        # Not Linux
+        pass
+    # ru_maxrss is in KB on Linux, in bytes on macOS
+    footprint["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    for source, retriever in retrievers.items():
+        path = retriever.hybrid_retriever.index.path
+        size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+        footprint[f"{source}_index_mb"] = round(size / 2**20, 1)
+    return footprint
+
+
+###########################################################
+#####  Relevance gate calibration
+###########################################################
+def calibrate_relevance_gate(retrievers: dict, labeled: list[dict], k: int, target_precision: float,
+                             path: str = relevance_gate_path) -> dict:
+    """
+    Best cross-encoder score of the top k hybrid results of every labeled query, from its own collection (relevant when
+    a labeled id is among them) and from the other collection (irrelevant).  The score of a (query, chunk) pair does
+    not depend on the strategy that retrieved the chunk, so the thresholds serve every strategy.
+    """
+    best_scores, labels = [], []
+    for item in labeled:
+        relevant = set(item["relevant_ids"])
+        for source, retriever in retrievers.items():
+            hybrid = retriever.hybrid_retriever
+            results = hybrid.retrieve_rows(item["query"], k)
+            if not results:
+                # Nothing passed the re-ranking guardrail: the graph falls back to web search without asking the gate
+                continue
+            rows = [row for row, _ in results]
+            scores = [score for _, score in results]
+            missing = [i for i, score in enumerate(scores) if score is None]
+            if missing:
+                candidates = [(hybrid.index.ids[rows[i]], hybrid.documents[rows[i]]) for i in missing]
+                for i, score in zip(missing, hybrid.reranker.score(item["query"], candidates, len(candidates))):
+                    scores[i] = score
+            best_scores.append(max(scores))
+            labels.append(source == item["source"] and any(hybrid.index.ids[row] in relevant for row in rows))
+
+    accept_score, reject_score = calibrate(best_scores, labels, target_precision)
+    gate = RelevanceGate(accept_score, reject_score)
+    decided = [(decision, label) for decision, label in zip(map(gate.decide, best_scores), labels) if decision is not None]
+    result = {
+        "contexts": len(labels),
+        "relevant": int(sum(labels)),
+        "target_precision": target_precision,
+        "accept_score": round(accept_score, 3),
+        "reject_score": round(reject_score, 3),
+        # Share of the relevance checks that no longer need the LLM grader, and how often the gate agrees with the labels
+        "decided_locally": round(len(decided) / len(labels), 4) if labels else 0.0,
+        "local_accuracy": round(float(np.mean([decision == label for decision, label in decided])), 4) if decided else None,
+    }
+    gate.save(path, **{key: value for key, value in result.items() if key not in ("accept_score", "reject_score")})
+    return result
+
+
+###########################################################
+#####  Whole graph with fake LLMs
+###########################################################
+class FakeStructuredLLM:
+    """Stands in for ChatOpenAI(...).with_structured_output(schema)."""
+    def __init__(self, answer, latency: float):
+        self.answer = answer
+        self.latency = latency
+
+    async def ainvoke(self, messages):
+        await asyncio.sleep(self.latency)
+        return self.answer(messages[-1].content)
+
+
+class FakeStreamingChat:
+    """Stands in for AsyncOpenAI(base_url=<ollama>): streams FAKE_ANSWER word by word."""
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.chat = self
+        self.completions = self
+
+    async def create(self, model, messages, stream=False, **kwargs):
+        from types import SimpleNamespace
+        await asyncio.sleep(self.latency)
+
+        async def chunks():
+            for word in FAKE_ANSWER.split():
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word + ' '))])
+        return chunks()
+
+
+async def offline_agentic_rag(strategy: str, llm_latency: float, search_backend, search_cache,
+                              routing: str = EMBEDDING_ROUTING, relevance: str = CROSS_ENCODER_RELEVANCE):
+    # Imported here: the retrieval part of the suite does not need LangGraph nor the OpenAI clients
+    from agentic_rag import AgenticRAG, RouteOutput, RelevanceOutput, source_disease_qna, source_device_manuals, YES
+    agentic_rag = AgenticRAG()
+    await agentic_rag.setup_retrievers(strategy, routing, relevance)
+    # Only used when the embedding router is unsure
+    agentic_rag.router_llm_with_output = FakeStructuredLLM(lambda prompt: RouteOutput(
+        datasource=source_device_manuals if any(word in prompt.lower() for word in ['device', 'model', 'manual'])
+        else source_disease_qna), llm_latency)
+    agentic_rag.checker_llm_with_output = FakeStructuredLLM(lambda prompt: RelevanceOutput(binary_score=YES), llm_latency)
+    agentic_rag.ollama_via_openai = FakeStreamingChat(llm_latency)
+    # Real cache and compaction, offline backend.  The cache is in memory: stub snippets must not reach the app's cache
+    agentic_rag.search_tool = agentic_rag.build_search_tool(search_backend, search_cache)
+    await agentic_rag.build_graph()
+    return agentic_rag
+
+
+async def evaluate_graph(labeled: list[dict], strategy: str, concurrency: int, llm_latency: float) -> dict:
+    from agentic_rag import GenerationToken
+    from web_search import StubSearchBackend, WebSearchCache
+    semaphore = asyncio.Semaphore(concurrency)
+    search_backend, search_cache = StubSearchBackend(latency=llm_latency), WebSearchCache(path=None)
+    gate_counts = dict(shared_registry.relevance_gate().counts)
+    latencies, ttfts = [], []
+
+    async def session(query: str):
+        async with semaphore:
+            # One session per question, like a new browser tab. run_graph skips the semantic cache
+            agentic_rag = await offline_agentic_rag(strategy, llm_latency, search_backend, search_cache)
+            started = time.perf_counter()
+            first_token = None
+            async for message in agentic_rag.run_graph(query):
+                if first_token is None and isinstance(message, GenerationToken):
+                    first_token = time.perf_counter() - started
+            latencies.append(time.perf_counter() - started)
+            if first_token is not None:
+                ttfts.append(first_token)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[session(item["query"]) for item in labeled])
+    elapsed = time.perf_counter() - started
+    # Relevance checks decided by the cross-encoder gate (accepted/rejected) or sent to the (fake) LLM grader
+    gate_counts = {path: count - gate_counts[path] for path, count in shared_registry.relevance_gate().counts.items()}
+    return {"strategy": strategy, "queries": len(labeled), "total": percentiles_ms(latencies),
+            "time_to_first_token": percentiles_ms(ttfts), f"qps@{concurrency}": round(len(labeled) / elapsed, 1),
+            "relevance_gate": gate_counts, "web_search_calls": search_backend.calls}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latency, throughput, memory and recall@k/MRR of the retrieval strategies")
+    parser.add_argument("--queries", help="labeled queries (JSONL). Sampled from the collections when omitted")
+    parser.add_argument("--save-queries", help="write the sampled labeled queries to this JSONL file")
+    parser.add_argument("--n-queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--strategies", nargs="+", choices=STRATEGIES, default=STRATEGIES)
+    parser.add_argument("--graph", action="store_true", help="also run the whole graph with fake LLMs")
+    parser.add_argument("--fake-llm-latency", type=float, default=0.2, help="seconds of each fake LLM or web call")
+    parser.add_argument("--calibrate-relevance", action="store_true",
+                        help=f"fit the thresholds of the cross-encoder relevance gate and save them to {relevance_gate_path}")
+    parser.add_argument("--target-precision", type=float, default=RELEVANCE_TARGET_PRECISION,
+                        help="precision the gate must reach on the contexts it accepts or rejects without the LLM grader")
+    parser.add_argument("--output", help="write the report as JSON")
+    args = parser.parse_args()
+
+    retrievers = {source: shared_registry.retriever(cls) for source, cls in RETRIEVERS.items()}
+    if args.queries:
+        labeled = load_labeled_queries(args.queries)
+    else:
+        labeled = sample_labeled_queries(retrievers, args.n_queries)
+        if args.save_queries:
+            with open(args.save_queries, 'w', encoding='utf-8') as f:
+                f.writelines(json.dumps(item) + '\n' for item in labeled)
+    print(f"---Evaluating {len(labeled)} labeled queries, k={args.k}---")
+
+    report = {"retrieval": [], "graph": []}
+    for strategy in args.strategies:
+        result = evaluate_strategy(retrievers, labeled, strategy, args.k, args.concurrency)
+        report["retrieval"].append(result)
+        print(json.dumps(result, indent=2))
+    report["memory"] = memory_footprint(retrievers)
+    print(json.dumps(report["memory"], indent=2))
+    if args.calibrate_relevance:
+        report["relevance_gate"] = calibrate_relevance_gate(retrievers, labeled, args.k, args.target_precision)
+        print(json.dumps(report["relevance_gate"], indent=2))
+    if args.graph:
+        for strategy in args.strategies:
+            result = asyncio.run(evaluate_graph(labeled, strategy, args.concurrency, args.fake_llm_latency))
+            report["graph"].append(result)
+            print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
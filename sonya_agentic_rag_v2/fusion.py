@@ -0,0 +1,67 @@
+import numpy as np
+
+# Score fusion strategies of HybridRetriever.  Each one only sees the top-N candidate list of each leg
+# (rows of the hybrid index plus their raw scores, best first), never full-corpus score vectors.
+WEIGHTED_MINMAX_FUSION = "weighted_minmax"
+ZSCORE_FUSION = "zscore"
+RRF_FUSION = "rrf"
+
+# The usual constant of reciprocal rank fusion. It damps the weight of the very first ranks
+RRF_K = 60
+
+
+def _union(sem_rows: np.ndarray, keyword_rows: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Candidate rows of both legs plus the position of each leg's rows among them."""
+    rows = np.union1d(sem_rows, keyword_rows)
+    return rows, np.searchsorted(rows, sem_rows), np.searchsorted(rows, keyword_rows)
+
+
+def weighted_minmax_fusion(sem_rows, sem_scores, keyword_rows, keyword_scores, alpha: float):
+    """The original fusion: alpha * min-max normalized cosine + (1 - alpha) * BM25 divided by its max."""
+    rows, sem_positions, keyword_positions = _union(sem_rows, keyword_rows)
+    fused = np.zeros(len(rows))
+    if len(sem_scores):
+        # To avoid divide by zero
+        fused[sem_positions] += alpha * (sem_scores - sem_scores.min()) / (sem_scores.max() - sem_scores.min() + 1e-8)
+    if len(keyword_scores):
+        fused[keyword_positions] += (1 - alpha) * keyword_scores / (keyword_scores.max() + 1e-8)
+    return rows, fused
+
+
+def zscore_fusion(sem_rows, sem_scores, keyword_rows, keyword_scores, alpha: float):
+    """Weighted sum of z-scores.  Less sensitive than min-max to a single outlier score of a leg."""
+    rows, sem_positions, keyword_positions = _union(sem_rows, keyword_rows)
+    fused = np.zeros(len(rows))
+    for weight, positions, scores in [(alpha, sem_positions, sem_scores), (1 - alpha, keyword_positions, keyword_scores)]:
+        if not len(scores):
+            continue
+        z = (scores - scores.mean()) / (scores.std() + 1e-8)
+        # A candidate missing from this leg ranks below everything the leg returned
+        leg = np.full(len(rows), z.min())
+        leg[positions] = z
+        fused += weight * leg
+    return rows, fused
+
+
+def reciprocal_rank_fusion(sem_rows, sem_scores, keyword_rows, keyword_scores, alpha: float):
+    """Weighted RRF: sum of weight / (RRF_K + rank).  Only ranks matter, so the two score scales never need to agree."""
+    rows, sem_positions, keyword_positions = _union(sem_rows, keyword_rows)
+    fused = np.zeros(len(rows))
+    fused[sem_positions] += alpha / (RRF_K + 1 + np.arange(len(sem_rows)))
+    fused[keyword_positions] += (1 - alpha) / (RRF_K + 1 + np.arange(len(keyword_rows)))
+    return rows, fused
+
+
+FUSION_STRATEGIES = {
+    WEIGHTED_MINMAX_FUSION: weighted_minmax_fusion,
+    ZSCORE_FUSION: zscore_fusion,
+    RRF_FUSION: reciprocal_rank_fusion,
+}
+
+
+def fuse(strategy: str, sem_rows: np.ndarray, sem_scores: np.ndarray, keyword_rows: np.ndarray,
+         keyword_scores: np.ndarray, alpha: float) -> tuple[np.ndarray, np.ndarray]:
+    """Fused (rows, scores) of the union of both candidate lists. Either leg may be empty."""
+    if strategy not in FUSION_STRATEGIES:
+        raise ValueError(f"Unknown fusion strategy '{strategy}'. Choose one of {list(FUSION_STRATEGIES)}")
+    return FUSION_STRATEGIES[strategy](sem_rows, sem_scores, keyword_rows, keyword_scores, alpha)
@@ -0,0 +1,404 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from datetime import datetime, timezone
+
+import numpy as np
+from scipy.sparse import csr_matrix, hstack
+from chromadb.api.models.Collection import Collection
+from bm25 import SparseBM25, bm25_weights, tokenize
+
+hybrid_index_root_path = "./hybrid_index"
+
+# Bump when the on-disk layout changes. Artifacts of another version are rebuilt, and the rebuild replaces them even
+# when the content, hence the fingerprint directory, is the same.  2: precomputed bm25_weights.npy
+INDEX_FORMAT_VERSION = 2
+# Page size when pulling documents, embeddings and metadatas out of Chroma
+CHROMA_PAGE_SIZE = 5000
+# Version of the content of a collection, bumped by the loaders after they write to it (see mark_collection_written)
+SOURCE_VERSION_FILE = 'source_version.json'
+
+
+def collection_fingerprint(collection: Collection) -> str:
+    """Content hash of a collection computed from ids plus the 'content_hash' metadata when it is present."""
+    entries = []
+    offset = 0
+    while True:
+        page = collection.get(include=['metadatas'], limit=CHROMA_PAGE_SIZE, offset=offset)
+        ids = page['ids']
+        if not ids:
+            break
+        metadatas = page['metadatas'] or [None] * len(ids)
+        entries.extend((doc_id, (meta or {}).get('content_hash', '')) for doc_id, meta in zip(ids, metadatas))
+        offset += len(ids)
+    return _fingerprint(entries)
+
+
+def source_version(collection_name: str, root: str = hybrid_index_root_path) -> str:
+    path = os.path.join(root, collection_name, SOURCE_VERSION_FILE)
+    try:
+        with open(path) as f:
+            return json.load(f)['version']
+    except (OSError, ValueError, KeyError):
+        return ''
+
+
+def mark_collection_written(collection_name: str, root: str = hybrid_index_root_path):
+    """Called by the loaders once they changed a collection: the hybrid indexes opened from now on check it again."""
+    collection_root = os.path.join(root, collection_name)
+    os.makedirs(collection_root, exist_ok=True)
+    tmp_path = os.path.join(collection_root, f'.tmp-{uuid.uuid4().hex}.json')
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': uuid.uuid4().hex, 'written_at': datetime.now(timezone.utc).isoformat()}, f)
+    os.replace(tmp_path, os.path.join(collection_root, SOURCE_VERSION_FILE))
+
+
+def freshness_key(collection: Collection, root: str = hybrid_index_root_path) -> str:
+    """
+    Cheap stand-in for collection_fingerprint: record count plus the version of the loaders' last write.  Reading it
+    costs one count() instead of paging through every id and metadata of the collection.
+    """
+    return f'{collection.count()}:{source_version(collection.name, root)}'
+
+
+def _fingerprint(entries: list[tuple[str, str]]) -> str:
+    # Chroma does not guarantee the order of get(). Sort so the hash only depends on the content
+    digest = hashlib.sha256()
+    for doc_id, content_hash in sorted(entries):
+        digest.update(doc_id.encode('utf-8'))
+        digest.update(b'\x00')
+        digest.update(content_hash.encode('utf-8'))
+        digest.update(b'\x01')
+    return digest.hexdigest()
+
+
+class TextColumn:
+    """A list of strings kept as one memory-mapped utf-8 blob plus offsets. Strings are decoded on access."""
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self.blob = blob
+        self.offsets = offsets
+
+    @staticmethod
+    def write(path_prefix: str, texts: list[str]):
+        encoded = [text.encode('utf-8') for text in texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        with open(f'{path_prefix}.bin', 'wb') as f:
+            for b in encoded:
+                f.write(b)
+        np.save(f'{path_prefix}_offsets.npy', offsets)
+
+    @classmethod
+    def open(cls, path_prefix: str) -> "TextColumn":
+        offsets = np.load(f'{path_prefix}_offsets.npy', mmap_mode='r')
+        # np.memmap refuses empty files
+        if offsets[-1] == 0:
+            blob = np.zeros(0, dtype=np.uint8)
+        else:
+            blob = np.memmap(f'{path_prefix}.bin', dtype=np.uint8, mode='r')
+        return cls(blob, offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class HybridIndex:
+    """
+    On-disk artifact backing HybridRetriever: float32 embeddings (.npy), documents, ids and BM25 term statistics.
+    It lives under <root>/<collection name>/<fingerprint>/ and is opened with mmap, so every session and every process
+    shares the same pages instead of pulling the whole collection out of Chroma at startup.
+    """
+    def __init__(self, path: str, manifest: dict, ids: TextColumn, documents: TextColumn, embeddings: np.ndarray,
+                 vocab: list[str], tf_indptr: np.ndarray, tf_indices: np.ndarray, tf_data: np.ndarray, doc_len: np.ndarray,
+                 bm25_weights: np.ndarray):
+        self.path = path
+        self.manifest = manifest
+        self.fingerprint = manifest['fingerprint']
+        self.ids = ids
+        self.documents = documents
+        self.embeddings = embeddings
+        self.vocab = {term: term_id for term_id, term in enumerate(vocab)}
+        # Term-major CSR of raw term frequencies: postings of term t are tf_indices/tf_data[tf_indptr[t]:tf_indptr[t + 1]]
+        self.tf_indptr = tf_indptr
+        self.tf_indices = tf_indices
+        self.tf_data = tf_data
+        self.doc_len = doc_len
+        self._row_by_id = None
+        # Shares tf_indptr/tf_indices with the raw term frequencies, the weights have IDF and length normalization baked in
+        self.bm25 = SparseBM25.from_term_statistics(self.vocab, tf_indptr, tf_indices, bm25_weights, len(doc_len))
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    @property
+    def row_by_id(self) -> dict[str, int]:
+        # Built on first use: only the ANN leg backed by Chroma needs to map ids back to rows
+        if self._row_by_id is None:
+            self._row_by_id = {doc_id: row for row, doc_id in enumerate(self.ids)}
+        return self._row_by_id
+
+    ###########################################################
+    #####  Persistence
+    ###########################################################
+    @classmethod
+    def open(cls, path: str) -> "HybridIndex":
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        if manifest.get('format_version') != INDEX_FORMAT_VERSION:
+            # Rather than a FileNotFoundError on whichever file the older layout lacks
+            raise ValueError(f"Hybrid index at {path} has format version {manifest.get('format_version')}, "
+                             f"expected {INDEX_FORMAT_VERSION}. Rebuild it with HybridIndex.open_or_build")
+        with open(os.path.join(path, 'vocab.json')) as f:
+            vocab = json.load(f)
+        return cls(
+            path,
+            manifest,
+            ids=TextColumn.open(os.path.join(path, 'ids')),
+            documents=TextColumn.open(os.path.join(path, 'documents')),
+            embeddings=np.load(os.path.join(path, 'embeddings.npy'), mmap_mode='r'),
+            vocab=vocab,
+            tf_indptr=np.load(os.path.join(path, 'tf_indptr.npy'), mmap_mode='r'),
+            tf_indices=np.load(os.path.join(path, 'tf_indices.npy'), mmap_mode='r'),
+            tf_data=np.load(os.path.join(path, 'tf_data.npy'), mmap_mode='r'),
+            doc_len=np.load(os.path.join(path, 'doc_len.npy'), mmap_mode='r'),
+            bm25_weights=np.load(os.path.join(path, 'bm25_weights.npy'), mmap_mode='r'),
+        )
+
+    @classmethod
+    def open_or_build(cls, collection: Collection, root: str = hybrid_index_root_path, verify: bool = False) -> "HybridIndex":
+        """
+        Open the artifact matching the current content of the collection; build it only if the collection changed.
+        The artifact whose freshness key (count plus the loaders' version) still matches is opened without reading
+        the collection.  Otherwise, or with verify=True, the content fingerprint decides: computing it pages through
+        every id and metadata of the collection.
+        """
+        key = freshness_key(collection, root)
+        collection_root = os.path.join(root, collection.name)
+        if not verify:
+            for path in cls._versions(collection_root):
+                if cls._is_valid(path, key):
+                    return cls.open(path)
+        fingerprint = collection_fingerprint(collection)
+        path = os.path.join(collection_root, fingerprint)
+        if cls._is_valid(path):
+            # Same content under a new key (ex. another process bumped the version without changing anything)
+            cls._write_manifest(path, {**cls._read_manifest(path), 'freshness_key': key})
+            return cls.open(path)
+        index = cls.build(collection, root, key)
+        print(f"---Built hybrid index for '{collection.name}' with {len(index)} documents at {index.path}---")
+        return index
+
+    @staticmethod
+    def _versions(collection_root: str) -> list[str]:
+        if not os.path.isdir(collection_root):
+            return []
+        return [os.path.join(collection_root, name) for name in os.listdir(collection_root)
+                if not name.startswith('.tmp-') and os.path.isdir(os.path.join(collection_root, name))]
+
+    @staticmethod
+    def _read_manifest(path: str) -> dict | None:
+        try:
+            with open(os.path.join(path, 'manifest.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_manifest(path: str, manifest: dict):
+        tmp_path = os.path.join(path, f'.tmp-{uuid.uuid4().hex}.json')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, os.path.join(path, 'manifest.json'))
+
+    @classmethod
+    def _is_valid(cls, path: str, freshness_key: str | None = None) -> bool:
+        manifest = cls._read_manifest(path)
+        if manifest is None or manifest.get('format_version') != INDEX_FORMAT_VERSION:
+            return False
+        return freshness_key is None or manifest.get('freshness_key') == freshness_key
+
+    @classmethod
+    def build(cls, collection: Collection, root: str = hybrid_index_root_path, key: str | None = None) -> "HybridIndex":
+        # Taken before reading the rows: a write in between makes the key stale, never the index
+        key = key or freshness_key(collection, root)
+        ids, documents, embeddings, entries = [], [], [], []
+        offset = 0
+        while True:
+            page = collection.get(include=['documents', 'embeddings', 'metadatas'], limit=CHROMA_PAGE_SIZE, offset=offset)
+            if not page['ids']:
+                break
+            metadatas = page['metadatas'] or [None] * len(page['ids'])
+            ids.extend(page['ids'])
+            documents.extend(page['documents'])
+            embeddings.append(np.asarray(page['embeddings'], dtype=np.float32))
+            entries.extend((doc_id, (meta or {}).get('content_hash', '')) for doc_id, meta in zip(page['ids'], metadatas))
+            offset += len(page['ids'])
+        # The fingerprint comes from the very rows we indexed, so a concurrent write can only cause a rebuild next time
+        fingerprint = _fingerprint(entries)
+        embedding_matrix = np.concatenate(embeddings) if embeddings else np.zeros((0, 0), dtype=np.float32)
+        return cls.write(os.path.join(root, collection.name), fingerprint, ids, documents, embedding_matrix, key)
+
+    @classmethod
+    def write(cls, collection_root: str, fingerprint: str, ids: list[str], documents: list[str],
+              embeddings: np.ndarray, freshness_key: str | None = None) -> "HybridIndex":
+        """Tokenize the corpus, persist all arrays in a temporary folder and publish it with an atomic rename."""
+        vocab, tf_indptr, tf_indices, tf_data, doc_len = cls._term_statistics(documents)
+        return cls._publish(collection_root, fingerprint, ids, documents, embeddings, vocab, tf_indptr, tf_indices,
+                            tf_data, doc_len, freshness_key)
+
+    @classmethod
+    def _publish(cls, collection_root: str, fingerprint: str, ids: list[str], documents: list[str], embeddings: np.ndarray,
+                 vocab: list[str], tf_indptr: np.ndarray, tf_indices: np.ndarray, tf_data: np.ndarray,
+                 doc_len: np.ndarray, freshness_key: str | None = None) -> "HybridIndex":
+        os.makedirs(collection_root, exist_ok=True)
+        tmp_path = os.path.join(collection_root, f'.tmp-{uuid.uuid4().hex}')
+        os.makedirs(tmp_path)
+
+        TextColumn.write(os.path.join(tmp_path, 'ids'), ids)
+        TextColumn.write(os.path.join(tmp_path, 'documents'), documents)
+        np.save(os.path.join(tmp_path, 'embeddings.npy'), np.ascontiguousarray(embeddings, dtype=np.float32))
+        np.save(os.path.join(tmp_path, 'tf_indptr.npy'), tf_indptr)
+        np.save(os.path.join(tmp_path, 'tf_indices.npy'), tf_indices)
+        np.save(os.path.join(tmp_path, 'tf_data.npy'), tf_data)
+        np.save(os.path.join(tmp_path, 'doc_len.npy'), doc_len)
+        np.save(os.path.join(tmp_path, 'bm25_weights.npy'), bm25_weights(tf_indptr, tf_indices, tf_data, doc_len))
+        with open(os.path.join(tmp_path, 'vocab.json'), 'w') as f:
+            json.dump(vocab, f)
+        manifest = {
+            'format_version': INDEX_FORMAT_VERSION,
+            'collection': os.path.basename(collection_root),
+            'fingerprint': fingerprint,
+            'freshness_key': freshness_key,
+            'count': len(ids),
+            'dimension': int(embeddings.shape[1]) if embeddings.ndim == 2 else 0,
+            'created_at': datetime.now(timezone.utc).isoformat(),
+        }
+        with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+
+        path = os.path.join(collection_root, fingerprint)
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            if cls._is_valid(path):
+                # Another process published the same fingerprint first. Theirs is as good as ours
+                shutil.rmtree(tmp_path, ignore_errors=True)
+            else:
+                # Same content, but written by another format version (or a writer that died): replace it
+                shutil.rmtree(path, ignore_errors=True)
+                try:
+                    os.replace(tmp_path, path)
+                except OSError:
+                    shutil.rmtree(tmp_path, ignore_errors=True)
+        cls._remove_stale_versions(collection_root, keep=fingerprint)
+        return cls.open(path)
+
+    def apply_changes(self, fingerprint: str, removed_ids: set[str], ids: list[str], documents: list[str],
+                      embeddings: np.ndarray, freshness_key: str | None = None) -> "HybridIndex":
+        """
+        New version of the index after an upsert/delete sync of the collection, without going back to Chroma:
+        rows of removed_ids are dropped, (ids, documents, embeddings) are appended (pass upserted ids in removed_ids too).
+        Only the appended documents are tokenized.  Term frequencies of the other rows are reused and BM25 weights are
+        recomputed from them, because IDF and average document length depend on the whole corpus.
+        """
+        removed_ids = set(removed_ids) | set(ids)
+        keep = np.asarray([doc_id not in removed_ids for doc_id in self.ids], dtype=bool)
+        kept_rows = np.flatnonzero(keep)
+        vocab = dict(self.vocab)
+        tf = csr_matrix((self.tf_data, self.tf_indices, self.tf_indptr), shape=(len(self.vocab), len(self)))[:, kept_rows]
+
+        # Term frequencies of the new documents over the vocabulary extended with their new terms
+        rows, cols, counts = [], [], []
+        new_doc_len = np.zeros(len(documents), dtype=np.float32)
+        for doc_id, document in enumerate(documents):
+            tokens = tokenize(document)
+            new_doc_len[doc_id] = len(tokens)
+            frequencies: dict[int, int] = {}
+            for token in tokens:
+                term_id = vocab.setdefault(token, len(vocab))
+                frequencies[term_id] = frequencies.get(term_id, 0) + 1
+            rows.extend(frequencies.keys())
+            cols.extend([doc_id] * len(frequencies))
+            counts.extend(frequencies.values())
+        new_tf = csr_matrix((np.asarray(counts, dtype=np.float32), (rows, cols)), shape=(len(vocab), len(documents)))
+        tf.resize((len(vocab), len(kept_rows)))
+        tf = hstack([tf, new_tf], format='csr')
+        # Drop terms left without any document: they would shift the average IDF of the epsilon floor of BM25Okapi
+        live_terms = np.flatnonzero(np.diff(tf.indptr))
+        tf = tf[live_terms]
+        tf.sort_indices()
+        terms = list(vocab.keys())
+        index_dtype = np.int32 if max(tf.nnz, tf.shape[1]) < np.iinfo(np.int32).max else np.int64
+
+        parts = [np.asarray(self.embeddings[kept_rows], dtype=np.float32)] if len(kept_rows) else []
+        if len(documents):
+            parts.append(np.asarray(embeddings, dtype=np.float32).reshape(len(documents), -1))
+        all_embeddings = np.concatenate(parts) if parts else np.zeros((0, 0), dtype=np.float32)
+        return self._publish(
+            os.path.dirname(self.path), fingerprint,
+            [self.ids[row] for row in kept_rows] + list(ids),
+            [self.documents[row] for row in kept_rows] + list(documents),
+            all_embeddings,
+            [terms[term_id] for term_id in live_terms],
+            tf.indptr.astype(index_dtype), tf.indices.astype(index_dtype), tf.data.astype(np.float32),
+            np.concatenate([np.asarray(self.doc_len, dtype=np.float32)[kept_rows], new_doc_len]),
+            freshness_key,
+        )
+
+    @staticmethod
+    def _term_statistics(documents: list[str]):
+        vocab: dict[str, int] = {}
+        doc_ids, term_ids, counts = [], [], []
+        doc_len = np.zeros(len(documents), dtype=np.float32)
+        for doc_id, document in enumerate(documents):
+            tokens = tokenize(document)
+            doc_len[doc_id] = len(tokens)
+            frequencies: dict[int, int] = {}
+            for token in tokens:
+                term_id = vocab.setdefault(token, len(vocab))
+                frequencies[term_id] = frequencies.get(term_id, 0) + 1
+            doc_ids.extend([doc_id] * len(frequencies))
+            term_ids.extend(frequencies.keys())
+            counts.extend(frequencies.values())
+
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        # SciPy copies a CSR whose indices and indptr have different dtypes. Pick one that fits both
+        index_dtype = np.int32 if max(len(term_ids), len(documents)) < np.iinfo(np.int32).max else np.int64
+        # Group postings by term (stable, so documents stay in ascending order inside a posting list)
+        order = np.argsort(term_ids, kind='stable')
+        tf_indices = np.asarray(doc_ids, dtype=index_dtype)[order]
+        tf_data = np.asarray(counts, dtype=np.float32)[order]
+        tf_indptr = np.zeros(len(vocab) + 1, dtype=index_dtype)
+        np.cumsum(np.bincount(term_ids, minlength=len(vocab)), out=tf_indptr[1:])
+        return list(vocab.keys()), tf_indptr, tf_indices, tf_data, doc_len
+
+    @staticmethod
+    def _remove_stale_versions(collection_root: str, keep: str):
+        # Sessions that still map an old version keep working on Linux/macOS after the unlink
+        for name in os.listdir(collection_root):
+            if name != keep and not name.startswith('.tmp-') and os.path.isdir(os.path.join(collection_root, name)):
+                shutil.rmtree(os.path.join(collection_root, name), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    import argparse
+    import chromadb
+    from resource_registry import chromdb_persistent_path
+    parser = argparse.ArgumentParser(description="Check the hybrid indexes against the full content of their collections")
+    parser.add_argument("collections", nargs="*", default=["medical_disease_qna", "medical_device_manuals"])
+    parser.add_argument("--root", default=hybrid_index_root_path)
+    args = parser.parse_args()
+    client = chromadb.PersistentClient(path=chromdb_persistent_path)
+    for name in args.collections:
+        # verify=True: fingerprint of every id and content_hash, rebuild if it does not match the artifact
+        index = HybridIndex.open_or_build(client.get_collection(name), args.root, verify=True)
+        print(f"---'{name}': {len(index)} documents, fingerprint {index.fingerprint}---")
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from chromadb.api.models.Collection import Collection
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from hybrid_index import CHROMA_PAGE_SIZE
+
+# Rows handed to a chunking worker at once.  Big enough to amortize pickling, small enough to keep every worker busy
+CHUNK_TASK_ROWS = 1000
+# Chunks per SentenceTransformer.encode call and per collection.add (Chroma caps a batch at about 5461 records)
+EMBED_BATCH_SIZE = 4096
+ENCODE_BATCH_SIZE = 256
+# Embedded batches waiting for the writer.  Bounds memory when Chroma writes are slower than the encoder
+WRITE_QUEUE_SIZE = 2
+
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 100
+# Ids given by the loader before content hashes: '<row>_<chunk>', 1-based
+POSITIONAL_ID = re.compile(r'\d+_\d+')
+
+_splitter = None
+
+
+def content_hash(text: str, metadata: dict | None = None) -> str:
+    """Stable id of a chunk: the same text with the same metadata is the same chunk, whatever its row position."""
+    digest = hashlib.sha256(json.dumps(metadata or {}, sort_keys=True, default=str).encode('utf-8'))
+    digest.update(b'\x00')
+    digest.update(text.encode('utf-8'))
+    return digest.hexdigest()[:32]
+
+
+def _split_rows(rows: list[tuple[str, dict]]) -> list[tuple[str, str, dict]]:
+    """Worker of the process pool: (text, metadata) rows to (id, chunk, metadata) chunks."""
+    global _splitter
+    if _splitter is None:
+        # One splitter per worker process, same settings as the retrievers used to chunk with
+        _splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP,
+                                                   separators=["\n\n", "\n", " ", ""])
+    chunks = []
+    for text, metadata in rows:
+        for chunk in _splitter.split_text(text or ''):
+            chunk_id = content_hash(chunk, metadata)
+            chunks.append((chunk_id, chunk, {**metadata, 'content_hash': chunk_id}))
+    return chunks
+
+
+class IngestionPipeline:
+    """
+    Bulk, resumable ingestion into a Chroma collection:
+    chunking in a process pool -> skip chunks whose content-hash id is already indexed -> SentenceTransformer encode
+    in large batches -> collection.add on a writer thread, overlapped with the encoding of the next batch.
+    Ids are content hashes, so re-running on the same (or a partly loaded) CSV only adds what is missing.  Records of
+    a collection loaded before, with positional ids ('1_1', '1_2', ...), are deleted first: they would come back next to
+    their content-hash copy in every retrieval.
+    """
+    def __init__(self, collection: Collection, embedding_model, workers: int | None = None,
+                 embed_batch_size: int = EMBED_BATCH_SIZE):
+        self.collection = collection
+        self.embedding_model = embedding_model
+        self.workers = workers
+        self.embed_batch_size = embed_batch_size
+        self.stats = {'rows': 0, 'chunks': 0, 'skipped': 0, 'added': 0, 'legacy_deleted': 0}
+
+    def _chunks(self, texts: list[str], metadatas: list[dict]):
+        rows = list(zip(texts, metadatas))
+        tasks = [rows[start:start + CHUNK_TASK_ROWS] for start in range(0, len(rows), CHUNK_TASK_ROWS)]
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            # map keeps the row order and hands out results as soon as the first tasks are done
+            for chunks in pool.map(_split_rows, tasks):
+                yield from chunks
+
+    def _batches(self, chunks):
+        batch = {}
+        for chunk_id, chunk, metadata in chunks:
+            self.stats['chunks'] += 1
+            # Identical chunks of the same row collapse to one record
+            batch[chunk_id] = (chunk, metadata)
+            if len(batch) >= self.embed_batch_size:
+                yield batch
+                batch = {}
+        if batch:
+            yield batch
+
+    def delete_legacy_records(self) -> int:
+        """
+        Delete the records of the old loader: positional id, and not the content_hash of their metadata.  Any other id
+        (ex. a natural key) is left alone.  0 once the collection is migrated.
+        """
+        legacy = []
+        offset = 0
+        while True:
+            page = self.collection.get(include=['metadatas'], limit=CHROMA_PAGE_SIZE, offset=offset)
+            if not page['ids']:
+                break
+            for chunk_id, metadata in zip(page['ids'], page['metadatas'] or [None] * len(page['ids'])):
+                if POSITIONAL_ID.fullmatch(chunk_id) and (metadata or {}).get('content_hash') != chunk_id:
+                    legacy.append(chunk_id)
+            offset += len(page['ids'])
+        for start in range(0, len(legacy), EMBED_BATCH_SIZE):
+            self.collection.delete(ids=legacy[start:start + EMBED_BATCH_SIZE])
+        if legacy:
+            print(f"---Deleted {len(legacy)} records with positional ids from '{self.collection.name}'---")
+        self.stats['legacy_deleted'] += len(legacy)
+        return len(legacy)
+
+    def _missing(self, batch: dict) -> dict:
+        existing = set(self.collection.get(ids=list(batch), include=[])['ids'])
+        self.stats['skipped'] += len(existing)
+        return {chunk_id: value for chunk_id, value in batch.items() if chunk_id not in existing}
+
+    def _write(self, writes: queue.Queue, errors: list):
+        while True:
+            item = writes.get()
+            if item is None:
+                return
+            if errors:
+                # Keep draining so the producer never blocks on a full queue
+                continue
+            ids, documents, metadatas, embeddings = item
+            try:
+                self.collection.add(ids=ids, documents=documents, metadatas=metadatas, embeddings=embeddings)
+                self.stats['added'] += len(ids)
+            except Exception as e:
+                errors.append(e)
+
+    def run(self, texts: list[str], metadatas: list[dict]) -> dict:
+        started = time.perf_counter()
+        self.stats['rows'] += len(texts)
+        self.delete_legacy_records()
+        writes = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        errors = []
+        writer = threading.Thread(target=self._write, args=(writes, errors), name='chroma-writer', daemon=True)
+        writer.start()
+        try:
+            for batch in self._batches(self._chunks(texts, metadatas)):
+                if errors:
+                    break
+                batch = self._missing(batch)
+                if not batch:
+                    continue
+                ids = list(batch)
+                documents = [batch[chunk_id][0] for chunk_id in ids]
+                embeddings = self.embedding_model.encode(documents, batch_size=ENCODE_BATCH_SIZE, convert_to_numpy=True,
+                                                         show_progress_bar=False)
+                writes.put((ids, documents, [batch[chunk_id][1] for chunk_id in ids], np.asarray(embeddings, dtype=np.float32)))
+                print(f"---Ingestion of '{self.collection.name}': {self.stats}---")
+        finally:
+            writes.put(None)
+            writer.join()
+        if errors:
+            raise errors[0]
+        print(f"---Ingested '{self.collection.name}' in {time.perf_counter() - started:.1f} s: {self.stats}---")
+        return self.stats
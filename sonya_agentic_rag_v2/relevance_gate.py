@@ -0,0 +1,94 @@
+import json
+import os
+import threading
+import uuid
+import numpy as np
+
+# Relevance checking modes of AgenticRAG
+LLM_RELEVANCE = "llm"
+# Cross-encoder scores decide, the LLM grader only grades the contexts whose score falls in the ambiguous band
+CROSS_ENCODER_RELEVANCE = "cross_encoder"
+
+relevance_gate_path = "./relevance_gate/relevance_gate.json"
+
+# Thresholds on the best cross-encoder/ms-marco-MiniLM-L-6-v2 logit of the retrieved documents, used until
+# 'python evaluation.py --calibrate-relevance' writes calibrated ones.  A relevant passage mostly scores above 3.
+# Below 0 is what the re-ranking guardrail of HybridRetriever already drops
+RELEVANCE_ACCEPT_SCORE = 3.0
+RELEVANCE_REJECT_SCORE = 0.0
+# Share of the contexts above the accept threshold that have to be relevant (below the reject threshold: irrelevant)
+RELEVANCE_TARGET_PRECISION = 0.95
+
+
+def calibrate(best_scores: list[float], labels: list[bool],
+              target_precision: float = RELEVANCE_TARGET_PRECISION) -> tuple[float, float]:
+    """
+    (accept_score, reject_score) from the best cross-encoder score of retrieved contexts labeled relevant or not.
+    accept_score is the lowest score from which at least target_precision of the contexts are relevant, reject_score
+    the highest score under which at least target_precision of them are irrelevant.  Between both, the LLM grades.
+    When no score reaches target_precision, the gate never accepts (or never rejects) on its own.
+    """
+    scores = np.asarray(best_scores, dtype=np.float64)
+    labels = np.asarray(labels, dtype=bool)
+    thresholds = np.unique(scores)
+    accept, reject = float('inf'), float('-inf')
+    for threshold in thresholds:
+        if labels[scores >= threshold].mean() >= target_precision:
+            accept = float(threshold)
+            break
+    for threshold in thresholds[::-1]:
+        below = scores < threshold
+        if below.any() and (~labels[below]).mean() >= target_precision:
+            reject = float(threshold)
+            break
+    # Never let both bands overlap: a context is either accepted, rejected or graded
+    return accept, min(reject, accept)
+
+
+class RelevanceGate:
+    """
+    Local relevance check of the retrieved documents: the best cross-encoder score is compared with calibrated
+    thresholds.  decide() returns True (relevant), False (not relevant) or None when the score is in the ambiguous
+    band and the LLM grader has to decide.
+    """
+    def __init__(self, accept_score: float = RELEVANCE_ACCEPT_SCORE, reject_score: float = RELEVANCE_REJECT_SCORE):
+        self.accept_score = accept_score
+        self.reject_score = reject_score
+        self._lock = threading.Lock()
+        self.counts = {'accepted': 0, 'rejected': 0, LLM_RELEVANCE: 0}
+
+    @classmethod
+    def load(cls, path: str = relevance_gate_path):
+        """The gate with the thresholds calibrated by evaluation.py, or the default ones."""
+        if not os.path.exists(path):
+            return cls()
+        try:
+            with open(path, encoding='utf-8') as f:
+                saved = json.load(f)
+            print(f"---Loaded relevance thresholds from {path}: accept >= {saved['accept_score']:.3f}, reject < {saved['reject_score']:.3f}---")
+            return cls(saved['accept_score'], saved['reject_score'])
+        except (OSError, ValueError, KeyError) as e:
+            print(f"---Ignored unreadable relevance thresholds {path}: {e}---")
+            return cls()
+
+    def save(self, path: str = relevance_gate_path, **details):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # Write aside then rename, like the semantic cache
+        tmp_path = f'{path}.tmp-{uuid.uuid4().hex}'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'accept_score': self.accept_score, 'reject_score': self.reject_score, **details}, f, indent=2)
+        os.replace(tmp_path, path)
+
+    def decide(self, best_score: float) -> bool | None:
+        if best_score >= self.accept_score:
+            return True
+        if best_score < self.reject_score:
+            return False
+        return None
+
+    def record(self, decision: bool | None) -> dict:
+        """Count a decision of the gate (None: sent to the LLM grader) and return the counts."""
+        path = LLM_RELEVANCE if decision is None else 'accepted' if decision else 'rejected'
+        with self._lock:
+            self.counts[path] += 1
+            return dict(self.counts)
@@ -0,0 +1,169 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+
+RERANK_BATCH_SIZE = 32
+# Query plus chunk tokens seen by the cross-encoder. Our chunks are <= 500 characters, far below 512 tokens
+RERANK_MAX_LENGTH = 512
+RERANK_CACHE_SIZE = 10_000
+RERANK_CACHE_TTL_SECONDS = 3600
+
+
+def normalize_query(query: str) -> str:
+    """'How do patients contract hantavirus?' and 'how do patients  contract hantavirus' share cache entries."""
+    return " ".join(query.lower().split()).rstrip("?.! ")
+
+
+class LruTtlCache:
+    """Bounded, thread-safe LRU cache whose entries also expire ttl_seconds after they were stored."""
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, stored_at = entry
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class RerankerMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.pairs_scored = 0
+        self.early_exits = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, hits: int, misses: int, scored: int, early_exit: bool, latency: float):
+        with self._lock:
+            self.queries += 1
+            self.cache_hits += hits
+            self.cache_misses += misses
+            self.pairs_scored += scored
+            self.early_exits += int(early_exit)
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            lookups = self.cache_hits + self.cache_misses
+            return {
+                "queries": self.queries,
+                "cache_hits": self.cache_hits,
+                "cache_misses": self.cache_misses,
+                "cache_hit_rate": self.cache_hits / lookups if lookups else 0.0,
+                "pairs_scored": self.pairs_scored,
+                "early_exits": self.early_exits,
+                "mean_latency_ms": 1000 * self.total_latency / self.queries if self.queries else 0.0,
+                "max_latency_ms": 1000 * self.max_latency,
+            }
+
+
+class CrossEncoderReranker:
+    """
+    Re-ranking stage of HybridRetriever.  Cross-encoder scores are cached per (normalized query, chunk id), so popular
+    questions are not scored again.  Pairs are scored in batches of batch_size; with early_exit, they are scored k at a
+    time in fused order and scoring stops as soon as k candidates pass the score > 0 guardrail.
+    """
+    def __init__(self, cross_encoder, batch_size: int = RERANK_BATCH_SIZE, cache_size: int = RERANK_CACHE_SIZE,
+                 ttl_seconds: float = RERANK_CACHE_TTL_SECONDS, early_exit: bool = False):
+        # max_length is a constructor argument of CrossEncoder, see ResourceRegistry.cross_encoder
+        self.cross_encoder = cross_encoder
+        self.batch_size = batch_size
+        self.early_exit = early_exit
+        self.cache = LruTtlCache(cache_size, ttl_seconds)
+        self.metrics = RerankerMetrics()
+
+    def score(self, query: str, candidates: list[tuple[str, str]], k: int) -> list[float | None]:
+        """Scores of (chunk id, text) candidates.  None for the candidates skipped by the early exit."""
+        started = time.perf_counter()
+        normalized = normalize_query(query)
+        scores = [self.cache.get((normalized, chunk_id)) for chunk_id, _ in candidates]
+        hits = sum(score is not None for score in scores)
+        scored = 0
+        passed = 0
+        early_exit = False
+        # With early exit, score k candidates at a time so we can stop after the first chunks
+        step = min(k, self.batch_size) if self.early_exit else self.batch_size
+        for start in range(0, len(candidates), step):
+            batch = range(start, min(start + step, len(candidates)))
+            missing = [i for i in batch if scores[i] is None]
+            if missing:
+                predictions = self.cross_encoder.predict([(query, candidates[i][1]) for i in missing],
+                                                         batch_size=self.batch_size, show_progress_bar=False)
+                for i, prediction in zip(missing, predictions):
+                    scores[i] = float(prediction)
+                    self.cache.put((normalized, candidates[i][0]), scores[i])
+                scored += len(missing)
+            passed += sum(scores[i] > 0 for i in batch)
+            if self.early_exit and passed >= k and batch.stop < len(candidates):
+                early_exit = True
+                break
+        self.metrics.record(hits, len(candidates) - hits, scored, early_exit, time.perf_counter() - started)
+        return scores
+
+    def score_batch(self, items: list[tuple[str, list[tuple[str, str]]]]) -> list[list[float]]:
+        """
+        Scores of the (query, candidates) of many queries.  Pairs missing from the cache are scored by one predict call
+        across all queries, so the cross-encoder runs on full batches instead of a few pairs per query.  No early exit.
+        """
+        started = time.perf_counter()
+        all_scores, missing = [], []
+        for item, (query, candidates) in enumerate(items):
+            normalized = normalize_query(query)
+            scores = [self.cache.get((normalized, chunk_id)) for chunk_id, _ in candidates]
+            missing.extend((item, i) for i, score in enumerate(scores) if score is None)
+            all_scores.append(scores)
+        if missing:
+            predictions = self.cross_encoder.predict([(items[item][0], items[item][1][i][1]) for item, i in missing],
+                                                     batch_size=self.batch_size, show_progress_bar=False)
+            for (item, i), prediction in zip(missing, predictions):
+                query, candidates = items[item]
+                all_scores[item][i] = float(prediction)
+                self.cache.put((normalize_query(query), candidates[i][0]), all_scores[item][i])
+        # Recorded per query like score(), with an equal share of the batch latency
+        latency = (time.perf_counter() - started) / max(len(items), 1)
+        misses = Counter(item for item, _ in missing)
+        for item, (_, candidates) in enumerate(items):
+            self.metrics.record(len(candidates) - misses[item], misses[item], misses[item], False, latency)
+        return all_scores
+
+    @staticmethod
+    def _top(scores: list[float | None], k: int) -> list[tuple[int, float]]:
+        reranked = sorted(((i, score) for i, score in enumerate(scores) if score is not None), key=lambda x: x[1], reverse=True)
+        # score > 0 is a guardrail
+        return [(i, score) for i, score in reranked if score > 0][:k]
+
+    def rerank(self, query: str, candidates: list[tuple[str, str]], k: int) -> list[tuple[int, float]]:
+        """Top k (position in candidates, score) by cross-encoder score among the candidates passing the guardrail."""
+        return self._top(self.score(query, candidates, k), k)
+
+    def rerank_batch(self, items: list[tuple[str, list[tuple[str, str]]]], k: int) -> list[list[tuple[int, float]]]:
+        """rerank() of many (query, candidates) with one cross-encoder pass, see score_batch."""
+        return [self._top(scores, k) for scores in self.score_batch(items)]
@@ -0,0 +1,108 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import chromadb
+from chromadb.api.models.Collection import Collection
+from sentence_transformers import SentenceTransformer, CrossEncoder
+from hybrid_index import HybridIndex, hybrid_index_root_path
+from ann_index import open_ann_index
+from embedding_store import open_embedding_store
+from reranker import RERANK_MAX_LENGTH
+from semantic_cache import SemanticCache, semantic_cache_path
+from embedding_router import CentroidRouter
+from relevance_gate import RelevanceGate, relevance_gate_path
+from web_search import WebSearchCache, web_search_cache_path
+
+chromdb_persistent_path = "./chroma_db"
+
+EMBEDDING_MODEL_NAME = 'sentence-transformers/all-MiniLM-L6-v2'
+RERANKER_MODEL_NAME = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+
+class ResourceRegistry:
+    """
+    Process-wide registry of the heavy, read-only resources of the Agentic RAG app: embedding models, cross-encoders,
+    Chroma clients, hybrid indexes and the retrievers built on top of them.  Each one is loaded once on first use
+    and shared by every Gradio session.  A session (AgenticRAG) only keeps its own light state like the strategy.
+    """
+    def __init__(self):
+        # Re-entrant because building a retriever asks the registry for its models and client
+        self._lock = threading.RLock()
+        self._resources = {}
+
+    def _get_or_create(self, key: tuple, factory):
+        with self._lock:
+            if key not in self._resources:
+                self._resources[key] = factory()
+            return self._resources[key]
+
+    def embedding_model(self, model_name: str = EMBEDDING_MODEL_NAME) -> SentenceTransformer:
+        return self._get_or_create(('embedding_model', model_name), lambda: SentenceTransformer(model_name))
+
+    def cross_encoder(self, model_name: str = RERANKER_MODEL_NAME, max_length: int = RERANK_MAX_LENGTH) -> CrossEncoder:
+        return self._get_or_create(('cross_encoder', model_name, max_length), lambda: CrossEncoder(model_name, max_length=max_length))
+
+    def chroma_client(self, path: str = chromdb_persistent_path):
+        return self._get_or_create(('chroma_client', path), lambda: chromadb.PersistentClient(path=path))
+
+    def hybrid_index(self, collection: Collection, root: str = hybrid_index_root_path) -> HybridIndex:
+        return self._get_or_create(('hybrid_index', collection.name, root), lambda: HybridIndex.open_or_build(collection, root))
+
+    def ann_index(self, collection: Collection, index: HybridIndex):
+        """hnswlib (or Chroma HNSW) index for the semantic leg of hybrid ANN retrieval, one per version of the collection."""
+        return self._get_or_create(('ann_index', collection.name, index.fingerprint), lambda: open_ann_index(collection, index))
+
+    def embedding_store(self, index: HybridIndex, precision: str):
+        """float32, float16 or int8 embedding matrix of a hybrid index for the exact semantic leg."""
+        key = ('embedding_store', index.manifest['collection'], index.fingerprint, precision)
+        return self._get_or_create(key, lambda: open_embedding_store(index, precision))
+
+    def semantic_cache(self, path: str = semantic_cache_path) -> SemanticCache:
+        """Answers cached by question similarity, shared by every session."""
+        return self._get_or_create(('semantic_cache', path), lambda: SemanticCache(path))
+
+    def web_search_cache(self, path: str = web_search_cache_path) -> WebSearchCache:
+        """Serper snippets cached by normalized question, shared by every session."""
+        return self._get_or_create(('web_search_cache', path), lambda: WebSearchCache(path))
+
+    def relevance_gate(self, path: str = relevance_gate_path) -> RelevanceGate:
+        """Cross-encoder relevance thresholds, calibrated by evaluation.py --calibrate-relevance."""
+        return self._get_or_create(('relevance_gate', path), lambda: RelevanceGate.load(path))
+
+    def embedding_router(self, indexes: dict[str, HybridIndex]) -> CentroidRouter:
+        """Centroid router over the hybrid indexes keyed by source, one per version of the collections."""
+        key = ('embedding_router', tuple(sorted((source, index.fingerprint) for source, index in indexes.items())))
+        return self._get_or_create(key, lambda: CentroidRouter.from_indexes(indexes))
+
+    def cpu_executor(self) -> ThreadPoolExecutor:
+        """Bounded pool for the CPU-bound work (encoders, BM25, cross-encoder) awaited by the async graph nodes."""
+        return self._get_or_create(('cpu_executor',), lambda: ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1),
+                                                                                   thread_name_prefix='rag-cpu'))
+
+    async def run_cpu_bound(self, func, *args):
+        """Await func(*args) on the CPU pool, so the event loop keeps serving other sessions meanwhile."""
+        return await asyncio.get_running_loop().run_in_executor(self.cpu_executor(), func, *args)
+
+    def retriever(self, retriever_cls):
+        """The shared instance of MedicalDiseaseQAndARetriever or MedicalDeviceManualsRetriever with its hybrid retriever ready."""
+        def create():
+            retriever = retriever_cls(registry=self)
+            retriever.build_hybrid_retriever()
+            return retriever
+        return self._get_or_create(('retriever', retriever_cls.__name__), create)
+
+    def invalidate(self, collection_name: str):
+        """Drop the hybrid index and retrievers of a collection after re-indexing it, so the next session picks up the change."""
+        with self._lock:
+            for key in list(self._resources):
+                if key[0] in ('hybrid_index', 'ann_index', 'embedding_store') and key[1] == collection_name:
+                    del self._resources[key]
+                elif key[0] == 'embedding_router':
+                    # Rebuilt from the new centroids on next use
+                    del self._resources[key]
+                elif key[0] == 'retriever' and self._resources[key].identity == collection_name:
+                    del self._resources[key]
+
+
+shared_registry = ResourceRegistry()
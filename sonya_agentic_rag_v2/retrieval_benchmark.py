@@ -0,0 +1,181 @@
+import argparse
+import shutil
+import statistics
+import tempfile
+import time
+import numpy as np
+from hybrid_index import HybridIndex
+from bm25 import tokenize
+from documents_retrievers import HybridRetriever
+from fusion import FUSION_STRATEGIES, WEIGHTED_MINMAX_FUSION
+from ann_index import HnswlibAnnIndex, hnswlib
+from embedding_store import EMBEDDING_STORES, FLOAT32, FLOAT16, INT8
+
+# Per-query latency of HybridRetriever.search on synthetic corpora, so we know where the retriever stops scaling.
+# With hnswlib installed, it also reports the ANN semantic leg (use_ann=True) and its recall@k against the exact path.
+# --precisions float16 int8 adds the quantized embedding stores, with and without full-precision rescoring, their
+# memory and their recall@k against the float32 exact path.
+# Embeddings are random unit vectors (384 dimensions like all-MiniLM-L6-v2) and documents follow a Zipf-like term
+# distribution.  No model and no ChromaDB are needed: queries come with precomputed embeddings.
+#
+#   python retrieval_benchmark.py --sizes 10000 100000 1000000
+#
+# 1M chunks need about 1.5 GB for the float32 embeddings plus a couple of minutes to tokenize the synthetic corpus.
+# Building the hnswlib index over random 384-dimension vectors is the slowest part (minutes at 100k chunks).
+
+EMBEDDING_DIMENSION = 384
+
+
+class SyntheticQueryEncoder:
+    """Stands in for the SentenceTransformer: returns the precomputed embedding of each synthetic query."""
+    def __init__(self, embeddings_by_query: dict[str, np.ndarray]):
+        self.embeddings_by_query = embeddings_by_query
+
+    def encode(self, query: str) -> np.ndarray:
+        return self.embeddings_by_query[query]
+
+
+class UnusedReranker:
+    """search() never reranks. Keeps the cross-encoder from being downloaded for nothing."""
+    def predict(self, pairs):
+        raise RuntimeError("The search benchmark does not rerank")
+
+
+def synthetic_corpus(n_docs: int, vocab_size: int = 50_000, doc_len: int = 60, seed: int = 42):
+    rng = np.random.default_rng(seed)
+    term_probabilities = 1.0 / np.arange(1, vocab_size + 1)
+    term_probabilities /= term_probabilities.sum()
+    vocab = np.array([f"term{i}" for i in range(vocab_size)])
+    documents = []
+    # Generate in slices to keep the int64 term matrix small at 1M documents
+    for start in range(0, n_docs, 100_000):
+        term_ids = rng.choice(vocab_size, size=(min(100_000, n_docs - start), doc_len), p=term_probabilities)
+        documents.extend(" ".join(row) for row in vocab[term_ids])
+    embeddings = rng.standard_normal((n_docs, EMBEDDING_DIMENSION), dtype=np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return [str(i) for i in range(n_docs)], documents, embeddings
+
+
+def synthetic_queries(documents: list[str], embeddings: np.ndarray, n_queries: int, seed: int = 7):
+    """Each query takes a few terms of a random document and an embedding close to that document's embedding."""
+    rng = np.random.default_rng(seed)
+    embeddings_by_query = {}
+    for doc_index in rng.choice(len(documents), size=n_queries, replace=False):
+        terms = documents[doc_index].split()
+        query = " ".join(rng.choice(terms, size=4, replace=False)) + f" q{doc_index}"
+        noisy = embeddings[doc_index] + rng.standard_normal(EMBEDDING_DIMENSION).astype(np.float32) * 0.05
+        embeddings_by_query[query] = noisy / np.linalg.norm(noisy)
+    return embeddings_by_query
+
+
+def full_sort_search(retriever: HybridRetriever, query: str, n_results: int) -> list[int] | None:
+    """The original HybridRetriever.search: normalize full-corpus score vectors, then argsort all of them."""
+    sem_scores = np.dot(retriever.embeddings, retriever.embedding_model_for_query.encode(query))
+    norm_sem_scores = (sem_scores - sem_scores.min()) / (sem_scores.max() - sem_scores.min() + 1e-8)
+    bm25_scores = retriever.bm25.get_scores(tokenize(query))
+    if bm25_scores.max() <= 0:
+        return None
+    combined = retriever.alpha * norm_sem_scores + (1 - retriever.alpha) * bm25_scores / (bm25_scores.max() + 1e-8)
+    return list(np.argsort(combined)[::-1][:n_results])
+
+
+def latency_summary(latencies: list[float]) -> str:
+    latencies_ms = sorted(latency * 1000 for latency in latencies)
+    p95 = latencies_ms[min(len(latencies_ms) - 1, int(len(latencies_ms) * 0.95))]
+    return f"mean {statistics.mean(latencies_ms):8.2f} ms | p50 {statistics.median(latencies_ms):8.2f} ms | p95 {p95:8.2f} ms"
+
+
+def benchmark_size(n_docs: int, n_queries: int, n_results: int, index_root: str, fusion: str, precisions: list[str]):
+    print(f"\n=== {n_docs:,} chunks ===")
+    started = time.perf_counter()
+    ids, documents, embeddings = synthetic_corpus(n_docs)
+    index = HybridIndex.write(f"{index_root}/synthetic_{n_docs}", f"synthetic-{n_docs}", ids, documents, embeddings)
+    print(f"built synthetic hybrid index in {time.perf_counter() - started:.1f} s")
+    embeddings_by_query = synthetic_queries(documents, embeddings, n_queries)
+    del documents, embeddings
+
+    ann_index = None
+    if hnswlib is not None:
+        started = time.perf_counter()
+        ann_index = HnswlibAnnIndex(index)
+        print(f"built hnswlib index in {time.perf_counter() - started:.1f} s")
+    retriever = HybridRetriever(None, SyntheticQueryEncoder(embeddings_by_query), alpha=0.6,
+                                index=index, reranker=UnusedReranker(), ann_index=ann_index, fusion=fusion)
+    searches = {
+        # Lower bound of both exact paths: the brute-force cosine over the whole memory-mapped matrix
+        "cosine dot only": lambda query: np.dot(retriever.embeddings, retriever.embedding_model_for_query.encode(query)),
+        "full argsort": lambda query: full_sort_search(retriever, query, n_results),
+        f"exact legs + {fusion}": lambda query: retriever.search(query, n_results),
+    }
+    if ann_index is not None:
+        searches[f"hnsw ANN legs + {fusion}"] = lambda query: retriever.search(query, n_results, use_ann=True)
+    quantized = {}
+    for precision in precisions:
+        for rescore in [True, False]:
+            name = f"{precision} legs + {fusion}" + (" rescored" if rescore else "")
+            quantized[name] = HybridRetriever(None, retriever.embedding_model_for_query, alpha=0.6, index=index,
+                                              reranker=UnusedReranker(), fusion=fusion,
+                                              embedding_precision=precision, rescore=rescore)
+            # Bind the retriever now, not at call time
+            searches[name] = lambda query, quantized_retriever=quantized[name]: quantized_retriever.search(query, n_results)
+    latencies = {name: [] for name in searches}
+    # Warm up the page cache of the memory-mapped arrays
+    for search in searches.values():
+        search(next(iter(embeddings_by_query)))
+    # Interleave the variants query by query so they see the same cache and CPU conditions
+    for query in embeddings_by_query:
+        for name, search in searches.items():
+            started = time.perf_counter()
+            search(query)
+            latencies[name].append(time.perf_counter() - started)
+    for name, values in latencies.items():
+        print(f"{name:<32} {latency_summary(values)}")
+    if ann_index is not None:
+        print(f"recall@{n_results} of hnsw ANN legs against the exact legs: {ann_recall(retriever, embeddings_by_query, n_results):.3f}")
+    else:
+        print("hnswlib is not installed: skipped the ANN semantic leg")
+    for name, quantized_retriever in quantized.items():
+        store = quantized_retriever.embedding_store
+        recall = search_recall(retriever, quantized_retriever, embeddings_by_query, n_results)
+        print(f"{name:<32} {store.nbytes / 2**20:8.1f} MB embeddings (float32 {index.embeddings.nbytes / 2**20:.1f} MB) | "
+              f"recall@{n_results} against float32: {recall:.3f}")
+
+
+def ann_recall(retriever: HybridRetriever, queries, n_results: int) -> float:
+    """Share of the exact hybrid top n_results that the ANN path also returns, averaged over the queries."""
+    recalls = []
+    for query in queries:
+        exact = retriever.search(query, n_results)
+        if not exact:
+            continue
+        approximate = retriever.search(query, n_results, use_ann=True)
+        recalls.append(len(set(exact) & set(approximate)) / len(exact))
+    return statistics.mean(recalls) if recalls else float("nan")
+
+
+def search_recall(retriever: HybridRetriever, other: HybridRetriever, queries, n_results: int) -> float:
+    """Share of the top n_results of retriever that other also returns, averaged over the queries."""
+    recalls = []
+    for query in queries:
+        exact = retriever.search(query, n_results)
+        if exact:
+            recalls.append(len(set(exact) & set(other.search(query, n_results))) / len(exact))
+    return statistics.mean(recalls) if recalls else float("nan")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-query latency of HybridRetriever.search on synthetic corpora")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--k", type=int, default=3, help="final k; search() is asked for 3 x k candidates like retrieve()")
+    parser.add_argument("--fusion", choices=list(FUSION_STRATEGIES), default=WEIGHTED_MINMAX_FUSION)
+    parser.add_argument("--precisions", nargs="*", choices=[p for p in EMBEDDING_STORES if p != FLOAT32],
+                        default=[FLOAT16, INT8], help="quantized embedding stores to compare with float32")
+    args = parser.parse_args()
+
+    index_root = tempfile.mkdtemp(prefix="hybrid_index_bench_")
+    try:
+        for size in args.sizes:
+            benchmark_size(size, args.queries, args.k * 3, index_root, args.fusion, args.precisions)
+    finally:
+        shutil.rmtree(index_root, ignore_errors=True)
@@ -0,0 +1,135 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+import numpy as np
+from debounced_save import DebouncedSave, SAVE_DELAY_SECONDS
+
+semantic_cache_path = "./semantic_cache/semantic_cache.json"
+
+# all-MiniLM-L6-v2 cosine of a question and its rewording ('What's the incubation period of measles?' vs
+# 'What is the incubation period for measles') is around 0.95.  Different questions of the same disease stay below 0.9
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_SIZE = 1000
+
+
+class SemanticCache:
+    """
+    Answers of AgenticRAG.run keyed by the MiniLM embedding of the question, the retrieval strategy and the corpus
+    (fingerprints of the indexed collections).  A new question hits the cache when the cosine similarity with a cached
+    question of the same strategy and corpus reaches threshold: re-ingesting a collection retires its cached answers.
+    Least recently used entries are evicted beyond max_size.  The cache is saved to a JSON file by a timer thread at
+    most save_delay seconds after a change and at exit, so it survives restarts of the app.
+    """
+    def __init__(self, path: str = semantic_cache_path, max_size: int = SEMANTIC_CACHE_SIZE,
+                 threshold: float = SEMANTIC_CACHE_THRESHOLD, save_delay: float = SAVE_DELAY_SECONDS):
+        self.path = path
+        self.max_size = max_size
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        # entry id -> {query, strategy, corpus, generation, messages}, least recently used first
+        self._entries: OrderedDict = OrderedDict()
+        # entry id -> normalized query embedding
+        self._embeddings: dict[str, np.ndarray] = {}
+        self.hits = 0
+        self.misses = 0
+        self._load()
+        self._saver = DebouncedSave(self._save, save_delay)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            # A broken cache file only costs the cached answers
+            print(f"---Ignored unreadable semantic cache {self.path}: {e}---")
+            return
+        for entry in saved['entries'][-self.max_size:]:
+            entry_id = entry.pop('id')
+            self._embeddings[entry_id] = np.asarray(entry.pop('embedding'), dtype=np.float32)
+            self._entries[entry_id] = entry
+        print(f"---Loaded {len(self._entries)} cached answers from {self.path}---")
+
+    def _save(self):
+        # Only the snapshot is taken under the lock; the embeddings are never modified in place
+        with self._lock:
+            snapshot = [(entry_id, self._embeddings[entry_id], entry) for entry_id, entry in self._entries.items()]
+        entries = [{'id': entry_id, 'embedding': embedding.tolist(), **entry} for entry_id, embedding, entry in snapshot]
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # Write aside then rename, so a crash never leaves a truncated cache file
+        tmp_path = f'{self.path}.tmp-{uuid.uuid4().hex}'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'entries': entries}, f)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        embedding = np.asarray(embedding, dtype=np.float32)
+        return embedding / (np.linalg.norm(embedding) + 1e-8)
+
+    def _scope(self, strategy: str, corpus: str) -> list[str]:
+        # Entries written before the corpus was part of the key have none, so they never match again
+        return [entry_id for entry_id, entry in self._entries.items()
+                if entry['strategy'] == strategy and entry.get('corpus') == corpus]
+
+    def lookup(self, embedding, strategy: str, corpus: str) -> dict | None:
+        """The cached entry of the closest question answered with the same strategy and corpus, if it is close enough."""
+        q_emb = self._normalize(embedding)
+        with self._lock:
+            ids = self._scope(strategy, corpus)
+            if ids:
+                similarities = np.stack([self._embeddings[entry_id] for entry_id in ids]) @ q_emb
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self.hits += 1
+                    self._entries.move_to_end(ids[best])
+                    return {**self._entries[ids[best]], 'similarity': float(similarities[best])}
+            self.misses += 1
+            return None
+
+    def lookup_batch(self, embeddings, strategy: str, corpus: str) -> list[dict | None]:
+        """lookup() of many questions with one matrix product."""
+        q_embs = np.stack([self._normalize(embedding) for embedding in embeddings])
+        with self._lock:
+            ids = self._scope(strategy, corpus)
+            if not ids:
+                self.misses += len(q_embs)
+                return [None] * len(q_embs)
+            similarities = q_embs @ np.stack([self._embeddings[entry_id] for entry_id in ids]).T
+            results = []
+            for row, best in enumerate(np.argmax(similarities, axis=1)):
+                if similarities[row, best] >= self.threshold:
+                    self.hits += 1
+                    self._entries.move_to_end(ids[best])
+                    results.append({**self._entries[ids[best]], 'similarity': float(similarities[row, best])})
+                else:
+                    self.misses += 1
+                    results.append(None)
+            return results
+
+    def put(self, embedding, strategy: str, corpus: str, query: str, generation: str, messages: list[str]):
+        self.put_many(strategy, corpus, [(embedding, query, generation, messages)])
+
+    def put_many(self, strategy: str, corpus: str, answers: list[tuple]):
+        """put() of many (embedding, query, generation, messages)."""
+        with self._lock:
+            for embedding, query, generation, messages in answers:
+                entry_id = uuid.uuid4().hex
+                self._embeddings[entry_id] = self._normalize(embedding)
+                self._entries[entry_id] = {'query': query, 'strategy': strategy, 'corpus': corpus, 'generation': generation,
+                                           'messages': messages, 'created_at': time.time()}
+            while len(self._entries) > self.max_size:
+                evicted_id, _ = self._entries.popitem(last=False)
+                del self._embeddings[evicted_id]
+        self._saver.mark_dirty()
+
+    def flush(self):
+        """Save the pending changes now."""
+        self._saver.flush()
+
+    def __len__(self) -> int:
+        return len(self._entries)
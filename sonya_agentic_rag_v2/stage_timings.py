@@ -0,0 +1,15 @@
+import time
+from contextlib import contextmanager
+
+
+@contextmanager
+def timed(timings: dict | None, stage: str):
+    """Add the seconds spent in the block to timings[stage].  A no-op when timings is None (the serving path)."""
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - started
@@ -0,0 +1,82 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from hybrid_index import HybridIndex, INDEX_FORMAT_VERSION, collection_fingerprint
+
+
+class FakeCollection:
+    """The part of a Chroma collection HybridIndex reads: name, count() and paged get()."""
+    def __init__(self, name: str, documents: list[str]):
+        self.name = name
+        self.ids = [str(i) for i in range(len(documents))]
+        self.documents = documents
+        self.embeddings = np.random.default_rng(0).standard_normal((len(documents), 8)).astype(np.float32)
+
+    def count(self) -> int:
+        return len(self.ids)
+
+    def get(self, include=None, limit=None, offset=0):
+        end = len(self.ids) if limit is None else offset + limit
+        return {
+            'ids': self.ids[offset:end],
+            'documents': self.documents[offset:end],
+            'embeddings': self.embeddings[offset:end],
+            'metadatas': [{'content_hash': doc_id} for doc_id in self.ids[offset:end]],
+        }
+
+
+class TestHybridIndexUpgrade(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.collection = FakeCollection('medical_disease_qna', [
+            'what causes glaucoma', 'symptoms of asthma', 'treatment of migraine', 'insulin pump manual'])
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _downgrade_to_v1(self, path: str):
+        # Artifact of format version 1: no precomputed BM25 weights
+        os.remove(os.path.join(path, 'bm25_weights.npy'))
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        manifest['format_version'] = 1
+        with open(os.path.join(path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+
+    def test_rebuild_replaces_old_format_artifact_at_same_fingerprint(self):
+        path = HybridIndex.open_or_build(self.collection, self.root).path
+        self._downgrade_to_v1(path)
+
+        index = HybridIndex.open_or_build(self.collection, self.root)
+
+        self.assertEqual(index.path, path)
+        self.assertEqual(index.fingerprint, collection_fingerprint(self.collection))
+        self.assertEqual(index.manifest['format_version'], INDEX_FORMAT_VERSION)
+        self.assertTrue(os.path.exists(os.path.join(path, 'bm25_weights.npy')))
+        self.assertEqual(len(index), self.collection.count())
+        self.assertEqual(os.listdir(os.path.dirname(path)), [os.path.basename(path)])
+
+    def test_open_refuses_old_format_artifact(self):
+        path = HybridIndex.open_or_build(self.collection, self.root).path
+        self._downgrade_to_v1(path)
+
+        with self.assertRaises(ValueError):
+            HybridIndex.open(path)
+
+    def test_current_artifact_is_reopened_without_rebuild(self):
+        index = HybridIndex.open_or_build(self.collection, self.root)
+        created_at = index.manifest['created_at']
+
+        reopened = HybridIndex.open_or_build(self.collection, self.root)
+
+        self.assertEqual(reopened.path, index.path)
+        self.assertEqual(reopened.manifest['created_at'], created_at)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from reranker import CrossEncoderReranker, normalize_query
+from debounced_save import DebouncedSave, SAVE_DELAY_SECONDS
+
+web_search_cache_path = "./web_search_cache/web_search_cache.json"
+
+# Results asked from Serper per search.  More snippets than we keep, the cross-encoder picks the best of them
+WEB_SEARCH_RESULTS = 10
+# Snippet chunks put in the prompt after compaction.  The prompt used to get the snippets of GoogleSerperAPIWrapper(k=3):
+# 3 organic snippets of up to about 160 characters, plus the knowledge graph description when there is one.
+# 3 chunks of at most 160 characters never exceed that budget, they are only the best 3 of 10 results
+WEB_SEARCH_MAX_CHUNKS = 3
+WEB_SEARCH_CHUNK_SIZE = 160
+# Medical answers do not change by the hour.  A week keeps popular fallbacks off the API without going stale
+WEB_SEARCH_CACHE_TTL_SECONDS = 7 * 24 * 3600
+WEB_SEARCH_CACHE_SIZE = 5000
+
+
+def parse_serper_snippets(results: dict) -> list[str]:
+    """Answer box, knowledge graph description and organic snippets of a Serper response, like GoogleSerperAPIWrapper.run."""
+    snippets = []
+    answer_box = results.get('answerBox') or {}
+    for key in ['answer', 'snippet']:
+        if answer_box.get(key):
+            snippets.append(str(answer_box[key]).replace('\n', ' '))
+    knowledge_graph = results.get('knowledgeGraph') or {}
+    if knowledge_graph.get('description'):
+        snippets.append(f"{knowledge_graph.get('title', '')}: {knowledge_graph['description']}".lstrip(': '))
+    for result in results.get('organic', []):
+        if result.get('snippet'):
+            snippets.append(result['snippet'])
+    return snippets
+
+
+class SerperBackend:
+    """Google search through the Serper API."""
+    def __init__(self, k: int = WEB_SEARCH_RESULTS):
+        # Imported here so the offline backend works without langchain_community
+        from langchain_community.utilities import GoogleSerperAPIWrapper
+        self.serper = GoogleSerperAPIWrapper(k=k)
+
+    async def search(self, query: str) -> list[str]:
+        # aiohttp request instead of a blocking one
+        return parse_serper_snippets(await self.serper.aresults(query))
+
+
+class StubSearchBackend:
+    """
+    Offline backend for tests and evaluation.py: canned snippets per normalized query from a JSON file
+    {"<query>": ["snippet", ...]}, else k generic snippets.  latency simulates the round-trip to Serper.
+    """
+    def __init__(self, path: str | None = None, latency: float = 0.0, k: int = WEB_SEARCH_RESULTS):
+        self.latency = latency
+        self.k = k
+        self.snippets = {}
+        if path:
+            with open(path, encoding='utf-8') as f:
+                self.snippets = {normalize_query(query): snippets for query, snippets in json.load(f).items()}
+        self.calls = 0
+
+    async def search(self, query: str) -> list[str]:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return self.snippets.get(normalize_query(query)) or \
+            [f"Offline web search result {i + 1} for '{query}'" for i in range(self.k)]
+
+
+class WebSearchCache:
+    """
+    Snippets of web searches keyed by normalized query, so the same question asked again does not call Serper.
+    Entries expire after ttl_seconds and the least recently used ones are evicted beyond max_size.  Saved to a JSON
+    file by a timer thread shortly after a change, like the semantic cache.  path=None keeps the cache in memory only.
+    """
+    def __init__(self, path: str | None = web_search_cache_path, max_size: int = WEB_SEARCH_CACHE_SIZE,
+                 ttl_seconds: float = WEB_SEARCH_CACHE_TTL_SECONDS, save_delay: float = SAVE_DELAY_SECONDS):
+        self.path = path
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # normalized query -> {snippets, created_at}, least recently used first
+        self._entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._load()
+        self._saver = DebouncedSave(self._save, save_delay)
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            # A broken cache file only costs some Serper calls
+            print(f"---Ignored unreadable web search cache {self.path}: {e}---")
+            return
+        now = time.time()
+        for key, entry in saved['entries'][-self.max_size:]:
+            if now - entry['created_at'] <= self.ttl_seconds:
+                self._entries[key] = entry
+        print(f"---Loaded {len(self._entries)} cached web searches from {self.path}---")
+
+    def _save(self):
+        if not self.path:
+            return
+        with self._lock:
+            entries = list(self._entries.items())
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # Write aside then rename, so a crash never leaves a truncated cache file
+        tmp_path = f'{self.path}.tmp-{uuid.uuid4().hex}'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'entries': entries}, f)
+        os.replace(tmp_path, self.path)
+
+    def get(self, query: str) -> list[str] | None:
+        key = normalize_query(query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry['created_at'] > self.ttl_seconds:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry['snippets']
+
+    def put(self, query: str, snippets: list[str]):
+        key = normalize_query(query)
+        with self._lock:
+            self._entries[key] = {'snippets': snippets, 'created_at': time.time()}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        self._saver.mark_dirty()
+
+    def flush(self):
+        """Save the pending changes now."""
+        self._saver.flush()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class WebSearcher:
+    """
+    Web search fallback of AgenticRAG: cached backend call, then compaction.  Snippets are split into chunks of at most
+    chunk_size characters and only the max_chunks best by cross-encoder score go to the prompt, instead of everything
+    Serper returned.  Compaction is CPU-bound and runs on executor (the CPU pool of the registry).
+    """
+    def __init__(self, backend, cache: WebSearchCache, reranker: CrossEncoderReranker, executor=None,
+                 max_chunks: int = WEB_SEARCH_MAX_CHUNKS, chunk_size: int = WEB_SEARCH_CHUNK_SIZE):
+        self.backend = backend
+        self.cache = cache
+        self.reranker = reranker
+        self.executor = executor
+        self.max_chunks = max_chunks
+        self.splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=0, separators=[". ", "; ", " ", ""])
+
+    async def snippets(self, query: str) -> list[str]:
+        snippets = self.cache.get(query)
+        if snippets is not None:
+            print(f"---WEB SEARCH CACHE HIT ({self.cache.hits} hits, {self.cache.misses} misses)---")
+            return snippets
+        snippets = await self.backend.search(query)
+        # An empty answer is not cached: it is more likely a hiccup of the API than the truth
+        if snippets:
+            self.cache.put(query, snippets)
+        return snippets
+
+    def compact(self, query: str, snippets: list[str]) -> str:
+        chunks = list(dict.fromkeys(chunk for snippet in snippets for chunk in self.splitter.split_text(snippet)))
+        if len(chunks) <= self.max_chunks:
+            return '\n'.join(chunks)
+        reranked = self.reranker.rerank(query, [(chunk, chunk) for chunk in chunks], self.max_chunks)
+        # Nothing passing the guardrail still beats an empty context: keep the top snippets Serper ranked first
+        kept = [chunks[position] for position, _ in reranked] or chunks[:self.max_chunks]
+        return '\n'.join(kept)
+
+    async def search(self, query: str) -> str:
+        snippets = await self.snippets(query)
+        context = await asyncio.get_running_loop().run_in_executor(self.executor, self.compact, query, snippets)
+        print(f"---WEB SEARCH COMPACTION: {sum(len(snippet) for snippet in snippets)} -> {len(context)} characters---")
+        return context